@@ -0,0 +1,173 @@
+import csv
+from os import path
+from time import time
+from sys import exit, argv
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+from src.models.CabgenPipeline import CabgenPipeline
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ResultJournal import JournalReplicator
+from src.utils.handle_log import logging_conf, release_logger, task_context
+from src.utils.handle_preflight import preflight
+from src.utils.handle_processing import format_time
+from src.utils.handle_reanalysis import batch_mutations
+from src.utils.handle_results import open_result_store
+
+usage = """Usage:
+    python3 batch_main.py <manifest> [lane=complete|genomic|fastqc] \
+[workers=N] [backend=sqlite|file|mongo] [results=<path>] \
+[mutations=batch|sample]
+
+Runs the read pairs of a manifest without the task queue. The manifest is
+a CSV or TSV with the columns sample, read1 and read2 (an optional header
+line; read paths relative to the manifest). Results go to a SQLite file
+(default <manifest>.sqlite3), a directory of JSON files or Mongo. With
+mutations=batch (default) the BLASTx mutation search runs once per species
+over all the samples after the assemblies, instead of once per sample.
+
+Example:
+    python3 batch_main.py validation.tsv lane=genomic workers=4"""
+
+Entry = Tuple[int, str, str]
+
+
+def read_manifest(manifest: str) -> List[Entry]:
+    base_dir = path.dirname(path.abspath(manifest))
+    with open(manifest, newline="") as infile:
+        lines = [line for line in infile
+                 if line.strip() and not line.startswith("#")]
+    delimiter = "\t" if "\t" in (lines[0] if lines else "") else ","
+
+    entries = []
+    for row in csv.reader(lines, delimiter=delimiter):
+        row = [value.strip() for value in row]
+        if row[0].lower() == "sample":
+            continue
+        if len(row) < 3 or not row[0].isdigit():
+            raise ValueError(f"Invalid manifest line: {row}. Expected a "
+                             "numeric sample and two read files.")
+        read1, read2 = (path.join(base_dir, read) for read in row[1:3])
+        for read in (read1, read2):
+            if not path.isfile(read):
+                raise ValueError(f"Reads of sample {row[0]} not found: "
+                                 f"{read}.")
+        entries.append((int(row[0]), read1, read2))
+
+    samples = [entry[0] for entry in entries]
+    if len(set(samples)) != len(samples):
+        raise ValueError("The manifest repeats samples.")
+    return entries
+
+
+def parse_options(args: List[str]) -> Dict[str, str]:
+    options = {}
+    for arg in args:
+        option, _, value = arg.partition("=")
+        if option not in ("lane", "workers", "backend", "results",
+                          "mutations") or not value:
+            raise ValueError(f"Invalid option {arg}.")
+        options[option] = value
+    return options
+
+
+def run_entry(entry: Entry, lane: str, config: PipelineConfig
+              ) -> Tuple[int, bool, float]:
+    sample, read1, read2 = entry
+    start = time()
+    logger = logging_conf(sample, config.log_path)
+    try:
+        output = path.join(config.uploaded_sequences_path, f"output_{sample}")
+        pipe = CabgenPipeline(sample, "", read1, read2, output,
+                              logger, config)  # type: ignore
+        pipe.run(only_fastqc=lane == "fastqc",
+                 only_genomic=lane == "genomic",
+                 complete=lane == "complete")
+        return sample, True, time() - start
+    except (Exception, SystemExit) as e:
+        print(f"Failed to process sample {sample}.\n\n{e}")
+        return sample, False, time() - start
+    finally:
+        release_logger(logger)
+
+
+def main(args: List[str]):
+    if not args or args[0].startswith("-"):
+        print(usage)
+        exit(1)
+
+    entries = read_manifest(args[0])
+    options = parse_options(args[1:])
+    lane = options.get("lane", "complete")
+    if lane not in ("complete", "genomic", "fastqc"):
+        raise ValueError(f"Invalid lane {lane}.")
+    backend = options.get("backend", "sqlite")
+    results = options.get("results") or \
+        (f"{path.splitext(args[0])[0]}.sqlite3" if backend == "sqlite"
+         else f"{path.splitext(args[0])[0]}_results")
+
+    env_config = PipelineConfig.from_env()
+    config = preflight(replace(
+        env_config,
+        workers=int(options.get("workers", env_config.workers)),
+        result_backend=backend,
+        result_path=path.abspath(results) if backend != "mongo" else "",
+        mutation_deferred=options.get("mutations", "batch") == "batch" and
+        lane != "fastqc"))
+
+    replicator = None
+    if backend == "mongo" and config.result_journal_path:
+        replicator = JournalReplicator(config.result_journal_path,
+                                       config.journal_batch_size)
+        replicator.start()
+
+    start = time()
+    finished: Dict[int, Tuple[bool, float]] = {}
+    with ProcessPoolExecutor(max_workers=max(config.workers, 1),
+                             mp_context=task_context,
+                             max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_entry, entry, lane, config)
+                   for entry in entries]
+        for future in as_completed(futures):
+            sample, ok, runtime = future.result()
+            finished[sample] = (ok, runtime)
+            print(f"Sample {sample} {'finished' if ok else 'failed'} in "
+                  f"{format_time(runtime)} ({len(finished)}/"
+                  f"{len(entries)}).")
+
+    # The mutation batch reads what the samples wrote
+    if replicator and not replicator.drain(config.journal_flush_seconds):
+        raise RuntimeError("Results could not be replicated to Mongo, they "
+                           f"remain in {config.result_journal_path}.")
+
+    store = open_result_store(config)
+    try:
+        succeeded = sorted(sample for sample, (ok, _) in finished.items()
+                           if ok)
+        if config.mutation_deferred and succeeded:
+            print(f"Searching mutations of {len(succeeded)} samples.")
+            for sample, record in batch_mutations(store, config,
+                                                  succeeded).items():
+                store.save("relatorios", {"sequenciaId": sample},
+                           {f"registro.{field}": value
+                            for field, value in record.items()})
+    finally:
+        store.close()
+        if replicator:
+            replicator.drain(config.journal_flush_seconds)
+            replicator.stop()
+
+    failed = len(entries) - len(succeeded)
+    print(f"{len(succeeded)} samples finished, {failed} failed, in "
+          f"{format_time(time() - start)}. Results: "
+          f"{config.result_path or 'mongo'}.")
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
@@ -1,95 +1,323 @@
 import schedule
-from time import sleep
-from typing import List
-from os import getenv, path
-from dotenv import load_dotenv
-from src.utils.handle_log import logging_conf
+from time import sleep, time
+from typing import Dict, List, Set, Tuple
+from datetime import datetime, timezone
+from os import path
+from src.utils.handle_log import logging_conf, release_logger, \
+    init_worker_logging, start_log_listener, stop_log_listener, \
+    task_context
 from src.utils.handle_errors import fatal_error
-from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures import ProcessPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
 from src.models.CabgenPipeline import CabgenPipeline
+from src.models.PipelineConfig import PipelineConfig
+from src.utils.handle_preflight import preflight
+from src.models.TaskLease import TaskLease, recover_expired_leases, \
+    default_worker_id, mark_interrupted
+from src.utils.handle_programs import cancel_running_commands, \
+    reset_interruption, interruption
+from src.utils.handle_trace import configure_tracing, set_trace_context, \
+    record_span, span
+from src.models.RuntimePredictor import RuntimePredictor
+from src.utils.handle_dispatch import order_tasks, publish_predictions
 from src.utils.handle_tasks import get_fastqc_tasks, get_complete_tasks, \
-    get_genomic_tasks
+    get_genomic_tasks, mark_enqueued, count_running_by_user
+from src.utils.handle_metrics import write_metrics
+from src.utils.handle_workload import workload_record, record_workload
+from src.models.FairShareQueue import FairShareQueue, \
+    starvation_descriptions, enqueued_at
+from src.models.DiskBudget import DiskBudget, disk_descriptions
+from src.models.ResultJournal import JournalReplicator, journal_metrics, \
+    journal_descriptions, journaled_samples
 
-load_dotenv()
+log_queue = None
 
 
-def process_task(task: dict, mode: str):
+def process_task(task: dict, mode: str, config: PipelineConfig):
+    logger = None
+    lease = None
+    pipe = None
+    result = "failed"
+    sample = int(task.get("_id", 0))
+    # The interruption flags are per process, start the task with them clear
+    reset_interruption()
+    worker_id = default_worker_id(config.worker_id)
+    configure_tracing(config.trace_path, f"worker {worker_id}")
+    set_trace_context(sample=sample, lane=mode, worker=worker_id)
     try:
-        output_path = getenv("UPLOADED_SEQUENCES_PATH") or ""
-        if not output_path:
-            raise ValueError("There is no output path.")
-
-        log_path = getenv("LOG_PATH") or ""
-        if not log_path:
-            raise ValueError("There is no log path.")
-
-        sample = int(task.get("_id", 0))
+        output_path = config.uploaded_sequences_path
+        lease = TaskLease(sample, task.get("ultimaTarefa", ""),
+                          worker_id=worker_id,
+                          lease_seconds=config.lease_seconds,
+                          on_cancel=cancel_running_commands,
+                          cancel_poll_seconds=config.cancel_poll_seconds)
+        if not lease.claim():
+            print(f"Task {sample} is already claimed by another worker.")
+            return
+        if lease.cancelled:
+            return
+        claimed_at = datetime.now(timezone.utc)
+        record_span("queue_wait", "queue",
+                    enqueued_at(task, claimed_at).timestamp(),
+                    claimed_at.timestamp())
         recipient_email = task.get("email", "")
         read1 = task.get("arquivofastqr1", "")
         read2 = task.get("arquivofastqr2", "")
         output = path.join(output_path, f"output_{sample}")
 
-        logger = logging_conf(sample, log_path)
+        logger = logging_conf(sample, config.log_path)
         if not logger:
             print("Logger could not be started")
 
         pipe = CabgenPipeline(sample, recipient_email, read1, read2,
-                              output, logger)  # type: ignore
+                              output, logger, config)  # type: ignore
 
-        if mode == "fastqc":
-            pipe.run(only_fastqc=True)
-        elif mode == "complete":
-            pipe.run(complete=True)
-        elif mode == "genomic":
-            pipe.run(only_genomic=True)
-        else:
-            raise ValueError("Invalid mode provided for task processing.")
+        with span("task", "task"):
+            if mode == "fastqc":
+                pipe.run(only_fastqc=True)
+            elif mode == "complete":
+                pipe.run(complete=True)
+            elif mode == "genomic":
+                pipe.run(only_genomic=True)
+            else:
+                raise ValueError("Invalid mode provided for task "
+                                 "processing.")
+        result = "ok"
 
     except Exception as e:
         print(f"Failed to process task {sample}.\n\n{e}")
+    finally:
+        release_logger(logger)
+        replicated = True
+        if pipe and config.result_journal_path:
+            replicated = flush_journal(config)
+        if lease:
+            result = finish_interrupted(lease) or result
+            # Released, the task would be taken again before its journaled
+            # state reaches Mongo; the scheduler keeps it aside meanwhile
+            # and the lease expires once it is replicated
+            if replicated:
+                lease.release()
+            else:
+                lease.stop_heartbeat()
+        if pipe:
+            record_workload(config.workload_path, workload_record(
+                task, mode, pipe, claimed_at, config.workers, result))
+
+
+def finish_interrupted(lease: TaskLease) -> str:
+    reason = "cancelled" if lease.cancelled else interruption()
+    if not reason:
+        return reason
+    try:
+        result = "cancelada" if reason == "cancelled" else "tempo_esgotado"
+        mark_interrupted(lease.task_id, lease.lane, result)
+        print(f"Task {lease.task_id} {reason}.")
+    except Exception as e:
+        print(f"Failed to mark task {lease.task_id} as {reason}.\n\n{e}")
+    return reason
+
+
+def flush_journal(config: PipelineConfig) -> bool:
+    # The task state must reach Mongo before the lease is released, or the
+    # next poll could take the task again; during an outage the scheduler's
+    # replicator pushes it once the database is back
+    replicator = JournalReplicator(config.result_journal_path,
+                                   config.journal_batch_size)
+    try:
+        if replicator.drain(config.journal_flush_seconds):
+            return True
+        print("Results not yet replicated to Mongo, left in the journal.")
+        return False
+    finally:
+        replicator.stop()
+
+
+lanes = ["fastqc", "complete", "genomic"]
+
+
+def fetch_tasks(config: PipelineConfig, known: Set[int]) -> List[dict]:
+    """
+    Takes the tasks waiting in every lane that the dispatcher has not seen
+    yet, with their predictions and their lane. Tasks with results still
+    in the result journal keep their lease and are left out, as their state
+    in Mongo is not current yet.
+    """
+    journaled: Set[int] = set()
+    try:
+        if config.result_journal_path:
+            journaled = journaled_samples(config.result_journal_path)
+    except Exception as e:
+        print(f"Failed to read the result journal.\n\n{e}")
 
+    try:
+        recovered = recover_expired_leases(exclude=journaled)
+        if recovered:
+            print(f"Recovered {recovered} tasks with expired leases.")
+    except Exception as e:
+        print(f"Failed to recover expired leases.\n\n{e}")
+
+    fetched = [(get_fastqc_tasks(), "fastqc"),
+               (get_complete_tasks(), "complete"),
+               (get_genomic_tasks(), "genomic")]
+    skipped = known | journaled
+    fetched = [([task for task in tasks if task["_id"] not in skipped], mode)
+               for tasks, mode in fetched]
+    if not any(tasks for tasks, _ in fetched):
+        return []
+
+    with span("plan_dispatch", "scheduler"):
+        ordered_lanes = plan_dispatch(fetched, config)
+    tasks = []
+    for ordered, mode in zip(ordered_lanes, lanes):
+        if ordered:
+            print(f"Queued {len(ordered)} {mode} tasks.")
+        for task in ordered:
+            task["lane"] = mode
+            tasks.append(task)
+    return tasks
 
-def process_tasks_in_parallel(tasks: List[dict], mode: str):
+
+def process_tasks_in_parallel(config: PipelineConfig):
+    """
+    Dispatches the tasks of all lanes on the worker slots until none is
+    left. The queue is refilled from Mongo whenever a slot frees up and
+    every DISPATCH_REFILL_SECONDS, so a task submitted meanwhile competes
+    for the next slot instead of waiting for the tasks fetched before it.
+    """
     try:
-        workers = getenv("WORKERS") or 2
-        with ProcessPoolExecutor(max_workers=int(workers)) as executor:
-            futures = [executor.submit(process_task, task, mode)
-                       for task in tasks]
-            wait(futures)
+        workers = config.workers
+        queue = FairShareQueue([], config.user_max_concurrency,
+                               count_running_by_user())
+        disk = DiskBudget(config.uploaded_sequences_path,
+                          config.disk_headroom_mb)
+        # Tasks dispatched or queued in this run; failed ones are retried
+        # by the next run, as before
+        known: Set[int] = set()
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=task_context,
+                                 max_tasks_per_child=1,
+                                 initializer=init_worker_logging,
+                                 initargs=(log_queue,)) as executor:
+            running: Dict[Future, dict] = {}
+            refill = True
+            while True:
+                if refill:
+                    tasks = fetch_tasks(config, known)
+                    known.update(task["_id"] for task in tasks)
+                    queue.add(tasks)
+                    fetched_at = time()
+                    if config.result_journal_path:
+                        write_metrics(config.metrics_path, "journal",
+                                      journal_metrics(
+                                          config.result_journal_path),
+                                      journal_descriptions)
+
+                disk.measure()
+                while len(running) < workers:
+                    task = queue.next_task(disk.fits)
+                    if task is None:
+                        break
+                    disk.reserve(task)
+                    future = executor.submit(process_task, task,
+                                             task["lane"], config)
+                    running[future] = task
+
+                for lane in lanes:
+                    write_metrics(config.metrics_path, f"scheduler_{lane}",
+                                  queue.starvation_metrics(lane),
+                                  starvation_descriptions)
+                write_metrics(config.metrics_path, "disk",
+                              disk.metrics({lane: queue.blocked(lane)
+                                            for lane in lanes}),
+                              disk_descriptions)
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED,
+                               timeout=max(config.dispatch_refill_seconds -
+                                           (time() - fetched_at), 0))
+                for future in done:
+                    task = running.pop(future)
+                    queue.task_finished(task)
+                    disk.release(task)
+                refill = bool(done) or \
+                    time() - fetched_at >= config.dispatch_refill_seconds
+
+        if queue.blocked():
+            print(f"{queue.blocked()} tasks deferred for lack of disk "
+                  "space.")
+        if len(queue) > queue.blocked():
+            print(f"{len(queue) - queue.blocked()} tasks deferred by user "
+                  "concurrency caps.")
     except Exception as e:
         print(f"Failed to process tasks in parallel.\n\n{e}")
 
 
-def pipeline_job():
+def plan_dispatch(lanes: List[Tuple[List[dict], str]],
+                  config: PipelineConfig) -> List[List[dict]]:
     try:
-        fastqc_tasks = get_fastqc_tasks()
-        complete_tasks = get_complete_tasks()
-        genomic_tasks = get_genomic_tasks()
+        predictor = RuntimePredictor.from_mongo()
+    except Exception as e:
+        print(f"Failed to load runtime history.\n\n{e}")
+        predictor = RuntimePredictor([])
 
-        if fastqc_tasks:
-            print(f"Processing {len(fastqc_tasks)} FastQC tasks...")
-            process_tasks_in_parallel(fastqc_tasks, "fastqc")
+    running = count_running_by_user()
+    start = datetime.now(timezone.utc)
 
-        if complete_tasks:
-            print(f"Processing {len(complete_tasks)} Complete tasks...")
-            process_tasks_in_parallel(complete_tasks, "complete")
+    ordered_lanes = []
+    for tasks, mode in lanes:
+        mark_enqueued(tasks)
+        ordered = order_tasks(tasks, mode, predictor,
+                              config.uploaded_sequences_path,
+                              config.dispatch_policy)
+        ordered = FairShareQueue(ordered, config.user_max_concurrency,
+                                 running).planned_order()
+        start = publish_predictions(ordered, config.workers, start)
+        ordered_lanes.append(ordered)
+    return ordered_lanes
 
-        if genomic_tasks:
-            print(f"Processing {len(genomic_tasks)} Genomic tasks...")
-            process_tasks_in_parallel(genomic_tasks, "genomic")
+
+def pipeline_job(config: PipelineConfig):
+    try:
+        with span("dispatch", "scheduler"):
+            process_tasks_in_parallel(config)
     except Exception as e:
         print(f"Failed to run pipeline_job.\n\n{e}")
 
 
 def main():
+    global log_queue
+    replicator = None
     try:
+        # A broken install is refused here instead of failing every sample
+        config = preflight(PipelineConfig.from_env())
+        for program, version in config.tool_versions.items():
+            print(f"{program}: {version}")
+        configure_tracing(config.trace_path,
+                          f"scheduler {default_worker_id(config.worker_id)}")
+
+        log_queue, log_listener = start_log_listener(
+            config.log_path, config.log_json_path)
+
+        # Results written while Mongo was unreachable, by this run or an
+        # earlier one, are pushed in the background
+        if config.result_journal_path:
+            replicator = JournalReplicator(config.result_journal_path,
+                                           config.journal_batch_size)
+            replicator.start()
+
         timeout = 5
-        schedule.every(timeout).minutes.do(pipeline_job)
+        schedule.every(timeout).minutes.do(pipeline_job, config)
 
         while True:
             schedule.run_pending()
             sleep(20)
     except Exception as e:
+        if replicator:
+            replicator.stop()
+        if log_queue is not None:
+            stop_log_listener(log_queue, log_listener)
         fatal_error(f"Failed to run main function.\n\n{e}")
 
 
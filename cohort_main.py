@@ -0,0 +1,151 @@
+import json
+from os import path, makedirs, replace
+from sys import exit, argv
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+from src.models.MongoHandler import MongoHandler
+from src.models.PipelineConfig import PipelineConfig
+from src.models.CohortStore import CohortStore
+
+usage = """Usage:
+    python3 cohort_main.py export
+    python3 cohort_main.py samples [column=value ...]
+    python3 cohort_main.py prevalence <list column> [by=<column>] \
+[column=value ...]
+
+Example:
+    python3 cohort_main.py samples speciesKey=klebsiella_pneumoniae st=258 \
+mutationGenes=PmrB"""
+
+export_batch_size = 5000
+
+
+Checkpoint = Tuple[datetime, Dict[str, str]]
+
+
+def read_checkpoint(cohort_path: str) -> Checkpoint:
+    """
+    Returns the finishedAt of the last exported record and the records
+    exported within the overlap window before it, as sample to finishedAt.
+    """
+    checkpoint_file = path.join(cohort_path, "_checkpoint.json")
+    if not path.isfile(checkpoint_file):
+        return datetime(1970, 1, 1), {}
+    with open(checkpoint_file) as infile:
+        checkpoint = json.load(infile)
+    return datetime.fromisoformat(checkpoint["exportedUntil"]), \
+        checkpoint.get("recent", {})
+
+
+def write_checkpoint(cohort_path: str, exported_until: datetime,
+                     recent: Dict[str, str]):
+    checkpoint_file = path.join(cohort_path, "_checkpoint.json")
+    with open(f"{checkpoint_file}.tmp", "w") as outfile:
+        json.dump({"exportedUntil": exported_until.isoformat(),
+                   "recent": recent}, outfile)
+    replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+
+def export_records(config: PipelineConfig) -> int:
+    """
+    Appends the sample records finished since the last export to the
+    cohort dataset. finishedAt is the producer's clock, so a record can
+    reach Mongo after a newer one was exported (concurrent workers, results
+    journaled during an outage): the export starts COHORT_EXPORT_OVERLAP
+    seconds before the checkpoint and skips the records it already has.
+
+    Returns:
+        int: Number of records exported.
+    """
+    makedirs(config.cohort_path, exist_ok=True)
+    store = CohortStore(config.cohort_path)
+    exported_until, recent = read_checkpoint(config.cohort_path)
+    overlap = timedelta(seconds=config.cohort_export_overlap)
+    cursor = exported_until - overlap
+    exported = 0
+
+    mongo_client = MongoHandler()
+    try:
+        while True:
+            reports = mongo_client.search(
+                "relatorios",
+                match={"registro.finishedAt": {"$gt": cursor}},
+                sort={"registro.finishedAt": 1},
+                limit=export_batch_size,
+                project={"_id": 0, "registro": 1})
+            records = [report["registro"] for report in reports]
+            if not records:
+                break
+            cursor = records[-1]["finishedAt"]
+
+            new_records = [
+                record for record in records
+                if recent.get(str(record["sample"])) !=
+                record["finishedAt"].isoformat()]
+            if new_records:
+                store.append(new_records)  # type: ignore
+                exported += len(new_records)
+            for record in new_records:
+                recent[str(record["sample"])] = \
+                    record["finishedAt"].isoformat()
+
+            exported_until = max(exported_until, cursor)
+            recent = {sample: finished for sample, finished in recent.items()
+                      if datetime.fromisoformat(finished) >
+                      exported_until - overlap}
+            write_checkpoint(config.cohort_path, exported_until, recent)
+    finally:
+        mongo_client.close()
+    return exported
+
+
+def parse_filters(args: List[str]) -> Dict[str, List[str]]:
+    filters: Dict[str, List[str]] = {}
+    for arg in args:
+        column, _, value = arg.partition("=")
+        if not value:
+            raise ValueError(f"Invalid filter {arg}.")
+        filters.setdefault(column, []).append(value)
+    return filters
+
+
+def main(args: List[str]):
+    config = PipelineConfig.from_env()
+    if not config.cohort_path:
+        raise Exception("COHORT_PATH is not defined.")
+    command = args[0] if args else ""
+
+    if command == "export":
+        started = datetime.now(timezone.utc)
+        exported = export_records(config)
+        print(f"Exported {exported} records in "
+              f"{(datetime.now(timezone.utc) - started).total_seconds():.1f}"
+              " s.")
+        return
+
+    store = CohortStore(config.cohort_path)
+    if command == "samples":
+        filters = parse_filters(args[1:])
+        frame = store.load(filters.pop("speciesKey", None))
+        samples = frame.samples(**filters)
+        print(f"{len(samples)} samples")
+        print(" ".join(str(sample) for sample in samples))
+    elif command == "prevalence" and len(args) > 1:
+        filters = parse_filters(args[2:])
+        by = filters.pop("by", [""])[0]
+        frame = store.load(filters.pop("speciesKey", None))
+        prevalence = frame.prevalence(args[1], by, **filters)
+        for (group, value), (count, total, fraction) in sorted(
+                prevalence.items()):
+            print(f"{group}\t{value}\t{count}/{total}\t{fraction:.1%}")
+    else:
+        print(usage)
+        exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
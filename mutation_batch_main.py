@@ -0,0 +1,34 @@
+from sys import exit, argv
+from typing import List
+from src.models.MongoHandler import MongoHandler
+from src.models.PipelineConfig import PipelineConfig
+from src.utils.handle_reanalysis import batch_mutations
+
+usage = """Usage:
+    python3 mutation_batch_main.py [sample ...]
+
+Reprocesses the BLASTx mutation search of the given samples, or of every
+sample with a mutation species, batching the samples of each species."""
+
+
+def main(args: List[str]):
+    if any(not arg.isdigit() for arg in args):
+        print(usage)
+        exit(1)
+
+    config = PipelineConfig.from_env()
+    mongo_client = MongoHandler()
+    try:
+        records = batch_mutations(mongo_client, config,
+                                  [int(arg) for arg in args])
+        print(f"Reprocessed {len(records)} samples.")
+    finally:
+        mongo_client.close()
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
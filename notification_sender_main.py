@@ -0,0 +1,34 @@
+import schedule
+from time import sleep
+from src.utils.handle_errors import fatal_error
+from src.models.PipelineConfig import PipelineConfig
+from src.models.NotificationOutbox import NotificationOutbox
+from src.utils.handle_notifications import drain_outbox
+
+
+def notification_job(config: PipelineConfig):
+    try:
+        outbox = NotificationOutbox(config.outbox_database())
+        sent = drain_outbox(outbox, config)
+        outbox.close()
+
+        if sent:
+            print(f"Sent {len(sent)} notifications.")
+    except Exception as e:
+        print(f"Failed to run notification_job.\n\n{e}")
+
+
+def main():
+    try:
+        config = PipelineConfig.from_env()
+        schedule.every(1).minutes.do(notification_job, config)
+
+        while True:
+            schedule.run_pending()
+            sleep(20)
+    except Exception as e:
+        fatal_error(f"Failed to run notification sender.\n\n{e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import os
+import logging
+from os import path
+from sys import exit, argv
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+from src.models.CabgenPipeline import CabgenPipeline
+from src.models.MongoHandler import MongoHandler
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ReferenceDatabases import ReferenceDatabases
+from src.utils.handle_log import log_format, release_logger
+from src.utils.handle_reanalysis import database_stages, abricate_stages, \
+    stage_record_fields, batch_mutations, plan_reanalysis, save_reanalysis
+
+usage = """Usage:
+    python3 reanalysis_main.py plan [database ...] [column=value ...] \
+[sample ...]
+    python3 reanalysis_main.py run [database ...] [column=value ...] \
+[sample ...]
+
+Reruns, on the stored assemblies and annotations, only the stages that
+depend on reference databases updated since each sample was analysed, and
+updates only the report fields of those stages. Databases default to all of
+""" + ", ".join(database_stages) + """; filters match the sample
+record, e.g. speciesKey=klebsiella_pneumoniae.
+
+Example:
+    python3 reanalysis_main.py run abricate_db speciesKey=escherichia_coli"""
+
+
+def parse_args(args: List[str]) -> Tuple[List[str], dict]:
+    databases = []
+    match: dict = {}
+    samples = []
+    for arg in args:
+        if arg.isdigit():
+            samples.append(int(arg))
+        elif "=" in arg:
+            column, _, value = arg.partition("=")
+            values = match.setdefault(f"registro.{column}", {"$in": []})
+            # Numbers may be stored as text (st) or as integers (sample)
+            values["$in"] += [value, int(value)] if value.isdigit() \
+                else [value]
+        elif arg in database_stages:
+            databases.append(arg)
+        else:
+            raise ValueError(f"Unknown database or filter {arg}.")
+    if samples:
+        match["sequenciaId"] = {"$in": samples}
+    return databases or list(database_stages), match
+
+
+def reanalysis_logger(sample: int, log_dir: str) -> logging.Logger:
+    logger = logging.getLogger(f"reanalise_{sample}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    os.makedirs(log_dir, exist_ok=True)
+    handler = logging.FileHandler(
+        path.join(log_dir, f"reanalise_{sample}.log"))
+    handler.setFormatter(log_format)
+    logger.addHandler(handler)
+    return logger
+
+
+def reanalyze_sample(sample: int, stages: List[str],
+                     config: PipelineConfig) -> dict:
+    logger = reanalysis_logger(sample, config.log_path)
+    pipe = None
+    try:
+        output = path.join(config.uploaded_sequences_path, f"output_{sample}")
+        pipe = CabgenPipeline(sample, "", "", "", output, logger, config)
+        return dict(pipe.reanalyze(stages))
+    finally:
+        if pipe:
+            pipe.mongo_client.close()
+        release_logger(logger)
+
+
+def run_batch(batch: Dict[int, Tuple[List[str], List[str]]],
+              current: Dict[str, str], mongo_client: MongoHandler,
+              config: PipelineConfig) -> int:
+    """
+    Reanalyses a batch: the Abricate stages of the samples in parallel, and
+    the mutation search of all of them as one BLASTx batch per species.
+    Each sample gets the versions of the databases whose stages all
+    succeeded, so a failed sample is picked again by the next run.
+
+    Returns:
+        int: Number of samples updated.
+    """
+    records: Dict[int, dict] = {sample: {} for sample in batch}
+    with ProcessPoolExecutor(max_workers=max(config.workers, 1)) as executor:
+        futures = {executor.submit(reanalyze_sample, sample, [
+            stage for stage in stages if stage in abricate_stages], config):
+            sample for sample, (stages, _) in batch.items()
+            if any(stage in abricate_stages for stage in stages)}
+
+        mutation_samples = [sample for sample, (stages, _) in batch.items()
+                            if "mutations" in stages]
+        if mutation_samples:
+            try:
+                for sample, record in batch_mutations(
+                        mongo_client, config, mutation_samples).items():
+                    records[sample].update(record)
+            except Exception as e:
+                print(f"Failed to reanalyse mutations.\n\n{e}")
+
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                records[sample].update(future.result())
+            except (Exception, SystemExit) as e:
+                print(f"Failed to reanalyse {sample}.\n\n{e}")
+
+    updated = 0
+    for sample, (stages, stale) in batch.items():
+        record = records[sample]
+        done = [stage for stage in stages
+                if all(field in record
+                       for field in stage_record_fields[stage])]
+        versions = {database: current[database] for database in stale
+                    if all(stage in done or stage not in stages
+                           for stage in database_stages[database])}
+        if versions:
+            save_reanalysis(mongo_client, sample, record, versions)
+            updated += 1
+    return updated
+
+
+def main(args: List[str]):
+    if not args or args[0] not in ("plan", "run"):
+        print(usage)
+        exit(1)
+
+    config = PipelineConfig.from_env()
+    if not config.reference_db_root:
+        raise ValueError("Reanalysis needs the versioned reference "
+                         "databases, REFERENCE_DB_ROOT is not set.")
+    databases, match = parse_args(args[1:])
+    current = ReferenceDatabases(config.reference_db_root).versions()
+
+    mongo_client = MongoHandler()
+    try:
+        reports = mongo_client.search(
+            "relatorios", match=match,
+            project={"sequenciaId": 1, "especieMutacoes": 1,
+                     "versoesBancos": 1, "registro.databaseVersions": 1})
+        plan = plan_reanalysis(reports, current, databases)
+        stage_counts = Counter(stage for stages, _ in plan.values()
+                               for stage in stages)
+        print(f"{len(plan)} of {len(reports)} samples to reanalyse.")
+        for stage, count in stage_counts.most_common():
+            print(f"  {stage}: {count}")
+        if args[0] == "plan":
+            return
+
+        samples = sorted(plan)
+        batch_size = max(config.reanalysis_batch_size, 1)
+        updated = 0
+        for start in range(0, len(samples), batch_size):
+            batch = {sample: plan[sample]
+                     for sample in samples[start:start + batch_size]}
+            updated += run_batch(batch, current, mongo_client, config)
+            print(f"Reanalysed {updated} of {len(samples)} samples.")
+    finally:
+        mongo_client.close()
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
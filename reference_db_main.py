@@ -0,0 +1,95 @@
+from sys import exit, argv
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ReferenceDatabases import ReferenceDatabases, \
+    managed_databases
+from src.utils.handle_databases import missing_blast_indexes, \
+    build_blast_index
+
+usage = """Usage:
+    python3 reference_db_main.py list
+    python3 reference_db_main.py install <name> <source> [version]
+    python3 reference_db_main.py activate <name> <version>
+    python3 reference_db_main.py verify [name]
+    python3 reference_db_main.py prune <name> [keep]
+    python3 reference_db_main.py index
+
+Databases: """ + ", ".join(managed_databases)
+
+
+def list_databases(databases: ReferenceDatabases):
+    for name in managed_databases:
+        current = databases.current_version(name)
+        for version in databases.installed_versions(name):
+            marker = "*" if version == current else " "
+            manifest = databases.manifest(name, version)
+            print(f"{marker} {name} {version} {manifest['checksum'][:12]} "
+                  f"{manifest['installedAt']}")
+
+
+def verify_databases(databases: ReferenceDatabases, names: list) -> bool:
+    sound = True
+    for name in names:
+        if not databases.current_version(name):
+            continue
+        problems = databases.verify(name)
+        for problem in problems:
+            print(problem)
+        if not problems:
+            print(f"{name} {databases.current_version(name)}: OK")
+        sound = sound and not problems
+    return sound
+
+
+def index_unmanaged(config: PipelineConfig):
+    """
+    Builds the missing BLAST indexes of databases configured by path, for
+    installs that do not use REFERENCE_DB_ROOT yet.
+    """
+    for database_path in (config.polimyxin_db, config.outhers_db):
+        if not database_path:
+            continue
+        for fasta in missing_blast_indexes(database_path):
+            print(f"Indexing {fasta}")
+            build_blast_index(fasta, config.makeblastdb)
+
+
+def main(args: list):
+    config = PipelineConfig.from_env()
+    command = args[0] if args else ""
+
+    if command == "index":
+        index_unmanaged(config)
+        return
+
+    if not config.reference_db_root:
+        raise Exception("REFERENCE_DB_ROOT is not defined.")
+    databases = ReferenceDatabases(config.reference_db_root,
+                                   config.makeblastdb)
+
+    if command == "list":
+        list_databases(databases)
+    elif command == "install" and len(args) in (3, 4):
+        manifest = databases.install(args[1], args[2],
+                                     args[3] if len(args) == 4 else "")
+        print(f"{manifest['name']} {manifest['version']} is current.")
+    elif command == "activate" and len(args) == 3:
+        databases.activate(args[1], args[2])
+        print(f"{args[1]} {args[2]} is current.")
+    elif command == "verify":
+        if not verify_databases(databases, args[1:] or managed_databases):
+            exit(1)
+    elif command == "prune" and len(args) in (2, 3):
+        removed = databases.prune(args[1],
+                                  int(args[2]) if len(args) == 3 else 2)
+        print(f"Removed versions: {', '.join(removed) or 'none'}")
+    else:
+        print(usage)
+        exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
@@ -0,0 +1,92 @@
+import os
+from glob import glob
+from os import path
+from sys import exit, argv
+from itertools import product
+from dataclasses import asdict
+from typing import Dict, List
+from src.models.PipelineConfig import PipelineConfig
+from src.models.SchedulerSimulator import SchedulerSimulator, \
+    SimulationSettings
+from src.utils.handle_workload import read_workload
+
+usage = """Usage:
+    python3 simulate_main.py [workload.jsonl ...] [workers=2,4] \
+[threads=3,6] [cores=16] [policy=fifo,sjf,ljf] [dispatch=rounds,continuous] \
+[poll=300] [cap=0]
+
+Replays the recorded workload (every file in WORKLOAD_PATH by default) for
+each combination of the given settings. Settings not given default to the
+current configuration."""
+
+# Result column, header, width and format
+columns = [("workers", "workers", 7, ""), ("threads", "threads", 7, ""),
+           ("cores", "cores", 5, ""), ("policy", "policy", 6, ""),
+           ("dispatch", "dispatch", 10, ""),
+           ("throughput_per_hour", "tasks/h", 8, ".2f"),
+           ("turnaround_p50", "ta p50", 9, ".0f"),
+           ("turnaround_p95", "ta p95", 9, ".0f"),
+           ("wait_p50", "wait p50", 9, ".0f"),
+           ("wait_p95", "wait p95", 9, ".0f"),
+           ("slot_utilization", "slots", 6, ".0%"),
+           ("cpu_utilization", "cpu", 6, ".0%")]
+
+
+def parse_settings(args: List[str],
+                   config: PipelineConfig) -> Dict[str, list]:
+    options = {"workers": [config.workers],
+               "threads": [config.threads],
+               "cores": [os.cpu_count() or 1],
+               "policy": [config.dispatch_policy],
+               "dispatch": ["continuous"],
+               "poll": [300.],
+               "cap": [config.user_max_concurrency]}
+    for arg in args:
+        name, _, values = arg.partition("=")
+        if name not in options or not values:
+            raise ValueError(f"Invalid setting {arg}.")
+        kind = type(options[name][0])
+        options[name] = [kind(value) for value in values.split(",")]
+    return options
+
+
+def main(args: List[str]):
+    if args and args[0] in ("-h", "--help"):
+        print(usage)
+        exit(0)
+
+    config = PipelineConfig.from_env()
+    workload_files = [arg for arg in args if "=" not in arg]
+    if not workload_files and config.workload_path:
+        workload_files = sorted(glob(path.join(config.workload_path,
+                                               "workload-*.jsonl")))
+    if not workload_files:
+        raise Exception("No workload files given and WORKLOAD_PATH is "
+                        "empty.")
+
+    records = read_workload(workload_files)
+    options = parse_settings([arg for arg in args if "=" in arg], config)
+    simulator = SchedulerSimulator(records)
+    print(f"Replaying {len(records)} tasks from {len(workload_files)} "
+          "files.")
+    print(" ".join(f"{header:>{width}}" for _, header, width, _ in columns))
+
+    for workers, threads, cores, policy, dispatch, poll, cap in product(
+            options["workers"], options["threads"], options["cores"],
+            options["policy"], options["dispatch"], options["poll"],
+            options["cap"]):
+        settings = SimulationSettings(workers=workers, threads=threads,
+                                      cores=cores, policy=policy,
+                                      dispatch=dispatch, poll_interval=poll,
+                                      user_max_concurrency=cap)
+        result = {**asdict(settings), **simulator.simulate(settings)}
+        print(" ".join(f"{result[name]:>{width}{spec}}"
+                       for name, _, width, spec in columns))
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)
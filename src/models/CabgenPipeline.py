@@ -1,37 +1,74 @@
-import re
 import sys
 from time import time
-from dotenv import load_dotenv
+from typing import Dict, List, Tuple, Union
+from collections import Counter
+from datetime import datetime, timezone
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
 from logging import Logger
 from shutil import rmtree, copy
-from os import getenv, path, makedirs, listdir
-from src.models.MongoHandler import MongoHandler
+from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs, listdir
 from src.types.SpeciesDict import SpeciesDict
-from src.utils.handle_programs import run_command_line
-from src.utils.handle_folders import delete_folders_and_files
+from src.types.SampleRecord import SampleRecord
+from src.utils.handle_programs import run_command_line, \
+    set_command_deadline, check_interrupted, CommandTimeout, \
+    CommandCancelled
+from src.utils.handle_folders import delete_folders_and_files, \
+    directory_size
 from src.utils.handle_processing import count_kraken_words, \
     build_species_data, identify_bacteria_species, get_abricate_result, \
     process_resfinder, process_vfdb, process_plasmidfinder, format_time, \
-    handle_fastani_species
-from src.utils.send_email import send_email
-
-load_dotenv()
-uploaded_sequences_path = getenv("UPLOADED_SEQUENCES_PATH") or ""
-fastqc_output_path = getenv("FASTQC_OUTPUT_PATH") or ""
+    handle_fastani_species, parse_prokka_gff, map_abricate_hits_to_features, \
+    read_kraken_names, species_key, split_species_name, \
+    species_reference_files
+from src.utils.handle_reads import profile_reads, subsample_read_pairs, \
+    stage_reads, is_gzipped, head_read_pairs
+from src.utils.handle_databases import warm_page_cache
+from src.utils.handle_qc import run_native_qc
+from src.utils.handle_trace import span
+from src.utils.handle_results import open_result_store
+from src.utils.handle_checkm import cached_marker_set, checkm_taxa
+from src.utils.handle_gates import QualityGateFailed, assembly_stats, \
+    check_maximum, check_minimum, kraken_margin
+from src.utils.handle_records import new_sample_record, species_slug, \
+    abricate_genes, parse_mutations, to_float
+from src.utils.send_email import queue_email
+from src.models.RuntimePredictor import RuntimePredictor, read_features
+from src.models.ProgressReporter import ProgressReporter
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ReferenceDatabases import ReferenceDatabases, \
+    managed_databases
 
 
 class CabgenPipeline:
     def __init__(self, sample: int, recipient_email: str, read1: str,
-                 read2: str, output: str, logger: Logger):
+                 read2: str, output: str, logger: Logger,
+                 config: Union[PipelineConfig, None] = None):
+        self.config = config or PipelineConfig.from_env()
         self.sample = int(sample)
         self.recipient_email = recipient_email
-        self.read1 = path.join(uploaded_sequences_path, read1)
-        self.read2 = path.join(uploaded_sequences_path, read2)
+        self.read1 = path.join(self.config.uploaded_sequences_path, read1)
+        self.read2 = path.join(self.config.uploaded_sequences_path, read2)
+        # Reads given to the tools, the staged plain copies when available
+        self.input_read1 = self.read1
+        self.input_read2 = self.read2
+        self.staging_dir = ""
         self.output = output
-        self.threads = 3 if not getenv("THREADS") \
-            else int(getenv("THREADS"))  # type: ignore
-        self.mongo_client = MongoHandler()
+        self.threads = self.config.threads
+        self.mongo_client = open_result_store(self.config)
         self.logger = logger
+        self.stage_durations: Dict[str, float] = {}
+        self.stage_cpu: Dict[str, float] = {}
+        self.progress: Union[ProgressReporter, None] = None
+        self.read_count = None
+        self.read_profile: Union[Tuple[int, int], None] = None
+        self.display_name = ""
+        self.provisional_species = ""
+        self.record = new_sample_record(self.sample)
+        self.peak_disk = 0
+        self.disk_stop = Event()
+        self.disk_sampler: Union[Thread, None] = None
 
     def _check_params(self):
         try:
@@ -57,6 +94,8 @@ class CabgenPipeline:
             self.sample_directory = sample_directory
             self.unicycler_directory = unicycler_directory
             self.checkm_directory = checkm_directory
+            self.assembly_path = path.join(unicycler_directory,
+                                           "assembly.fasta")
 
             dirs_to_create = [sample_directory, unicycler_directory,
                               checkm_directory]
@@ -71,21 +110,60 @@ class CabgenPipeline:
             sys.exit(1)
 
     def _load_programs(self):
-        self.fastqc = getenv("FASTQC") or ""
-        self.abricate = getenv("ABRICATE_PATH") or ""
-        self.mlst = getenv("MLST_PATH") or ""
-        self.polimyxin_db = getenv("POLIMYXIN_DB_PATH") or ""
-        self.outhers_db = getenv("OUTHERS_DB_PATH") or ""
-        self.kraken2 = getenv("KRAKEN2_PATH") or ""
-        self.kraken_db = getenv("KRAKEN_DB_PATH") or ""
-        self.unicycler = getenv("UNICYCLER_PATH") or ""
-        self.fastani = getenv("FASTANI_PATH") or ""
-        self.fastani_db = getenv("FASTANI_DB_PATH") or ""
-        self.spades = getenv("SPADES_PATH") or ""
+        config = self.config
+        self.fastqc = config.fastqc
+        self.abricate = config.abricate
+        self.mlst = config.mlst
+        self.polimyxin_db = config.polimyxin_db
+        self.outhers_db = config.outhers_db
+        self.kraken2 = config.kraken2
+        self.kraken_db = config.kraken_db
+        self.unicycler = config.unicycler
+        self.fastani = config.fastani
+        self.fastani_db = config.fastani_db
+        self.spades = config.spades
+        self.prokka = config.prokka
+        self.checkm = config.checkm
+        self.blastx = config.blastx
+        self.abricate_db = config.abricate_db
+        self.reference_gene_catalog = config.reference_gene_catalog
+        self.mutation_catalog = config.mutation_catalog
+        self.fastqc_output_path = config.fastqc_output_path
+        self.qc_engine = config.qc_engine
+        self.abricate_on_assembly = config.abricate_on_assembly
+        self.assembly_profile = config.assembly_profile
+        self.target_depth = config.target_depth
+        self.fast_assembly_min_depth = config.fast_assembly_min_depth
+        self.subsample_seed = config.subsample_seed
+        self.pigz = config.pigz
         self.loaded_programs = ["abricate", "mlst",
                                 "polimyxin_db", "outhers_db",
                                 "kraken2", "kraken_db", "unicycler",
-                                "fastani", "fastani_db"]
+                                "fastani", "fastani_db", "prokka", "checkm",
+                                "blastx"]
+        self._load_databases()
+
+    def _load_databases(self):
+        # Resolved once per sample, so an activation during the run does not
+        # mix two versions of a database in the same analysis
+        self.database_versions: Dict[str, str] = {}
+        if not self.config.reference_db_root:
+            return
+
+        try:
+            databases = ReferenceDatabases(self.config.reference_db_root)
+            for name in managed_databases:
+                database_path = databases.resolve(name)
+                if database_path:
+                    setattr(self, name, database_path)
+                    self.database_versions[name] = \
+                        databases.current_version(name)
+                    self.logger.info(f"{name} version: "
+                                     f"{self.database_versions[name]}")
+        except Exception as e:
+            self.logger.error(
+                f"Failed to resolve reference databases.\n\n{e}")
+            sys.exit(1)
 
     def _check_programs(self):
         try:
@@ -103,73 +181,235 @@ class CabgenPipeline:
 
     def _run_fastqc(self):
         try:
-            self.logger.info("Running FastQC")
-            fastqc_output_path = getenv("FASTQC_OUTPUT_PATH") or ""
+            fastqc_output_path = self.fastqc_output_path
 
             if not fastqc_output_path:
                 self.logger.error("FastQC output path is not defined in .env.")
                 raise ValueError
 
-            fastqc_line = (f"{self.fastqc} --quiet {self.read1} {self.read2} "
+            if self.qc_engine == "native":
+                try:
+                    self._run_native_qc(fastqc_output_path)
+                    return
+                except Exception as e:
+                    # FastQC is optional with the native engine
+                    if not self.fastqc:
+                        raise RuntimeError(
+                            f"Native QC failed and FastQC is not installed "
+                            f"to fall back to.\n\n{e}")
+                    self.logger.error(
+                        f"Native QC failed, falling back to FastQC.\n\n{e}")
+
+            self.logger.info("Running FastQC")
+            fastqc_line = (f"{self.fastqc} --quiet -t {min(self.threads, 2)} "
+                           f"{self.input_read1} {self.input_read2} "
                            f"--outdir {fastqc_output_path}")
             run_command_line(fastqc_line)
         except Exception as e:
             self.logger.error(f"Failed to run FASTQC.\n\n{e}")
             sys.exit(1)
 
+    def _run_native_qc(self, fastqc_output_path: str):
+        self.logger.info("Running native QC")
+        qc_record = run_native_qc(self.input_read1, self.input_read2,
+                                  fastqc_output_path, self.sample)
+        self.qc_record = qc_record
+
+        query = {"sequenciaId": self.sample}
+        self.mongo_client.save("relatorios", query, {"qc": qc_record})
+
+    def _stage_reads(self):
+        if not self.config.read_staging or self.staging_dir:
+            return
+
+        try:
+            self.logger.info("Decompressing reads")
+            staging_root = self.config.read_staging_path or \
+                self.sample_directory
+            self.staging_dir = path.join(staging_root, f"reads_{self.sample}")
+            self.input_read1, self.input_read2 = stage_reads(
+                [self.read1, self.read2], self.staging_dir, self.pigz,
+                self.threads)
+        except (CommandTimeout, CommandCancelled):
+            raise
+        except Exception as e:
+            self.logger.error(
+                f"Failed to decompress reads, using the compressed files."
+                f"\n\n{e}")
+            self._release_reads()
+
+    def _release_reads(self):
+        if self.staging_dir:
+            rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = ""
+        self.input_read1 = self.read1
+        self.input_read2 = self.read2
+
+    def _prepare_assembly_reads(self):
+        self.assembly_read1 = self.input_read1
+        self.assembly_read2 = self.input_read2
+        self.unicycler_mode = "conservative"
+        self.unicycler_extra_args = ""
+
+        if self.assembly_profile != "fast":
+            return
+
+        try:
+            self.logger.info("Profiling reads for the fast assembly profile")
+            pairs, bases, genome_size = profile_reads(self.input_read1,
+                                                      self.input_read2)
+            self.read_profile = (pairs, bases)
+            query = {"sequenciaId": self.sample}
+
+            if not genome_size:
+                self.logger.info("Genome size could not be estimated, "
+                                 "assembling all reads.")
+                self.mongo_client.save(
+                    "relatorios", query,
+                    {"assembly_profile": "fast",
+                     "subsampling": "Not applied"})
+                return
+
+            read_depth = bases / genome_size
+            assembly_depth = read_depth
+            kept = pairs
+            fraction = self.target_depth / read_depth
+
+            if fraction < 1:
+                self.logger.info(
+                    f"Subsampling {pairs} pairs from {read_depth:.1f}x to "
+                    f"{self.target_depth:.1f}x (fraction {fraction:.3f})")
+                outputs = [path.join(self.sample_directory,
+                                     f"subsampled_R{mate}.fastq.gz")
+                           for mate in (1, 2)]
+                kept = subsample_read_pairs(self.input_read1,
+                                            self.input_read2,
+                                            fraction, outputs,
+                                            self.subsample_seed)
+                assembly_depth = read_depth * kept / pairs
+                self.assembly_read1, self.assembly_read2 = outputs
+
+            if assembly_depth >= self.fast_assembly_min_depth:
+                self.unicycler_mode = "normal"
+                self.unicycler_extra_args = " --no_correct"
+
+            self.logger.info(
+                f"Estimated genome size {genome_size}, read depth "
+                f"{read_depth:.1f}x, assembly depth {assembly_depth:.1f}x, "
+                f"Unicycler mode {self.unicycler_mode}")
+            self.mongo_client.save(
+                "relatorios", query,
+                {"assembly_profile": "fast",
+                 "estimated_genome_size": str(genome_size),
+                 "read_depth": str(round(read_depth, 2)),
+                 "assembly_depth": str(round(assembly_depth, 2)),
+                 "subsampling": f"{kept}/{pairs} pairs "
+                                f"(seed {self.subsample_seed})",
+                 "unicycler_mode": self.unicycler_mode})
+        except (CommandTimeout, CommandCancelled):
+            raise
+        except Exception as e:
+            self.logger.error(
+                f"Failed to prepare assembly reads, assembling all reads."
+                f"\n\n{e}")
+            self.assembly_read1 = self.input_read1
+            self.assembly_read2 = self.input_read2
+            self.unicycler_mode = "conservative"
+            self.unicycler_extra_args = ""
+
     def _run_unicycler(self):
         try:
             self.logger.info("Running Unicycler")
+            unicycler_line = (f"{self.unicycler} -1 {self.assembly_read1} "
+                              f"-2 {self.assembly_read2} "
+                              f"-o {self.unicycler_directory} "
+                              "--min_fasta_length 500 "
+                              f"--mode {self.unicycler_mode} "
+                              f"-t {self.threads}"
+                              f"{self.unicycler_extra_args}")
             if self.spades:
-                unicycler_line = (f"{self.unicycler} -1 {self.read1} "
-                                  f"-2 {self.read2} "
-                                  f"-o {self.unicycler_directory} "
-                                  "--min_fasta_length 500 --mode conservative "
-                                  f"-t {self.threads} "
-                                  f"--spades_path {self.spades}")
-            else:
-                unicycler_line = (f"{self.unicycler} -1 {self.read1} "
-                                  f"-2 {self.read2} "
-                                  f"-o {self.unicycler_directory} "
-                                  "--min_fasta_length 500 --mode conservative "
-                                  f"-t {self.threads}")
+                unicycler_line += f" --spades_path {self.spades}"
             program_output = run_command_line(unicycler_line)
             if program_output:
                 self.logger.info(program_output)
+
+            subsampled_reads = [read for read in (self.assembly_read1,
+                                                  self.assembly_read2)
+                                if read not in (self.input_read1,
+                                                self.input_read2)]
+            delete_folders_and_files(subsampled_reads)
         except Exception as e:
             self.logger.error(f"Failed to run Unicycler.\n\n{e}")
             sys.exit(1)
 
-    def _run_prokka(self):
+    def _run_prokka(self, threads=0):
         try:
-            self.assembly_path = path.join(f"{self.output}",
-                                           "unicycler/assembly.fasta")
             self.logger.info("Run Prokka")
-            prokka_line = (f"prokka --outdir {self.output}/prokka"
+            prokka_line = (f"{self.prokka} --outdir {self.output}/prokka"
                            f" --prefix genome {self.assembly_path} --force "
-                           f"--cpus {self.threads}")
+                           f"--cpus {threads or self.threads}")
             run_command_line(prokka_line)
         except Exception as e:
             self.logger.error(f"Failed to run Prokka.\n\n{e}")
             sys.exit(1)
 
+    def _taxonomy_marker_set(self) -> str:
+        # Marker set of the Kraken2 species, or of its genus, when the call
+        # is confident enough; otherwise CheckM places the genome itself
+        if not getattr(self, "most_common", ""):
+            return ""
+        margin = kraken_margin(self.first_count, self.second_count)
+        if margin < self.config.checkm_min_margin:
+            self.logger.info(f"Kraken2 margin {margin:.2f} is too low for "
+                             "the taxonomy-specific CheckM workflow")
+            return ""
+
+        cache_dir = self.config.checkm_marker_cache or \
+            path.join(self.sample_directory, "checkm_markers")
+        for rank, taxon in checkm_taxa(self.most_common):
+            marker_file = cached_marker_set(self.checkm, cache_dir, rank,
+                                            taxon)
+            if marker_file:
+                self.checkm_markers = f"{rank} {taxon}"
+                return marker_file
+        self.logger.info(f"CheckM has no marker set for "
+                         f"'{self.most_common}'")
+        return ""
+
     def _run_checkm(self):
         try:
             self.logger.info("Run CheckM")
-            checkM_line = ("checkm lineage_wf -x fasta "
-                           f"{self.unicycler_directory} "
-                           f"{self.checkm_directory} --threads {self.threads} "
-                           f"--pplacer_threads 1")
-            checkM_qa_line = ("checkm qa -o 2 "
+            marker_file = self._taxonomy_marker_set() \
+                if self.config.checkm_mode == "taxonomy" else ""
+            if marker_file:
+                self.logger.info(f"Using the CheckM marker set of "
+                                 f"{self.checkm_markers}")
+                checkM_line = (f"{self.checkm} analyze -x fasta "
+                               f"-t {self.threads} {marker_file} "
+                               f"{self.unicycler_directory} "
+                               f"{self.checkm_directory}")
+            else:
+                self.checkm_markers = "lineage"
+                marker_file = f"{self.checkm_directory}/lineage.ms"
+                checkM_line = (f"{self.checkm} lineage_wf -x fasta "
+                               f"{self.unicycler_directory} "
+                               f"{self.checkm_directory} "
+                               f"--threads {self.threads} "
+                               f"--pplacer_threads 1")
+            checkM_qa_line = (f"{self.checkm} qa -o 2 "
                               f"-f {self.checkm_directory}/{self.sample}"
                               "_resultados "
-                              f"--tab_table {self.checkm_directory}/lineage.ms"
+                              f"--tab_table {marker_file}"
                               f" {self.checkm_directory} "
                               f"--threads {self.threads}")
 
             run_command_line(checkM_line)
             run_command_line(checkM_qa_line)
 
+            query = {"sequenciaId": self.sample}
+            self.mongo_client.save("relatorios", query,
+                                   {"checkm_marcadores": self.checkm_markers})
+
             files_to_delete = [path.join(self.checkm_directory, file) for file
                                in listdir(self.checkm_directory)
                                if "resultados" not in file]
@@ -200,6 +440,9 @@ class CabgenPipeline:
                     self.mongo_client.save(
                         "relatorios", query, {"checkm_4": lines[11]})
                     self.contamination = lines[6] or 0
+                    self.record["completeness"] = to_float(lines[5])
+                    self.record["contamination"] = to_float(lines[6])
+                    self.record["genomeSize"] = int(to_float(lines[8]) or 0)
                     self.mongo_client.save(
                         "relatorios", query, {"sample": str(self.sample)})
         except Exception as e:
@@ -240,32 +483,103 @@ class CabgenPipeline:
             self.logger.error(f"Failed to process kraken2 result.\n\n{e}")
             sys.exit(1)
 
-    def _process_species(self):
+    def _preclassify_reads(self):
+        # Provisional species from the first reads while Unicycler runs, so
+        # the reference data of the species is read into memory before the
+        # species-dependent steps; the assembly-based call confirms it
         try:
-            if (re.findall(re.compile(r"\w+\s\w.*", re.I), self.most_common)):
-                check_especies = self.most_common.strip()
-                split_especies = check_especies.split(" ")
-                genus = split_especies[0]
-                species = split_especies[1]
-            else:
-                genus = self.most_common
-                species = ""
+            self.logger.info("Pre-classifying reads with Kraken2")
+            preclassify_dir = path.join(self.sample_directory, "preclassify")
+            makedirs(preclassify_dir, exist_ok=True)
+            outputs = [path.join(preclassify_dir, f"head_R{mate}.fastq")
+                       for mate in (1, 2)]
+            pairs = head_read_pairs(self.input_read1, self.input_read2,
+                                    self.config.preclassification_pairs,
+                                    outputs)
+
+            # Memory-mapped, the database pages are shared with the
+            # assembly classification instead of loaded twice
+            kraken_output = path.join(preclassify_dir, "out_kraken")
+            kraken_line = (f"{self.kraken2} --db {self.kraken_db} "
+                           "--use-names --memory-mapping --paired "
+                           f"--threads 1 --output {kraken_output} "
+                           f"{outputs[0]} {outputs[1]}")
+            run_command_line(kraken_line)
 
-            species_final_result = f"{genus}{species}".lower()
+            names = Counter(read_kraken_names(kraken_output))
+            names.pop("unclassified", None)
+            if not names:
+                self.logger.info("No read pairs were classified.")
+                return
+            name, count = names.most_common(1)[0]
+            self.provisional_species = species_key(name)
+
+            self.mongo_client.save(
+                "relatorios", {"sequenciaId": self.sample},
+                {"especieProvisoria": {"nome": name,
+                                       "fracao": round(count / pairs, 3),
+                                       "pares": pairs,
+                                       "fonte": "reads"}})
+
+            species_info: SpeciesDict = {
+                "species": self.provisional_species,
+                "assembly": self.assembly_path,
+                "sample": self.sample,
+                "poli_db_path": self.polimyxin_db,
+                "others_db_path": self.outhers_db,
+                "fastani_db_path": self.fastani_db,
+                "output_path": self.sample_directory}
+            warmed = warm_page_cache(species_reference_files(
+                species_info, self.provisional_species))
+            self.logger.info(
+                f"Provisional species {name} ({count}/{pairs} pairs), "
+                f"{warmed / 1e6:.0f} MB of reference data prefetched.")
+        except (CommandTimeout, CommandCancelled):
+            raise
+        except Exception as e:
+            self.logger.error(
+                f"Failed to pre-classify reads, the species will come from "
+                f"the assembly only.\n\n{e}")
+
+    def _confirm_provisional_species(self, species_final_result: str):
+        if not self.provisional_species:
+            return
+        confirmed = self.provisional_species == species_final_result
+        if not confirmed:
+            self.logger.info(
+                f"Provisional species {self.provisional_species} not "
+                f"confirmed by the assembly ({species_final_result}).")
+        self.mongo_client.save("relatorios", {"sequenciaId": self.sample},
+                               {"especieProvisoria.confirmada": confirmed})
+
+    def _process_species(self):
+        try:
+            # The same key as the provisional species of the reads
+            genus, species = split_species_name(self.most_common)
+            species_final_result = species_key(self.most_common)
             self.logger.info(f"Final result of the species: "
                              f"{species_final_result}.")
+            self._confirm_provisional_species(species_final_result)
             species_info: SpeciesDict = {"species": species_final_result,
                                          "assembly": self.assembly_path,
                                          "sample": self.sample,
                                          "poli_db_path": self.polimyxin_db,
                                          "others_db_path": self.outhers_db,
                                          "fastani_db_path": self.fastani_db,
-                                         "output_path": self.sample_directory}
+                                         "output_path": self.sample_directory,
+                                         "blastx": self.blastx,
+                                         "mutation_catalog":
+                                         self.mutation_catalog,
+                                         "mutation_exhaustive":
+                                         self.config.mutation_exhaustive,
+                                         "mutation_deferred":
+                                         self.config.mutation_deferred}
 
             blast_result, display_name, mlst_species = \
                 identify_bacteria_species(species_info)
 
             fastani_display_name = ""
+            mutation_species = species_final_result
 
             if not blast_result and (
                 ("enterobactercloacae" in species_final_result or
@@ -293,12 +607,17 @@ class CabgenPipeline:
 
                 blast_result = handle_fastani_species(
                     species_info, fastani_display_name)
+                mutation_species = fastani_display_name
             elif "klebsiellapneumoniae" in species_final_result:
                 fastani_display_name = self._run_fastani(species_info)
 
             if blast_result:
                 self.others_mutations_result = blast_result[0]
                 self.poli_mutations_result = blast_result[1]
+                # Lets the batch reprocessing rebuild the mutation search
+                self.mongo_client.save("relatorios",
+                                       {"sequenciaId": self.sample},
+                                       {"especieMutacoes": mutation_species})
             else:
                 self.others_mutations_result = []
                 self.poli_mutations_result = []
@@ -310,6 +629,12 @@ class CabgenPipeline:
             else:
                 self.display_name = f"{genus.title()} {species}"
 
+            self.record["species"] = self.display_name
+            self.record["speciesKey"] = species_slug(self.display_name)
+            self.record["mutations"], self.record["mutationGenes"] = \
+                parse_mutations(self.others_mutations_result +
+                                self.poli_mutations_result)
+
             if not mlst_species:
                 self.mlst_species = "Não disponível"
             else:
@@ -371,30 +696,35 @@ class CabgenPipeline:
         except Exception as e:
             self.logger.error(f"Failed to save species result.\n\n{e}")
 
-    def _run_abricate(self, db: str):
+    def _run_abricate(self, db: str, input_file="", strict=False):
         try:
+            abricate = self.abricate if not self.abricate_db else \
+                f"{self.abricate} --datadir {self.abricate_db}"
+            input_file = input_file or \
+                f"{self.sample_directory}/prokka/genome.ffn"
+
             if db.lower() == "resfinder":
                 self.logger.info("Run Abricate - ResFinder ")
                 self.abricate_res_out = path.join(
                     self.sample_directory, f"{self.sample}_outAbricateRes")
-                abricate_line = (f"{self.abricate} --db {db} "
-                                 f"{self.sample_directory}/prokka/genome.ffn "
+                abricate_line = (f"{abricate} --db {db} "
+                                 f"{input_file} "
                                  f"> {self.abricate_res_out} "
                                  f"--threads {self.threads}")
             elif db.lower() == "vfdb":
                 self.logger.info("Run Abricate - VFDB ")
                 self.abricate_vfdb_out = path.join(
                     self.sample_directory, f"{self.sample}_outAbricateVFDB")
-                abricate_line = (f"{self.abricate} --db {db} "
-                                 f"{self.sample_directory}/prokka/genome.ffn "
+                abricate_line = (f"{abricate} --db {db} "
+                                 f"{input_file} "
                                  f"> {self.abricate_vfdb_out} "
                                  f"--threads {self.threads}")
             elif db.lower() == "plasmidfinder":
                 self.logger.info("Run Abricate - PlasmidFinder ")
                 self.abricate_plasmid_out = path.join(
                     self.sample_directory, f"{self.sample}_outAbricatePlasmid")
-                abricate_line = (f"{self.abricate} --db {db} "
-                                 f"{self.sample_directory}/prokka/genome.ffn "
+                abricate_line = (f"{abricate} --db {db} "
+                                 f"{input_file} "
                                  f"> {self.abricate_plasmid_out} "
                                  f"--threads {self.threads}")
             else:
@@ -402,16 +732,51 @@ class CabgenPipeline:
 
             self.logger.info(f"{abricate_line}")
             run_command_line(abricate_line)
+        except (CommandTimeout, CommandCancelled):
+            raise
         except Exception as e:
             self.logger.error(
-                f"Failed to run Abricate with resfinder DB.\n\n{e}")
+                f"Failed to run Abricate with {db} DB.\n\n{e}")
+            # The redirection already emptied the output, which would be
+            # processed as no hits
+            if strict:
+                raise
+
+    def _run_contig_abricate(self):
+        abricate_dbs = ["resfinder", "vfdb", "plasmidfinder"]
+        for db in abricate_dbs:
+            self._run_abricate(db, self.assembly_path)
+
+        # These reports do not name the annotated feature, so they are final
+        # before Prokka finishes
+        self._process_abricate_result("resfinder")
+        self._process_abricate_result("plasmidfinder")
+
+    def _map_abricate_features(self):
+        try:
+            self.logger.info("Mapping Abricate hits to Prokka features")
+            gff_file = path.join(self.sample_directory, "prokka",
+                                 "genome.gff")
+            features = parse_prokka_gff(gff_file)
+            for abricate_out in (self.abricate_res_out,
+                                 self.abricate_vfdb_out,
+                                 self.abricate_plasmid_out):
+                map_abricate_hits_to_features(abricate_out, features)
+        except Exception as e:
+            self.logger.error(
+                f"Failed to map Abricate hits to features.\n\n{e}")
+
+        self._process_abricate_result("vfdb")
 
     def _process_resfinder_result(self):
         try:
             abricate_result = get_abricate_result(
                 self.abricate_res_out)
-            gene_results, blast_out_results = process_resfinder(
-                abricate_result)
+            gene_results, blast_out_results, resistance_classes = \
+                process_resfinder(abricate_result,
+                                  self.reference_gene_catalog)
+            self.record["resistanceGenes"] = abricate_genes(abricate_result)
+            self.record["resistanceClasses"] = resistance_classes
 
             query = {"sequenciaId": self.sample}
             if not gene_results:
@@ -433,6 +798,7 @@ class CabgenPipeline:
                 self.abricate_vfdb_out)
 
             query = {"sequenciaId": self.sample}
+            self.record["virulenceGenes"] = abricate_genes(abricate_result)
             if abricate_result:
                 blast_out_results = process_vfdb(abricate_result)
                 self.mongo_client.save(
@@ -451,6 +817,7 @@ class CabgenPipeline:
                 self.abricate_plasmid_out)
 
             query = {"sequenciaId": self.sample}
+            self.record["plasmids"] = abricate_genes(abricate_result)
             if abricate_result:
                 blast_out_results = process_plasmidfinder(abricate_result)
                 self.mongo_client.save("relatorios", query, {"plasmid":
@@ -486,6 +853,8 @@ class CabgenPipeline:
                          f"{self.assembly_path} > {self.mlst_result_path}")
 
             run_command_line(mlst_line)
+        except (CommandTimeout, CommandCancelled):
+            raise
         except Exception as e:
             self.logger.error(f"Failed to run MLST.\n\n{e}")
 
@@ -496,6 +865,9 @@ class CabgenPipeline:
                 out_mlst = line.split(",")
                 scheme_mlst = out_mlst[1]
                 st = out_mlst[2]
+                self.record["mlstScheme"] = scheme_mlst
+                self.record["st"] = st if st != "-" else \
+                    "new" if scheme_mlst != "-" else ""
 
                 query = {"sequenciaId": self.sample}
                 if st != "-":
@@ -523,37 +895,38 @@ class CabgenPipeline:
         except Exception as e:
             self.logger.error(f"Failed to process MLST result.\n\n{e}")
 
+    def _read_totals(self) -> Tuple[float, float]:
+        # Native QC already counted the reads, otherwise a single pass over
+        # each mate, on the staged copy when there is one
+        qc_files = (getattr(self, "qc_record", None) or {}).get("files", [])
+        if len(qc_files) == 2 and qc_files[0]["total_sequences"]:
+            reads_sum = sum(file["total_sequences"] for file in qc_files)
+            return float(reads_sum), \
+                qc_files[0]["total_bases"] / qc_files[0]["total_sequences"]
+
+        totals = []
+        awk_line = ("awk 'NR%4==2 {count++; bases += length} "
+                    "END {print count+0, bases+0}'")
+        for read in (self.input_read1, self.input_read2):
+            catcmd = "zcat" if is_gzipped(read) else "cat"
+            res = run_command_line(f"{catcmd} {read} | {awk_line}")
+            count, bases = res.split()
+            totals.append((float(count), float(bases)))
+
+        reads_sum = totals[0][0] + totals[1][0]
+        return reads_sum, totals[0][1] / totals[0][0]
+
     def _run_coverage(self):
         try:
             self.logger.info("Run coverage")
-            catcmd = "cat"
-            res = run_command_line(f"file {self.read1}")
-            if res and (str(res).find("gzip compressed") > -1 or
-                        str(res).find("gzip compatible") > -1):
-                catcmd = "zcat"
-
-            zcat = f"echo $({catcmd} {self.read1} | wc -l)/4 | bc"
-            res_r1 = run_command_line(zcat)
-            n_reads1 = res_r1.rstrip("\n")
-
-            zcat2 = f"echo $({catcmd} {self.read2} | wc -l)/4 | bc"
-            res_r2 = run_command_line(zcat2)
-            n_reads2 = res_r2.rstrip("\n")
-
-            reads_sum = (float(n_reads1) + float(n_reads2))
-
-            cat_line = f"{catcmd} {self.read1}"
-            awk_line = ("awk '{{if(NR%4==2) {{count++; bases += length}} }} "
-                        "END {{print bases/count}}'")
-            zcat3 = f"{cat_line} | {awk_line}"
-
-            res_avg = run_command_line(zcat3)
-            average_length = res_avg.rstrip("\n")
+            reads_sum, average_length = self._read_totals()
+            self.read_count = int(reads_sum)
 
             pre_coverage = (float(average_length) *
                             reads_sum) / float(self.genome_size)
 
             coverage = round(pre_coverage, 2)
+            self.record["coverage"] = coverage
             query = {"sequenciaId": self.sample}
             self.mongo_client.save(
                 "relatorios", query, {"coverage": str(coverage)})
@@ -564,7 +937,7 @@ class CabgenPipeline:
     def _copy_assembly_file(self):
         try:
             source = self.assembly_path
-            dest = path.join(fastqc_output_path, f"{self.sample}.fasta")
+            dest = path.join(self.fastqc_output_path, f"{self.sample}.fasta")
 
             copy(source, dest)
         except Exception as e:
@@ -573,7 +946,7 @@ class CabgenPipeline:
 
     def _run_only_fastqc(self):
         try:
-            self._run_fastqc()
+            self._run_stage("fastqc", self._run_fastqc)
             query = {"_id": self.sample}
             bson = {"$currentDate": {"ultimaActualizacao": True},
                     "$set": {"estado": "QUAL", "ultimaTarefa": ""}}
@@ -583,52 +956,324 @@ class CabgenPipeline:
                 f"Failed to run CABGen only FastQC pipeline.\n\n{e}")
             sys.exit(1)
 
+    @staticmethod
+    def _cpu_seconds() -> float:
+        # Tools and the pipeline itself; a stage running alongside another
+        # one (Prokka) shares its CPU time with it
+        return sum(usage.ru_utime + usage.ru_stime
+                   for usage in (getrusage(RUSAGE_CHILDREN),
+                                 getrusage(RUSAGE_SELF)))
+
+    def _run_stage(self, name: str, stage, *args):
+        check_interrupted()
+        start = time()
+        start_cpu = self._cpu_seconds()
+        if self.progress:
+            self.progress.start_stage(name)
+        # The deadline bounds the external tools; it is per thread since
+        # Prokka may run alongside the main stages
+        set_command_deadline(self.config.timeout_of(name))
+        try:
+            with span(name, "stage"):
+                result = stage(*args)
+            # A killed tool whose stage goes on with partial results must
+            # still end the task as timed out
+            check_interrupted()
+            return result
+        finally:
+            set_command_deadline(0)
+            self.stage_durations[name] = \
+                self.stage_durations.get(name, 0.) + time() - start
+            self.stage_cpu[name] = self.stage_cpu.get(name, 0.) + \
+                self._cpu_seconds() - start_cpu
+            if self.progress:
+                self.progress.finish_stage(name)
+
+    def _mark_final(self, *fields: str):
+        if self.progress:
+            self.progress.mark_final(list(fields))
+
+    def _check_read_gate(self):
+        if not (self.config.gate_min_read_pairs or self.config.gate_min_bases):
+            return
+
+        if self.read_profile:
+            pairs, bases = self.read_profile
+        else:
+            reads_sum, average_length = self._read_totals()
+            pairs, bases = reads_sum / 2, reads_sum * average_length
+        check_minimum("read_pairs", pairs, self.config.gate_min_read_pairs)
+        check_minimum("bases", bases, self.config.gate_min_bases)
+
+    def _check_assembly_gate(self):
+        if not (self.config.gate_min_assembly_size or
+                self.config.gate_max_assembly_size or
+                self.config.gate_min_n50):
+            return
+
+        size, n50, contigs = assembly_stats(self.assembly_path)
+        self.logger.info(f"Assembly: {size} bp in {contigs} contigs, "
+                         f"N50 {n50}")
+        check_minimum("assembly_size", size,
+                      self.config.gate_min_assembly_size)
+        check_maximum("assembly_size", size,
+                      self.config.gate_max_assembly_size)
+        check_minimum("n50", n50, self.config.gate_min_n50)
+
+    def _run_classification(self, preclassification):
+        # The taxonomy-specific CheckM workflow needs the Kraken2 call
+        kraken_first = self.config.checkm_mode == "taxonomy"
+        if not kraken_first:
+            self._classify_checkm()
+        if preclassification:
+            preclassification.result()
+        self._run_stage("kraken2", self._run_kraken2)
+        self._run_stage("kraken2", self._process_kraken2_result)
+        check_minimum("kraken_margin",
+                      kraken_margin(self.first_count, self.second_count),
+                      self.config.gate_min_kraken_margin)
+        if kraken_first:
+            self._classify_checkm()
+
+    def _classify_checkm(self):
+        self._run_stage("checkm", self._run_checkm)
+        self._run_stage("checkm", self._process_checkm_result)
+        self._mark_final("checkm_1", "checkm_2", "checkm_3", "checkm_4")
+        check_maximum("contamination", float(self.contamination),
+                      self.config.gate_max_contamination)
+        check_minimum("completeness", self.record["completeness"],
+                      self.config.gate_min_completeness)
+
+    def _stop_at_gate(self, gate: QualityGateFailed):
+        # The sample is reported as failing the gate instead of going
+        # through annotation, resistance and typing
+        self.logger.info(f"Sample failed a quality gate: {gate}")
+        query = {"sequenciaId": self.sample}
+        self.mongo_client.save("relatorios", query,
+                               {"statusAnalise": "reprovada",
+                                "portaoQualidade": gate.report()})
+        self.record["qualityGate"] = gate.gate
+
+        query = {"_id": self.sample}
+        bson = {"$currentDate": {"ultimaActualizacao": True},
+                "$set": {"ultimaTarefa": "",
+                         "resultadoExecucao": "reprovada_qualidade"}}
+        self.mongo_client.save("sequencias", query, bson)
+
     def _run_only_genomic(self):
+        background = ThreadPoolExecutor(max_workers=2)
         try:
-            self._run_unicycler()
-            self._run_prokka()
-            self._run_checkm()
-            self._process_checkm_result()
-            self._run_kraken2()
-            self._process_kraken2_result()
-            self._process_species()
-            self._save_species_result()
-            abricate_dbs = ["resfinder", "vfdb", "plasmidfinder"]
-            for db in abricate_dbs:
-                self._run_abricate(db)
-                self._process_abricate_result(db)
-            self._run_mlst()
-            self._process_mlst()
-            self._run_coverage()
-            self._copy_assembly_file()
+            self._run_stage("stage_reads", self._stage_reads)
+            self._run_stage("assembly_reads", self._prepare_assembly_reads)
+            self._check_read_gate()
+            preclassification = background.submit(
+                self._run_stage, "preclassify", self._preclassify_reads) \
+                if self.config.read_preclassification else None
+            self._run_stage("unicycler", self._run_unicycler)
+            self._check_assembly_gate()
+            # With a CheckM or Kraken2 gate both run first, so a failing
+            # sample skips Prokka and Abricate
+            gated = self.config.classification_gated()
+            if gated:
+                self._run_classification(preclassification)
+            if self.abricate_on_assembly:
+                # Prokka and the stages run meanwhile split the threads of
+                # the worker slot instead of each taking all of them
+                prokka_threads = max(self.config.threads // 2, 1)
+                prokka = background.submit(self._run_stage, "prokka",
+                                           self._run_prokka, prokka_threads)
+                self.threads = max(self.config.threads - prokka_threads, 1)
+                self._run_stage("abricate", self._run_contig_abricate)
+                self._mark_final("gene", "resfinder", "plasmid")
+            else:
+                self._run_stage("prokka", self._run_prokka)
+            if not gated:
+                self._run_classification(preclassification)
+            self._run_stage("species", self._process_species)
+            self._run_stage("species", self._save_species_result)
+            self._mark_final("especie")
+            self._run_stage("mlst", self._run_mlst)
+            self._run_stage("mlst", self._process_mlst)
+            self._mark_final("mlst", "mutacoes_poli", "mutacoes_outras")
+            if self.abricate_on_assembly:
+                prokka.result()
+                self.threads = self.config.threads
+                self._run_stage("abricate", self._map_abricate_features)
+                self._mark_final("VFDB")
+            else:
+                abricate_dbs = ["resfinder", "vfdb", "plasmidfinder"]
+                for db in abricate_dbs:
+                    self._run_stage("abricate", self._run_abricate, db)
+                    self._run_stage("abricate",
+                                    self._process_abricate_result, db)
+                self._mark_final("gene", "resfinder", "VFDB", "plasmid")
+            background.shutdown()
+            self._run_stage("coverage", self._run_coverage)
+            self._mark_final("coverage")
+            self._run_stage("copy_assembly", self._copy_assembly_file)
 
             query = {"_id": self.sample}
             bson = {"$currentDate": {"ultimaActualizacao": True},
                     "$set": {"estado": "ENSA", "ultimaTarefa": "",
                              "arquivofasta": f"{self.sample}.fasta"}}
             self.mongo_client.save("sequencias", query, bson)
+        except QualityGateFailed as gate:
+            self._stop_at_gate(gate)
         except Exception as e:
             self.logger.error(
                 f"Failed to run CABGen only genomic pipeline.\n\n{e}")
             sys.exit(1)
+        finally:
+            # Prokka or the preclassification may still be running on the
+            # staged reads, which are removed once the run ends
+            background.shutdown(wait=True, cancel_futures=True)
 
     def _run_complete(self):
         try:
-            self._run_fastqc()
+            self._run_stage("stage_reads", self._stage_reads)
+            self._run_stage("fastqc", self._run_fastqc)
             self._run_only_genomic()
         except Exception as e:
             self.logger.error(
                 f"Failed to run CABGen complete pipeline.\n\n{e}")
             sys.exit(1)
 
+    def _start_progress(self, lane: str):
+        try:
+            stage_estimates = RuntimePredictor.from_mongo(
+                limit=200, lane=lane,
+                handler=self.mongo_client).stage_estimates(lane)
+        except Exception as e:
+            self.logger.error(f"Failed to load stage estimates.\n\n{e}")
+            stage_estimates = {}
+
+        skipped = [] if self.config.read_preclassification \
+            else ["preclassify"]
+        self.progress = ProgressReporter(
+            self.mongo_client, self.sample, lane, stage_estimates,
+            self.config.progress_min_interval, skipped)
+        self.progress.flush(force=True)
+
+    def _close_progress(self):
+        # Also on failure, so a deferred flush does not fire once the Mongo
+        # client of the task is closed
+        if self.progress:
+            self.progress.close()
+
+    def _sample_disk(self, interval=30.):
+        # Peak footprint of the sample directory, kept in the run history to
+        # size the disk reservation of the next tasks
+        while True:
+            try:
+                self.peak_disk = max(self.peak_disk,
+                                     directory_size(self.output))
+            except Exception as e:
+                self.logger.error(f"Failed to measure disk usage.\n\n{e}")
+            if self.disk_stop.is_set():
+                return
+            self.disk_stop.wait(interval)
+
+    def _stop_disk_sampler(self):
+        # A sampler left running would keep walking the directory of a
+        # finished task for as long as its process lives
+        self.disk_stop.set()
+        if self.disk_sampler:
+            self.disk_sampler.join()
+            self.disk_sampler = None
+
+    def _save_sample_record(self):
+        # Typed copy of the report, read by the cohort exporter
+        try:
+            self.record["databaseVersions"] = self.database_versions
+            self.record["finishedAt"] = datetime.now(timezone.utc)
+            report = {"registro": self.record}
+            # Written once the analysis succeeded, so the reanalysis takes a
+            # failed or partial run as stale
+            if self.database_versions:
+                report["versoesBancos"] = self.database_versions
+            self.mongo_client.save("relatorios", {"sequenciaId": self.sample},
+                                   report)
+        except Exception as e:
+            self.logger.error(f"Failed to save sample record.\n\n{e}")
+
+    def _save_run_history(self, lane: str, runtime: float):
+        try:
+            if self.read_count is None and getattr(self, "qc_record", None):
+                self.read_count = sum(file["total_sequences"]
+                                      for file in self.qc_record["files"])
+
+            history = {"sequenciaId": self.sample,
+                       "lane": lane,
+                       "species": self.display_name,
+                       "threads": self.threads,
+                       "tool_versions": self.config.tool_versions,
+                       "database_versions": self.database_versions,
+                       "features": read_features(self.read1, self.read2,
+                                                 self.read_count),
+                       "stages": self.stage_durations,
+                       "stage_cpu": self.stage_cpu,
+                       "runtime": runtime,
+                       # The worker process runs this task only
+                       "peak_memory_mb":
+                       getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024,
+                       "peak_disk_mb": self.peak_disk / 1e6,
+                       "finishedAt": datetime.now(timezone.utc)}
+            self.mongo_client.save(
+                "historico_execucoes",
+                {"sequenciaId": self.sample, "lane": lane}, history)
+        except Exception as e:
+            self.logger.error(f"Failed to save run history.\n\n{e}")
+
+    def reanalyze(self, stages: List[str]) -> SampleRecord:
+        """
+        Reruns Abricate stages of a finished sample with the current
+        reference databases, on its stored Prokka genes or, when they were
+        cleaned up, its stored assembly. Only the report fields of those
+        stages are written.
+
+        Args:
+            stages (List[str]): Abricate databases to rerun, e.g. "vfdb".
+
+        Returns:
+            SampleRecord: The record fields the stages produced.
+
+        Raises:
+            RuntimeError: An Abricate run failed, so none of the stages
+            counts as reanalysed.
+        """
+        self._load_programs()
+        self.sample_directory = self.output
+        makedirs(self.sample_directory, exist_ok=True)
+        self.assembly_path = path.join(self.fastqc_output_path,
+                                       f"{self.sample}.fasta")
+        if not path.isfile(self.assembly_path):
+            raise FileNotFoundError(
+                f"Assembly of {self.sample} not found.")
+
+        annotation = path.join(self.sample_directory, "prokka", "genome.ffn")
+        input_file = annotation if path.isfile(annotation) \
+            else self.assembly_path
+        self.record = {}
+        for db in ("resfinder", "vfdb", "plasmidfinder"):
+            if db in stages:
+                self._run_stage("abricate", self._run_abricate, db,
+                                input_file, True)
+                self._process_abricate_result(db)
+        return self.record
+
     def run(self, only_fastqc=False, only_genomic=False, complete=False):
         try:
             start_time = time()
             # Starting the pipeline dependencies
             self._check_params()
-            self._create_dirs()
             self._load_programs()
             self._check_programs()
+            self._create_dirs()
+            lane = "fastqc" if only_fastqc else \
+                "genomic" if only_genomic else "complete"
+            self._start_progress(lane)
+            self.disk_sampler = Thread(target=self._sample_disk, daemon=True)
+            self.disk_sampler.start()
 
             # Starting pipeline run
             if only_fastqc:
@@ -641,15 +1286,32 @@ class CabgenPipeline:
                 self.logger.error("Invalid pipeline choice!")
                 raise ValueError
 
-            # Sending finish email
-            subject = f"Análise {self.sample}"
-            send_email(self.recipient_email, subject,
-                       "analysisFinish.template")
+            if lane != "fastqc":
+                self._save_sample_record()
+
+            # Queueing finish email, delivered by the notification sender
+            try:
+                if not self.recipient_email:
+                    raise ValueError("The task has no recipient.")
+                subject = f"Análise {self.sample}"
+                queue_email(self.config, self.recipient_email, subject,
+                            "analysisFinish.template", self.sample)
+            except Exception as e:
+                self.logger.error(f"Failed to queue finish e-mail.\n\n{e}")
+
+            self._stop_disk_sampler()
+            self._save_run_history(lane, time() - start_time)
+            self._close_progress()
 
             self.mongo_client.close()
             runtime = format_time(time() - start_time)
             self.logger.info(f"Total runtime: {runtime}")
         except Exception as e:
+            self._close_progress()
             self.mongo_client.close()
             self.logger.error(f"Failed to run CABGen pipeline.\n\n{e}")
             sys.exit(1)
+        finally:
+            self._close_progress()
+            self._stop_disk_sampler()
+            self._release_reads()
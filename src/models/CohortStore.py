@@ -0,0 +1,397 @@
+import os
+import numpy as np
+from os import path
+from time import time
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple, Union
+from src.types.SampleRecord import SampleRecord
+
+scalar_columns = {"sample": np.int64,
+                  "finishedAt": "datetime64[s]",
+                  "species": np.str_,
+                  "speciesKey": np.str_,
+                  "st": np.str_,
+                  "mlstScheme": np.str_,
+                  "completeness": np.float64,
+                  "contamination": np.float64,
+                  "coverage": np.float64,
+                  "genomeSize": np.int64}
+list_columns = ["resistanceGenes", "resistanceClasses", "virulenceGenes",
+                "plasmids", "mutations", "mutationGenes"]
+
+# Parts of a partition merged into one when it grows past this count
+max_parts = 16
+
+
+class ListColumn:
+    """
+    Multi-valued column stored as the concatenated values and the offset
+    of each row, so membership tests run on a single array.
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        self.values = values
+        self.offsets = offsets
+        self.rows = np.repeat(np.arange(len(offsets) - 1),
+                              np.diff(offsets))
+
+    @classmethod
+    def from_lists(cls, lists: List[List[str]]) -> "ListColumn":
+        lengths = [len(items) for items in lists]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        values = np.array([item for items in lists for item in items],
+                          dtype=np.str_)
+        return cls(values, offsets)
+
+    def take(self, rows: np.ndarray) -> "ListColumn":
+        lengths = np.diff(self.offsets)[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        index = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + \
+            np.arange(offsets[-1])
+        return ListColumn(self.values[index], offsets)
+
+    def contains(self, targets: List[str], count: int) -> np.ndarray:
+        hits = np.zeros(count, dtype=bool)
+        hits[self.rows[np.isin(self.values, targets)]] = True
+        return hits
+
+    def row(self, row: int) -> List[str]:
+        return self.values[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+
+class CohortFrame:
+    """
+    Columns of the latest record of every sample of the loaded partitions,
+    with vectorized filters and prevalence counts.
+    """
+
+    def __init__(self, scalars: Dict[str, np.ndarray],
+                 lists: Dict[str, ListColumn]):
+        self.scalars = scalars
+        self.lists = lists
+        self.scalars["month"] = \
+            scalars["finishedAt"].astype("datetime64[M]").astype(np.str_)
+
+    def __len__(self) -> int:
+        return len(self.scalars["sample"])
+
+    def mask(self, **filters) -> np.ndarray:
+        """
+        Selects the samples matching every filter. Scalar columns match any
+        of the given values, list columns match samples having any of them,
+        e.g. mask(st="258", mutationGenes="PmrB").
+
+        Returns:
+            np.ndarray: Boolean mask over the samples.
+        """
+        selected = np.ones(len(self), dtype=bool)
+        for column, wanted in filters.items():
+            if wanted is None:
+                continue
+            wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+            if column in self.lists:
+                selected &= self.lists[column].contains(wanted, len(self))
+            elif column in self.scalars:
+                selected &= np.isin(self.scalars[column],
+                                    np.array(wanted, dtype=np.str_)
+                                    if self.scalars[column].dtype.kind == "U"
+                                    else wanted)
+            else:
+                raise ValueError(f"Unknown column {column}.")
+        return selected
+
+    def take(self, rows: np.ndarray) -> "CohortFrame":
+        return CohortFrame({column: values[rows]
+                            for column, values in self.scalars.items()
+                            if column != "month"},
+                           {column: values.take(rows)
+                            for column, values in self.lists.items()})
+
+    def samples(self, **filters) -> List[int]:
+        return self.scalars["sample"][self.mask(**filters)].tolist()
+
+    def prevalence(self, column: str, by="", **filters) -> Dict[
+            Tuple[str, str], Tuple[int, int, float]]:
+        """
+        Counts how many of the selected samples carry each value of a list
+        column, optionally per group of a scalar column.
+
+        Args:
+            column (str): List column, e.g. "resistanceGenes".
+            by (str): Scalar column to group by, e.g. "st" or "month".
+            filters: Filters of mask.
+
+        Returns:
+            Dict[Tuple[str, str], Tuple[int, int, float]]: (group, value) to
+            samples carrying it, samples in the group and their fraction.
+        """
+        selected = self.mask(**filters)
+        groups = self.scalars[by].astype(np.str_) if by else \
+            np.full(len(self), "", dtype=np.str_)
+        group_names, row_groups = np.unique(groups, return_inverse=True)
+        totals = np.bincount(row_groups[selected],
+                             minlength=len(group_names))
+
+        values = self.lists[column]
+        keep = selected[values.rows]
+        value_names, value_index = np.unique(values.values[keep],
+                                             return_inverse=True)
+        if not len(value_names):
+            return {}
+
+        # A value repeated in a sample counts once
+        pairs = np.unique(values.rows[keep] * len(value_names) +
+                          value_index)
+        pair_groups = row_groups[pairs // len(value_names)]
+        counts = np.bincount(pair_groups * len(value_names) +
+                             pairs % len(value_names),
+                             minlength=len(group_names) * len(value_names))
+        counts = counts.reshape(len(group_names), len(value_names))
+
+        result = {}
+        for group, value in zip(*np.nonzero(counts)):
+            count = int(counts[group, value])
+            total = int(totals[group])
+            result[(str(group_names[group]), str(value_names[value]))] = \
+                (count, total, count / total)
+        return result
+
+    def record(self, row: int) -> dict:
+        record = {column: values[row].item()
+                  for column, values in self.scalars.items()}
+        record.update({column: values.row(row)
+                       for column, values in self.lists.items()})
+        return record
+
+
+class CohortStore:
+    """
+    Columnar dataset of the sample records, partitioned as
+    <root>/species=<speciesKey>/month=<YYYY-MM>/part-*.npz. Each export
+    appends new parts; a reanalysed sample is superseded by its latest
+    record when the partitions are loaded.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.cache: Dict[tuple, Tuple[tuple, CohortFrame]] = {}
+
+    @staticmethod
+    def partition_of(record: SampleRecord) -> Tuple[str, str]:
+        finished = record.get("finishedAt") or datetime.now(timezone.utc)
+        return record.get("speciesKey") or "unknown", \
+            f"{finished:%Y-%m}"
+
+    def _partition_dir(self, species: str, month: str) -> str:
+        return path.join(self.root, f"species={species}", f"month={month}")
+
+    def append(self, records: List[SampleRecord]) -> List[str]:
+        """
+        Appends records to their partitions.
+
+        Returns:
+            List[str]: The part files written.
+        """
+        partitions: Dict[Tuple[str, str], List[SampleRecord]] = {}
+        for record in records:
+            partitions.setdefault(self.partition_of(record), []) \
+                .append(record)
+
+        written = []
+        for (species, month), partition_records in partitions.items():
+            partition_dir = self._partition_dir(species, month)
+            os.makedirs(partition_dir, exist_ok=True)
+            part_file = path.join(partition_dir,
+                                  f"part-{time():.6f}-{os.getpid()}.npz")
+            write_part(part_file, columns_of(partition_records))
+            written.append(part_file)
+
+            parts = part_files(partition_dir)
+            if len(parts) > max_parts:
+                self.compact(species, month)
+        return written
+
+    def compact(self, species: str, month: str):
+        """
+        Merges the parts of a partition, keeping the latest record of each
+        sample.
+        """
+        partition_dir = self._partition_dir(species, month)
+        parts = part_files(partition_dir)
+        frame = load_frame(parts)
+        columns = {column: frame.scalars[column] for column in scalar_columns}
+        for column in list_columns:
+            columns[f"{column}.values"] = frame.lists[column].values
+            columns[f"{column}.offsets"] = frame.lists[column].offsets
+
+        write_part(path.join(partition_dir,
+                             f"part-{time():.6f}-{os.getpid()}.npz"),
+                   columns)
+        for part in parts:
+            os.remove(part)
+
+    def partitions(self, species: Union[List[str], None] = None,
+                   months: Union[List[str], None] = None) -> List[str]:
+        if not path.isdir(self.root):
+            return []
+        directories = []
+        for species_dir in sorted(os.listdir(self.root)):
+            if not species_dir.startswith("species=") or \
+                    (species and species_dir[8:] not in species):
+                continue
+            species_path = path.join(self.root, species_dir)
+            for month_dir in sorted(os.listdir(species_path)):
+                if month_dir.startswith("month=") and \
+                        (not months or month_dir[6:] in months):
+                    directories.append(path.join(species_path, month_dir))
+        return directories
+
+    def load(self, species: Union[List[str], None] = None,
+             months: Union[List[str], None] = None) -> CohortFrame:
+        """
+        Loads the latest record of the samples whose latest record is in
+        the given species and months (all by default). A sample reanalysed
+        in a later month, or under another species, is left out rather
+        than returned with its superseded record. Frames are cached until
+        a part file changes.
+        """
+        selected = self.partitions(species, months)
+        parts = [part for partition in selected
+                 for part in part_files(partition)]
+        other_parts = [part for partition in self.partitions()
+                       if partition not in selected
+                       for part in part_files(partition)] \
+            if species or months else []
+        key = (tuple(species or []), tuple(months or []))
+        signature = tuple((part, path.getmtime(part))
+                          for part in parts + other_parts)
+
+        cached = self.cache.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        frame = load_frame(parts)
+        if other_parts:
+            frame = drop_superseded(frame, other_parts)
+        self.cache[key] = (signature, frame)
+        return frame
+
+
+def part_files(partition_dir: str) -> List[str]:
+    return sorted(path.join(partition_dir, name)
+                  for name in os.listdir(partition_dir)
+                  if name.startswith("part-") and name.endswith(".npz"))
+
+
+def columns_of(records: List[SampleRecord]) -> Dict[str, np.ndarray]:
+    columns: Dict[str, np.ndarray] = {}
+    for column, dtype in scalar_columns.items():
+        values = [record.get(column) for record in records]
+        if column == "finishedAt":
+            values = [np.datetime64(value.replace(tzinfo=None), "s")
+                      if value else np.datetime64("NaT")
+                      for value in values]
+        elif dtype is np.str_:
+            values = [str(value or "") for value in values]
+        elif dtype is np.float64:
+            values = [float("nan") if value is None else float(value)
+                      for value in values]
+        else:
+            values = [int(value or 0) for value in values]
+        columns[column] = np.array(values, dtype=dtype)
+
+    for column in list_columns:
+        values = ListColumn.from_lists([list(record.get(column) or [])
+                                        for record in records])
+        columns[f"{column}.values"] = values.values
+        columns[f"{column}.offsets"] = values.offsets
+    return columns
+
+
+def write_part(part_file: str, columns: Dict[str, np.ndarray]):
+    temporary = f"{part_file}.tmp"
+    with open(temporary, "wb") as outfile:
+        np.savez(outfile, **columns)
+    os.replace(temporary, part_file)
+
+
+def drop_superseded(frame: CohortFrame, parts: List[str]) -> CohortFrame:
+    """
+    Removes the samples that have a newer record in other part files,
+    reading only their sample and finishedAt columns.
+    """
+    samples = []
+    finished = []
+    for part in parts:
+        with np.load(part, allow_pickle=False) as data:
+            samples.append(data["sample"])
+            finished.append(data["finishedAt"])
+    if not samples:
+        return frame
+    samples_array = np.concatenate(samples)
+    finished_array = np.concatenate(finished)
+
+    # Newest record elsewhere of each sample
+    order = np.lexsort((-finished_array.astype(np.int64), samples_array))
+    other_samples, first = np.unique(samples_array[order],
+                                     return_index=True)
+    other_finished = finished_array[order][first]
+
+    index = np.minimum(np.searchsorted(other_samples,
+                                       frame.scalars["sample"]),
+                       max(len(other_samples) - 1, 0))
+    superseded = (other_samples[index] == frame.scalars["sample"]) & \
+        (other_finished[index] > frame.scalars["finishedAt"])
+    if not superseded.any():
+        return frame
+    return frame.take(np.flatnonzero(~superseded))
+
+
+def load_frame(parts: List[str]) -> CohortFrame:
+    """
+    Concatenates part files and keeps the latest record of each sample.
+    """
+    scalars: Dict[str, List[np.ndarray]] = {column: []
+                                            for column in scalar_columns}
+    values: Dict[str, List[np.ndarray]] = {column: []
+                                           for column in list_columns}
+    offsets: Dict[str, List[np.ndarray]] = {column: []
+                                            for column in list_columns}
+    for part in parts:
+        with np.load(part, allow_pickle=False) as data:
+            for column in scalar_columns:
+                scalars[column].append(data[column])
+            for column in list_columns:
+                base = sum(len(chunk) for chunk in values[column])
+                values[column].append(data[f"{column}.values"])
+                column_offsets = data[f"{column}.offsets"] + base
+                offsets[column].append(column_offsets if not
+                                       offsets[column] else
+                                       column_offsets[1:])
+
+    if not parts:
+        empty = columns_of([])
+        return CohortFrame(
+            {column: empty[column] for column in scalar_columns},
+            {column: ListColumn(empty[f"{column}.values"],
+                                empty[f"{column}.offsets"])
+             for column in list_columns})
+
+    merged = {column: np.concatenate(chunks)
+              for column, chunks in scalars.items()}
+    lists = {column: ListColumn(np.concatenate(values[column]),
+                                np.concatenate(offsets[column]))
+             for column in list_columns}
+
+    # Latest record of each sample: sort newest first, keep the first seen
+    order = np.lexsort((-merged["finishedAt"].astype(np.int64),
+                        merged["sample"]))
+    _, first = np.unique(merged["sample"][order], return_index=True)
+    rows = np.sort(order[first])
+
+    return CohortFrame({column: values[rows]
+                        for column, values in merged.items()},
+                       {column: column_values.take(rows)
+                        for column, column_values in lists.items()})
@@ -0,0 +1,94 @@
+from os import path
+from shutil import disk_usage
+from typing import Dict, List, Tuple
+from src.utils.handle_folders import directory_size
+from src.utils.handle_metrics import Metric
+
+
+class DiskBudget:
+    """
+    Admission control over the volume of the sample outputs. Each admitted
+    task reserves its predicted peak footprint; the part of a reservation
+    not yet written counts against the free space, so a task is only
+    admitted when it fits next to what the running ones still need, keeping
+    headroom_mb free on top. The volume is measured once per dispatch round
+    by measure(), as walking the running outputs is not cheap.
+    """
+
+    def __init__(self, volume: str, headroom_mb: float = 0):
+        self.volume = volume
+        self.headroom = int(headroom_mb * 1e6)
+        self.reservations: Dict[int, Tuple[int, str]] = {}
+        # Free bytes and bytes each task has still to write, as measured
+        self.free_bytes = 0
+        self.remaining: Dict[int, int] = {}
+
+    @staticmethod
+    def footprint_of(task: dict) -> int:
+        return int(float(task.get("predicted_disk") or 0) * 1e6)
+
+    def output_of(self, task: dict) -> str:
+        return path.join(self.volume, f"output_{task['_id']}")
+
+    def measure(self):
+        """
+        Reads the free space of the volume and how much of its reservation
+        each running task has written.
+        """
+        self.free_bytes = disk_usage(self.volume).free
+        self.remaining = {
+            task_id: max(footprint - directory_size(output), 0)
+            for task_id, (footprint, output) in self.reservations.items()}
+
+    def reserved(self) -> int:
+        """
+        Returns the bytes the running tasks are still expected to write.
+        """
+        return sum(self.remaining.values())
+
+    def available(self) -> int:
+        return self.free_bytes - self.reserved() - self.headroom
+
+    def fits(self, task: dict) -> bool:
+        return self.footprint_of(task) <= self.available()
+
+    def reserve(self, task: dict):
+        footprint = self.footprint_of(task)
+        self.reservations[task["_id"]] = (footprint, self.output_of(task))
+        self.remaining[task["_id"]] = footprint
+
+    def release(self, task: dict):
+        self.reservations.pop(task["_id"], None)
+        self.remaining.pop(task["_id"], None)
+
+    def metrics(self, deferred: Dict[str, int]) -> List[Metric]:
+        """
+        Builds the disk metrics exported by the scheduler, as of the last
+        measure().
+
+        Args:
+            deferred (Dict[str, int]): Queued tasks waiting for disk space
+            in each lane.
+
+        Returns:
+            List[Metric]: Metrics in the format of handle_metrics.
+        """
+        reserved = self.reserved()
+        return [("cabgen_disk_free_bytes", {}, self.free_bytes),
+                ("cabgen_disk_reserved_bytes", {}, reserved),
+                ("cabgen_disk_headroom_bytes", {},
+                 self.free_bytes - reserved - self.headroom),
+                *[("cabgen_disk_deferred_tasks", {"lane": lane}, count)
+                  for lane, count in deferred.items()]]
+
+
+disk_descriptions = {
+    "cabgen_disk_free_bytes": "Free space on the sample output volume.",
+    "cabgen_disk_reserved_bytes":
+    "Space the running tasks are still expected to write.",
+    "cabgen_disk_headroom_bytes":
+    "Free space left for new tasks after reservations and the safety "
+    "margin.",
+    "cabgen_disk_deferred_tasks":
+    "Queued tasks that would fit their user's share but not the disk."
+}
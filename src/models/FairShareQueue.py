@@ -0,0 +1,191 @@
+from datetime import datetime, timezone
+from collections import Counter
+from typing import Callable, Dict, List, Set, Union
+
+default_runtime = 3600.
+
+
+class FairShareQueue:
+    """
+    Dispatch queue shared by the submitting users (criadoPor). Tasks with a
+    higher prioridade always go first. Within a priority level, the next task
+    comes from the user with the least weighted work dispatched so far
+    (weighted fair queuing over the predicted runtimes), skipping users that
+    reached their concurrency cap. Each user's tasks are sorted by
+    prioridade, then kept in arrival order (the dispatch policy's within a
+    fetch). Tasks fetched while the queue drains join it with add().
+    """
+
+    def __init__(self, tasks: List[dict], default_cap=0,
+                 running: Union[Counter, None] = None):
+        self.default_cap = default_cap
+        self.running: Dict[str, int] = dict(running or {})
+        self.queues: Dict[str, List[dict]] = {}
+        self.weights: Dict[str, float] = {}
+        self.caps: Dict[str, int] = {}
+        self.virtual_time: Dict[str, float] = {}
+        self.add(tasks)
+
+    @staticmethod
+    def user_of(task: dict) -> str:
+        return str(task.get("criadoPor") or "")
+
+    @staticmethod
+    def priority_of(task: dict) -> int:
+        return int(task.get("prioridade") or 0)
+
+    def add(self, tasks: List[dict]):
+        """
+        Queues tasks behind the ones of the same priority already queued.
+        A user with nothing queued starts from the least served active user
+        rather than from the share it left unused, so returning after an
+        idle time does not let it monopolize the slots.
+        """
+        floor = min((self.virtual_time[user] for user in self.queues
+                     if self.queues[user]), default=0.)
+        added: Set[str] = set()
+        for task in tasks:
+            user = self.user_of(task)
+            if not self.queues.get(user):
+                added.add(user)
+            self.queues.setdefault(user, []).append(task)
+            self.weights[user] = float(task.get("peso") or 1.)
+            self.caps[user] = int(task.get("maxConcorrencia") or
+                                  self.default_cap)
+
+        for user in added:
+            if user in self.virtual_time:
+                self.virtual_time[user] = max(self.virtual_time[user], floor)
+            else:
+                # Work already running elsewhere counts against the share
+                self.virtual_time[user] = floor + \
+                    self.running.get(user, 0) * default_runtime / \
+                    self.weights[user]
+        for user in {self.user_of(task) for task in tasks}:
+            # Stable, so arrival order is kept within a priority
+            self.queues[user].sort(key=lambda task: -self.priority_of(task))
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _eligible(self, user: str) -> bool:
+        cap = self.caps.get(user, self.default_cap)
+        return bool(self.queues[user]) and \
+            (not cap or self.running.get(user, 0) < cap)
+
+    def next_task(self, fits: Union[Callable[[dict], bool], None] = None
+                  ) -> Union[dict, None]:
+        """
+        Pops the next task to dispatch.
+
+        Args:
+            fits (Callable[[dict], bool]): Admission check of a task, e.g.
+            DiskBudget.fits. A user whose next task does not fit is passed
+            over for the following user, keeping the task queued.
+
+        Returns:
+            Union[dict, None]: The task, or None when every queued task
+            belongs to a user at its concurrency cap or does not fit.
+        """
+        users = sorted((user for user in self.queues
+                        if self._eligible(user)),
+                       key=lambda user: (
+                           -self.priority_of(self.queues[user][0]),
+                           self.virtual_time[user],
+                           self.running.get(user, 0)))
+        user = next((user for user in users
+                     if fits is None or fits(self.queues[user][0])), None)
+        if user is None:
+            return None
+
+        task = self.queues[user].pop(0)
+        self.virtual_time[user] += \
+            float(task.get("predicted_runtime") or default_runtime) / \
+            self.weights[user]
+        self.running[user] = self.running.get(user, 0) + 1
+        return task
+
+    def blocked(self, lane="") -> int:
+        """
+        Counts the queued tasks of users below their concurrency cap, the
+        ones held back by the admission check rather than by the caps.
+
+        Args:
+            lane (str): Counts only the tasks of this lane.
+        """
+        return sum(len(lane_tasks(self.queues[user], lane))
+                   for user in self.queues if self._eligible(user))
+
+    def task_finished(self, task: dict):
+        user = self.user_of(task)
+        self.running[user] = max(self.running.get(user, 0) - 1, 0)
+
+    def planned_order(self) -> List[dict]:
+        """
+        Returns the order in which the queued tasks would be dispatched if
+        the caps were never reached, without changing the queue.
+        """
+        plan = FairShareQueue([])
+        plan.queues = {user: list(queue)
+                       for user, queue in self.queues.items()}
+        plan.weights = dict(self.weights)
+        plan.virtual_time = dict(self.virtual_time)
+
+        order = []
+        task = plan.next_task()
+        while task is not None:
+            order.append(task)
+            task = plan.next_task()
+        return order
+
+    def starvation_metrics(self, lane: str) -> List[tuple]:
+        """
+        Builds the per-user queue metrics exported by the scheduler. The
+        running tasks of a user are counted over all lanes, the concurrency
+        cap applies to all of them.
+
+        Args:
+            lane (str): Pipeline lane of the queued tasks.
+
+        Returns:
+            List[tuple]: Metrics in the format of handle_metrics.
+        """
+        now = datetime.now(timezone.utc)
+        metrics = []
+        for user in set(self.queues) | set(self.running):
+            labels = {"user": user, "lane": lane}
+            queue = lane_tasks(self.queues.get(user, []), lane)
+            waits = [(now - enqueued_at(task, now)).total_seconds()
+                     for task in queue]
+            metrics.append(("cabgen_queued_tasks", labels, len(queue)))
+            metrics.append(("cabgen_running_tasks", labels,
+                            self.running.get(user, 0)))
+            metrics.append(("cabgen_oldest_wait_seconds", labels,
+                            round(max(waits, default=0.))))
+            metrics.append(("cabgen_weighted_share", labels,
+                            self.weights.get(user, 1.)))
+        return metrics
+
+
+def lane_tasks(tasks: List[dict], lane: str) -> List[dict]:
+    if not lane:
+        return tasks
+    return [task for task in tasks if task.get("lane", lane) == lane]
+
+
+def enqueued_at(task: dict, default: datetime) -> datetime:
+    enqueued = task.get("enfileiradoEm")
+    if not isinstance(enqueued, datetime):
+        return default
+    if enqueued.tzinfo is None:
+        enqueued = enqueued.replace(tzinfo=timezone.utc)
+    return enqueued
+
+
+starvation_descriptions = {
+    "cabgen_queued_tasks": "Tasks waiting for a worker per user.",
+    "cabgen_running_tasks": "Tasks running per user, in all lanes.",
+    "cabgen_oldest_wait_seconds":
+    "Queue time of the oldest waiting task per user.",
+    "cabgen_weighted_share": "Fair-share weight of the user."
+}
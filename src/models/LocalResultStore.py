@@ -0,0 +1,412 @@
+import os
+import json
+import fcntl
+import sqlite3
+import threading
+from os import path
+from uuid import uuid4
+from copy import deepcopy
+from contextlib import contextmanager
+from urllib.parse import quote
+from datetime import datetime, timezone
+from typing import Any, Iterator, List, Tuple, Union
+
+missing = object()
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Stored as naive UTC, like Mongo
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return {"$date": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def decode_object(document: dict) -> Any:
+    if len(document) == 1 and "$date" in document:
+        return datetime.fromisoformat(document["$date"])
+    return document
+
+
+def dumps(document: dict) -> str:
+    return json.dumps(document, default=encode_value)
+
+
+def loads(body: str) -> dict:
+    return json.loads(body, object_hook=decode_object)
+
+
+def get_field(document: dict, field: str) -> Any:
+    value: Any = document
+    for part in field.split("."):
+        if isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else missing
+        elif isinstance(value, dict):
+            value = value.get(part, missing)
+        else:
+            return missing
+        if value is missing:
+            return missing
+    return value
+
+
+def set_field(document: dict, field: str, value: Any):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unset_field(document: dict, field: str):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def comparable(left: Any, right: Any) -> bool:
+    try:
+        left < right
+        return True
+    except TypeError:
+        return False
+
+
+def value_matches(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and \
+            all(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$exists":
+                if (value is not missing) != bool(operand):
+                    return False
+            elif operator == "$in":
+                if not any(value_matches(value, item) for item in operand):
+                    return False
+            elif operator == "$nin":
+                if any(value_matches(value, item) for item in operand):
+                    return False
+            elif operator == "$ne":
+                if value_matches(value, operand):
+                    return False
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is missing or value is None or \
+                        not comparable(value, operand):
+                    return False
+                if operator == "$gt" and not value > operand or \
+                        operator == "$gte" and not value >= operand or \
+                        operator == "$lt" and not value < operand or \
+                        operator == "$lte" and not value <= operand:
+                    return False
+            else:
+                raise ValueError(f"Query operator {operator} is not "
+                                 "supported by the local result store.")
+        return True
+
+    if value is missing:
+        return condition is None
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def matches(document: dict, query: Union[dict, None]) -> bool:
+    """
+    Tells whether a document matches a Mongo query, for the operators the
+    pipeline uses.
+    """
+    for field, condition in (query or {}).items():
+        if field == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif not value_matches(get_field(document, field), condition):
+            return False
+    return True
+
+
+def apply_update(document: dict, bson: dict):
+    for operator, fields in bson.items():
+        for field, value in fields.items():
+            if operator == "$set":
+                set_field(document, field, deepcopy(value))
+            elif operator == "$unset":
+                unset_field(document, field)
+            elif operator == "$inc":
+                current = get_field(document, field)
+                set_field(document, field,
+                          (0 if current is missing else current) + value)
+            elif operator == "$currentDate":
+                # Naive UTC, as pymongo returns the dates
+                set_field(document, field,
+                          datetime.now(timezone.utc).replace(tzinfo=None))
+            else:
+                raise ValueError(f"Update operator {operator} is not "
+                                 "supported by the local result store.")
+
+
+def project_document(document: dict, projection: dict) -> dict:
+    values = {value for field, value in projection.items() if field != "_id"}
+    if values - {0, 1, True, False}:
+        raise ValueError("Only inclusion and exclusion projections are "
+                         "supported by the local result store.")
+    if values and all(values):
+        projected: dict = {}
+        if projection.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        for field in projection:
+            value = get_field(document, field)
+            if field != "_id" and value is not missing:
+                set_field(projected, field, deepcopy(value))
+        return projected
+
+    projected = deepcopy(document)
+    for field, value in projection.items():
+        if not value:
+            unset_field(projected, field)
+    return projected
+
+
+def sort_key(value: Any) -> Tuple[int, Any]:
+    if value is missing or value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value.replace(tzinfo=None))
+    return (4, str(value))
+
+
+def document_key(query: dict) -> str:
+    """
+    Storage key of the document a query of plain equalities addresses, e.g.
+    {"sequenciaId": 7}, so saves of a sample do not scan the collection.
+    """
+    if not query or any(field.startswith("$") or isinstance(value, dict)
+                        for field, value in query.items()):
+        return ""
+    return "&".join(f"{field}={dumps(query[field])}"
+                    for field in sorted(query))
+
+
+class LocalResultStore:
+    """
+    Result backend with the interface of MongoHandler for machines with no
+    database access. Documents are kept as JSON and queries are evaluated in
+    the process, which supports the operators the pipeline uses ($set,
+    $unset, $inc, $currentDate; $in, $exists, $ne, $gt/$lt, $or). The
+    storage is given by the subclasses.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def _transaction(self, collection_name: str) -> Iterator[None]:
+        yield
+
+    def _get(self, collection_name: str, key: str) -> Union[dict, None]:
+        raise NotImplementedError
+
+    def _documents(self, collection_name: str) -> List[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    def _put(self, collection_name: str, key: str, document: dict):
+        raise NotImplementedError
+
+    def _matching(self, collection_name: str, query: dict
+                  ) -> List[Tuple[str, dict]]:
+        key = document_key(query)
+        if key:
+            document = self._get(collection_name, key)
+            if document is not None and matches(document, query):
+                return [(key, document)]
+        return [(key, document) for key, document
+                in self._documents(collection_name)
+                if matches(document, query)]
+
+    def search(self, collection_name: str, match=None, lookup=None,
+               project=None, sort=None, limit=None):
+        if lookup:
+            raise ValueError("$lookup is not supported by the local result "
+                             "store.")
+        with self.lock:
+            results = [document for _, document
+                       in self._matching(collection_name, match or {})]
+
+        for field, direction in reversed(list((sort or {}).items())):
+            results.sort(key=lambda document: sort_key(
+                get_field(document, field)), reverse=direction < 0)
+        if limit:
+            results = results[:limit]
+        if project:
+            results = [project_document(document, project)
+                       for document in results]
+        return results
+
+    def save(self, collection_name: str, query: dict, bson: dict):
+        try:
+            if "$set" not in bson:
+                bson = {"$set": bson}
+
+            with self.lock, self._transaction(collection_name):
+                found = self._matching(collection_name, query)
+                if found:
+                    key, document = found[0]
+                else:
+                    key = document_key(query) or uuid4().hex
+                    document = {field: deepcopy(value)
+                                for field, value in query.items()
+                                if not field.startswith("$") and
+                                not isinstance(value, dict)}
+                    document.setdefault("_id", key)
+                apply_update(document, bson)
+                self._put(collection_name, key, document)
+        except Exception as error:
+            raise Exception(f"Could not update document.\n\n{error}")
+
+    def find_and_update(self, collection_name: str, query: dict,
+                        bson: dict):
+        try:
+            with self.lock, self._transaction(collection_name):
+                found = self._matching(collection_name, query)
+                if not found:
+                    return None
+                key, document = found[0]
+                apply_update(document, bson)
+                self._put(collection_name, key, document)
+                return document
+        except Exception as error:
+            raise Exception(f"Could not find and update document.\n\n"
+                            f"{error}")
+
+    def update_many(self, collection_name: str, query: dict, bson: dict):
+        try:
+            with self.lock, self._transaction(collection_name):
+                found = self._matching(collection_name, query)
+                for key, document in found:
+                    apply_update(document, bson)
+                    self._put(collection_name, key, document)
+                return len(found)
+        except Exception as error:
+            raise Exception(f"Could not update documents.\n\n{error}")
+
+    def close(self):
+        pass
+
+
+class SqliteResultStore(LocalResultStore):
+    """
+    Documents in one SQLite file, shared by the worker processes.
+    """
+
+    def __init__(self, database_path: str):
+        super().__init__()
+        self.database_path = database_path
+        self.connection = sqlite3.connect(database_path, timeout=60,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "collection TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "PRIMARY KEY (collection, key))")
+
+    @contextmanager
+    def _transaction(self, collection_name: str) -> Iterator[None]:
+        # Taken before reading, so read-modify-write is atomic across
+        # processes
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _get(self, collection_name: str, key: str) -> Union[dict, None]:
+        row = self.connection.execute(
+            "SELECT body FROM documents WHERE collection = ? AND key = ?",
+            (collection_name, key)).fetchone()
+        return loads(row[0]) if row else None
+
+    def _documents(self, collection_name: str) -> List[Tuple[str, dict]]:
+        rows = self.connection.execute(
+            "SELECT key, body FROM documents WHERE collection = ? "
+            "ORDER BY rowid", (collection_name,)).fetchall()
+        return [(key, loads(body)) for key, body in rows]
+
+    def _put(self, collection_name: str, key: str, document: dict):
+        self.connection.execute(
+            "INSERT INTO documents (collection, key, body) VALUES (?, ?, ?) "
+            "ON CONFLICT (collection, key) DO UPDATE SET body = "
+            "excluded.body", (collection_name, key, dumps(document)))
+
+    def close(self):
+        self.connection.close()
+
+
+class FileResultStore(LocalResultStore):
+    """
+    One JSON file per document, <root>/<collection>/<key>.json, readable
+    without any tool. Writes of a collection are serialized with a lock
+    file, so several worker processes can share the directory.
+    """
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _collection_dir(self, collection_name: str) -> str:
+        collection_dir = path.join(self.root, collection_name)
+        os.makedirs(collection_dir, exist_ok=True)
+        return collection_dir
+
+    def _document_file(self, collection_name: str, key: str) -> str:
+        return path.join(self._collection_dir(collection_name),
+                         f"{quote(key, safe='=&')}.json")
+
+    @contextmanager
+    def _transaction(self, collection_name: str) -> Iterator[None]:
+        with open(path.join(self.root, f"{collection_name}.lock"),
+                  "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get(self, collection_name: str, key: str) -> Union[dict, None]:
+        document_file = self._document_file(collection_name, key)
+        if not path.isfile(document_file):
+            return None
+        with open(document_file) as infile:
+            document = loads(infile.read())
+        document.pop("_key", None)
+        return document
+
+    def _documents(self, collection_name: str) -> List[Tuple[str, dict]]:
+        collection_dir = self._collection_dir(collection_name)
+        documents = []
+        for name in sorted(os.listdir(collection_dir)):
+            if not name.endswith(".json"):
+                continue
+            with open(path.join(collection_dir, name)) as infile:
+                document = loads(infile.read())
+            documents.append((document.pop("_key"), document))
+        return documents
+
+    def _put(self, collection_name: str, key: str, document: dict):
+        document_file = self._document_file(collection_name, key)
+        with open(f"{document_file}.tmp", "w") as outfile:
+            outfile.write(dumps({**document, "_key": key}))
+        os.replace(f"{document_file}.tmp", document_file)
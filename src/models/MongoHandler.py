@@ -1,4 +1,6 @@
-from pymongo import MongoClient
+from typing import List, Tuple
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from src.utils.handle_trace import span
 
 
 class MongoHandler:
@@ -10,20 +12,27 @@ class MongoHandler:
         self.db = self.client[self.db_name]
 
     def search(self, collection_name: str, match=None, lookup=None,
-               project=None):
+               project=None, sort=None, limit=None):
         collection = self.db[collection_name]
         pipeline = []
 
         if match:
             pipeline.append({"$match": match})
 
+        if sort:
+            pipeline.append({"$sort": sort})
+
+        if limit:
+            pipeline.append({"$limit": limit})
+
         if lookup:
             pipeline.append({"$lookup": lookup})
 
         if project:
             pipeline.append({"$project": project})
 
-        results = [res for res in collection.aggregate(pipeline)]
+        with span("search", "mongo", collection=collection_name):
+            results = [res for res in collection.aggregate(pipeline)]
         return results
 
     def save(self, collection_name: str, query: dict, bson: dict):
@@ -33,9 +42,42 @@ class MongoHandler:
             if "$set" not in bson:
                 bson = {"$set": bson}
 
-            collection.update_one(query, bson, upsert=True)
+            with span("save", "mongo", collection=collection_name):
+                collection.update_one(query, bson, upsert=True)
         except Exception as error:
             raise Exception(f"Could not update document.\n\n{error}")
 
+    def find_and_update(self, collection_name: str, query: dict,
+                        bson: dict):
+        try:
+            collection = self.db[collection_name]
+            with span("find_and_update", "mongo",
+                      collection=collection_name):
+                return collection.find_one_and_update(
+                    query, bson, return_document=ReturnDocument.AFTER)
+        except Exception as error:
+            raise Exception(f"Could not find and update document.\n\n"
+                            f"{error}")
+
+    def update_many(self, collection_name: str, query: dict, bson: dict):
+        try:
+            collection = self.db[collection_name]
+            with span("update_many", "mongo", collection=collection_name):
+                return collection.update_many(query, bson).modified_count
+        except Exception as error:
+            raise Exception(f"Could not update documents.\n\n{error}")
+
+    def bulk_upsert(self, collection_name: str,
+                    operations: List[Tuple[dict, dict]]) -> int:
+        # Errors are raised as they come, so the caller can tell a rejected
+        # update from a lost connection
+        collection = self.db[collection_name]
+        with span("bulk_upsert", "mongo", collection=collection_name,
+                  operations=len(operations)):
+            result = collection.bulk_write(
+                [UpdateOne(query, bson, upsert=True)
+                 for query, bson in operations], ordered=True)
+        return result.upserted_count + result.modified_count
+
     def close(self):
         self.client.close()
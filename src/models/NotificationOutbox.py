@@ -0,0 +1,72 @@
+import sqlite3
+from time import time
+from typing import List
+
+
+class NotificationOutbox:
+    def __init__(self, database_path="outbox.sqlite3"):
+        self.database_path = database_path
+        self.connection = sqlite3.connect(self.database_path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS notifications ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "recipient TEXT NOT NULL, "
+            "subject TEXT NOT NULL, "
+            "template TEXT NOT NULL, "
+            "sample INTEGER, "
+            "status TEXT NOT NULL DEFAULT 'pending', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "next_attempt_at REAL NOT NULL, "
+            "last_error TEXT)")
+        self.connection.commit()
+
+    def enqueue(self, recipient: str, subject: str, template: str,
+                sample=None):
+        try:
+            now = time()
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO notifications (recipient, subject, "
+                    "template, sample, created_at, next_attempt_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (recipient, subject, template, sample, now, now))
+        except Exception as error:
+            raise Exception(f"Could not enqueue notification.\n\n{error}")
+
+    def pending(self, now=None) -> List[sqlite3.Row]:
+        now = now or time()
+        cursor = self.connection.execute(
+            "SELECT * FROM notifications WHERE status = 'pending' "
+            "AND next_attempt_at <= ? ORDER BY recipient, created_at",
+            (now,))
+        return cursor.fetchall()
+
+    def oldest_pending(self, recipient: str) -> float:
+        cursor = self.connection.execute(
+            "SELECT MIN(created_at) FROM notifications "
+            "WHERE status = 'pending' AND recipient = ?", (recipient,))
+        return cursor.fetchone()[0] or time()
+
+    def mark_sent(self, ids: List[int]):
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE notifications SET status = 'sent', "
+                "attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                [(notification_id,) for notification_id in ids])
+
+    def mark_failed(self, ids: List[int], error: str, retry_delay: float,
+                    max_attempts: int):
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE notifications SET attempts = attempts + 1, "
+                "last_error = ?, next_attempt_at = ?, "
+                "status = CASE WHEN attempts + 1 >= ? THEN 'failed' "
+                "ELSE 'pending' END WHERE id = ?",
+                [(error, time() + retry_delay, max_attempts,
+                  notification_id) for notification_id in ids])
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,275 @@
+from os import getenv, path
+from typing import Dict
+from dotenv import load_dotenv
+from dataclasses import dataclass, field, fields
+
+default_reference_gene_catalog = ("/cabgen/sequences_database/"
+                                  "lista_ncbi_ReferenceGeneCatalog160725.txt")
+
+
+def env_str(name: str, default="") -> str:
+    return getenv(name) or default
+
+
+def env_int(name: str, default: int) -> int:
+    return int(getenv(name) or default)
+
+
+def env_float(name: str, default: float) -> float:
+    return float(getenv(name) or default)
+
+
+def env_bool(name: str, default=False) -> bool:
+    value = getenv(name)
+    if not value:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def env_seconds_map(name: str) -> Dict[str, float]:
+    """
+    Parses "name=seconds" pairs separated by commas, e.g.
+    "unicycler=14400,checkm=7200".
+    """
+    values = {}
+    for item in (getenv(name) or "").split(","):
+        key, _, seconds = item.strip().partition("=")
+        if key:
+            values[key.strip()] = float(seconds)
+    return values
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """
+    Typed snapshot of the pipeline configuration. It is loaded once by the
+    scheduler, validated by the preflight and handed to the workers, so no
+    module reads the environment on its own.
+    """
+    # Paths
+    uploaded_sequences_path: str = ""
+    fastqc_output_path: str = ""
+    log_path: str = ""
+    log_json_path: str = ""
+    metrics_path: str = ""
+    cohort_path: str = ""
+    cohort_export_overlap: float = 86400
+    trace_path: str = ""
+    workload_path: str = ""
+    result_backend: str = "mongo"
+    result_path: str = ""
+    result_journal_path: str = ""
+
+    # Scheduler
+    threads: int = 3
+    workers: int = 2
+    worker_id: str = ""
+    lease_seconds: int = 600
+    dispatch_policy: str = "fifo"
+    user_max_concurrency: int = 0
+    dispatch_refill_seconds: float = 60
+    progress_min_interval: float = 30
+    # Seconds a stage may run, zero for no limit; STAGE_TIMEOUTS sets it
+    # per stage
+    stage_timeout: float = 0
+    stage_timeouts: Dict[str, float] = field(default_factory=dict)
+    cancel_poll_seconds: float = 15
+    disk_headroom_mb: float = 10000
+    journal_batch_size: int = 500
+    journal_flush_seconds: float = 60
+
+    # Executables
+    fastqc: str = ""
+    abricate: str = ""
+    mlst: str = ""
+    kraken2: str = ""
+    unicycler: str = ""
+    fastani: str = ""
+    spades: str = ""
+    prokka: str = "prokka"
+    checkm: str = "checkm"
+    blastx: str = "blastx"
+    makeblastdb: str = "makeblastdb"
+    pigz: str = "pigz"
+
+    # Databases
+    polimyxin_db: str = ""
+    outhers_db: str = ""
+    kraken_db: str = ""
+    fastani_db: str = ""
+    abricate_db: str = ""
+    reference_gene_catalog: str = default_reference_gene_catalog
+    reference_db_root: str = ""
+    mutation_catalog: str = ""
+
+    # Pipeline options
+    qc_engine: str = "fastqc"
+    abricate_on_assembly: bool = False
+    assembly_profile: str = "default"
+    target_depth: float = 100
+    fast_assembly_min_depth: float = 40
+    subsample_seed: int = 11
+    read_staging: bool = True
+    read_staging_path: str = ""
+    read_preclassification: bool = False
+    preclassification_pairs: int = 100000
+    mutation_exhaustive: bool = True
+    mutation_batch_size: int = 50
+    reanalysis_batch_size: int = 500
+    mutation_deferred: bool = False
+    checkm_mode: str = "lineage"
+    checkm_marker_cache: str = ""
+    checkm_min_margin: float = 0.8
+
+    # Quality gates, zero disables a gate
+    gate_min_read_pairs: int = 0
+    gate_min_bases: float = 0
+    gate_min_assembly_size: int = 0
+    gate_max_assembly_size: int = 0
+    gate_min_n50: int = 0
+    gate_max_contamination: float = 0
+    gate_min_completeness: float = 0
+    gate_min_kraken_margin: float = 0
+
+    # Notifications
+    sender_email: str = ""
+    template_email_path: str = ""
+    notification_outbox_path: str = "outbox.sqlite3"
+    smtp_host: str = "localhost"
+    smtp_port: int = 25
+    smtp_user: str = ""
+    smtp_password: str = field(default="", repr=False)
+    smtp_timeout: float = 30
+    notification_rate_limit: int = 20
+    notification_max_attempts: int = 5
+    notification_digest_window: float = 300
+    notification_retry_delay: float = 60
+
+    # Filled by the preflight
+    tool_versions: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_env(cls, dotenv_path=None) -> "PipelineConfig":
+        load_dotenv(dotenv_path)
+        return cls(
+            uploaded_sequences_path=env_str("UPLOADED_SEQUENCES_PATH"),
+            fastqc_output_path=env_str("FASTQC_OUTPUT_PATH"),
+            log_path=env_str("LOG_PATH"),
+            log_json_path=env_str("LOG_JSON_PATH"),
+            metrics_path=env_str("METRICS_PATH"),
+            cohort_path=env_str("COHORT_PATH"),
+            cohort_export_overlap=env_float("COHORT_EXPORT_OVERLAP", 86400),
+            trace_path=env_str("TRACE_PATH"),
+            workload_path=env_str("WORKLOAD_PATH"),
+            result_backend=env_str("RESULT_BACKEND", "mongo"),
+            result_path=env_str("RESULT_PATH"),
+            result_journal_path=env_str("RESULT_JOURNAL_PATH"),
+            threads=env_int("THREADS", 3),
+            workers=env_int("WORKERS", 2),
+            worker_id=env_str("WORKER_ID"),
+            lease_seconds=env_int("LEASE_SECONDS", 600),
+            dispatch_policy=env_str("DISPATCH_POLICY", "fifo"),
+            user_max_concurrency=env_int("USER_MAX_CONCURRENCY", 0),
+            dispatch_refill_seconds=env_float("DISPATCH_REFILL_SECONDS", 60),
+            progress_min_interval=env_float("PROGRESS_MIN_INTERVAL", 30),
+            stage_timeout=env_float("STAGE_TIMEOUT", 0),
+            stage_timeouts=env_seconds_map("STAGE_TIMEOUTS"),
+            cancel_poll_seconds=env_float("CANCEL_POLL_SECONDS", 15),
+            disk_headroom_mb=env_float("DISK_HEADROOM_MB", 10000),
+            journal_batch_size=env_int("JOURNAL_BATCH_SIZE", 500),
+            journal_flush_seconds=env_float("JOURNAL_FLUSH_SECONDS", 60),
+            fastqc=env_str("FASTQC"),
+            abricate=env_str("ABRICATE_PATH"),
+            mlst=env_str("MLST_PATH"),
+            kraken2=env_str("KRAKEN2_PATH"),
+            unicycler=env_str("UNICYCLER_PATH"),
+            fastani=env_str("FASTANI_PATH"),
+            spades=env_str("SPADES_PATH"),
+            prokka=env_str("PROKKA_PATH", "prokka"),
+            checkm=env_str("CHECKM_PATH", "checkm"),
+            blastx=env_str("BLASTX_PATH", "blastx"),
+            makeblastdb=env_str("MAKEBLASTDB_PATH", "makeblastdb"),
+            pigz=env_str("PIGZ_PATH", "pigz"),
+            polimyxin_db=env_str("POLIMYXIN_DB_PATH"),
+            outhers_db=env_str("OUTHERS_DB_PATH"),
+            kraken_db=env_str("KRAKEN_DB_PATH"),
+            fastani_db=env_str("FASTANI_DB_PATH"),
+            abricate_db=env_str("ABRICATE_DB_PATH"),
+            reference_gene_catalog=env_str("REFERENCE_GENE_CATALOG",
+                                           default_reference_gene_catalog),
+            reference_db_root=env_str("REFERENCE_DB_ROOT"),
+            mutation_catalog=env_str("MUTATION_CATALOG"),
+            qc_engine=env_str("QC_ENGINE", "fastqc"),
+            abricate_on_assembly=env_bool("ABRICATE_ON_ASSEMBLY"),
+            assembly_profile=env_str("ASSEMBLY_PROFILE", "default"),
+            target_depth=env_float("ASSEMBLY_TARGET_DEPTH", 100),
+            fast_assembly_min_depth=env_float("FAST_ASSEMBLY_MIN_DEPTH", 40),
+            subsample_seed=env_int("SUBSAMPLE_SEED", 11),
+            read_staging=env_bool("READ_STAGING", True),
+            read_staging_path=env_str("READ_STAGING_PATH"),
+            read_preclassification=env_bool("READ_PRECLASSIFICATION"),
+            preclassification_pairs=env_int("PRECLASSIFICATION_PAIRS",
+                                            100000),
+            mutation_exhaustive=env_bool("MUTATION_EXHAUSTIVE", True),
+            mutation_batch_size=env_int("MUTATION_BATCH_SIZE", 50),
+            reanalysis_batch_size=env_int("REANALYSIS_BATCH_SIZE", 500),
+            mutation_deferred=env_bool("MUTATION_DEFERRED"),
+            checkm_mode=env_str("CHECKM_MODE", "lineage"),
+            checkm_marker_cache=env_str("CHECKM_MARKER_CACHE"),
+            checkm_min_margin=env_float("CHECKM_TAXONOMY_MIN_MARGIN", 0.8),
+            gate_min_read_pairs=env_int("GATE_MIN_READ_PAIRS", 0),
+            gate_min_bases=env_float("GATE_MIN_BASES", 0),
+            gate_min_assembly_size=env_int("GATE_MIN_ASSEMBLY_SIZE", 0),
+            gate_max_assembly_size=env_int("GATE_MAX_ASSEMBLY_SIZE", 0),
+            gate_min_n50=env_int("GATE_MIN_N50", 0),
+            gate_max_contamination=env_float("GATE_MAX_CONTAMINATION", 0),
+            gate_min_completeness=env_float("GATE_MIN_COMPLETENESS", 0),
+            gate_min_kraken_margin=env_float("GATE_MIN_KRAKEN_MARGIN", 0),
+            sender_email=env_str("SENDER_EMAIL"),
+            template_email_path=env_str("TEMPLATE_EMAIL_PATH"),
+            notification_outbox_path=env_str("NOTIFICATION_OUTBOX_PATH",
+                                             "outbox.sqlite3"),
+            smtp_host=env_str("SMTP_HOST", "localhost"),
+            smtp_port=env_int("SMTP_PORT", 25),
+            smtp_user=env_str("SMTP_USER"),
+            smtp_password=env_str("SMTP_PASSWORD"),
+            smtp_timeout=env_float("SMTP_TIMEOUT", 30),
+            notification_rate_limit=env_int("NOTIFICATION_RATE_LIMIT", 20),
+            notification_max_attempts=env_int("NOTIFICATION_MAX_ATTEMPTS",
+                                              5),
+            notification_digest_window=env_float(
+                "NOTIFICATION_DIGEST_WINDOW", 300),
+            notification_retry_delay=env_float("NOTIFICATION_RETRY_DELAY",
+                                               60))
+
+    def timeout_of(self, stage: str) -> float:
+        """
+        Returns the seconds the external commands of a stage may run, zero
+        meaning no limit.
+        """
+        return self.stage_timeouts.get(stage, self.stage_timeout)
+
+    def classification_gated(self) -> bool:
+        """
+        Whether a CheckM or Kraken2 gate is enabled, in which case both run
+        before the annotation stages.
+        """
+        return bool(self.gate_max_contamination or
+                    self.gate_min_completeness or
+                    self.gate_min_kraken_margin)
+
+    def outbox_database(self) -> str:
+        """
+        Path of the notification outbox. A relative NOTIFICATION_OUTBOX_PATH
+        is taken inside LOG_PATH, so the workers and the notification sender
+        open the same file whatever their working directory.
+        """
+        return path.join(self.log_path, self.notification_outbox_path)
+
+    def describe(self) -> Dict[str, str]:
+        """
+        Returns the configuration as strings, without secrets, for logs.
+        """
+        hidden = {"smtp_password"}
+        return {item.name: str(getattr(self, item.name))
+                for item in fields(self) if item.name not in hidden}
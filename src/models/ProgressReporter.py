@@ -0,0 +1,145 @@
+from time import time
+from typing import Dict, List, Union
+from threading import Lock, Timer
+from datetime import datetime, timedelta, timezone
+from src.models.MongoHandler import MongoHandler
+
+lane_stages = {
+    "fastqc": ["fastqc"],
+    "genomic": ["stage_reads", "assembly_reads", "preclassify", "unicycler",
+                "prokka", "checkm", "kraken2", "species", "mlst", "abricate",
+                "coverage", "copy_assembly"]
+}
+lane_stages["complete"] = lane_stages["fastqc"] + lane_stages["genomic"]
+
+
+class ProgressReporter:
+    """
+    Publishes a compact progress record of a running task in sequencias.
+    Writes are throttled to one every min_interval seconds; a transition
+    that falls inside the interval is written by a deferred flush.
+    """
+
+    def __init__(self, mongo_client: MongoHandler, sample: int, lane: str,
+                 stage_estimates: Union[Dict[str, float], None] = None,
+                 min_interval: float = 30,
+                 skipped: Union[List[str], None] = None):
+        self.mongo_client = mongo_client
+        self.sample = sample
+        self.stages = [stage for stage in lane_stages.get(lane, [])
+                       if stage not in (skipped or [])]
+        self.stage_estimates = stage_estimates or {}
+        self.min_interval = min_interval
+        self.current_stage = ""
+        self.completed: List[str] = []
+        self.started_at: Dict[str, datetime] = {}
+        self.last_flush = 0.
+        self.timer: Union[Timer, None] = None
+        self.closed = False
+        self.lock = Lock()
+        self.flush_lock = Lock()
+
+    def start_stage(self, name: str):
+        with self.lock:
+            self.current_stage = name
+            self.started_at.setdefault(name, datetime.now(timezone.utc))
+        self.flush()
+
+    def finish_stage(self, name: str):
+        with self.lock:
+            if name not in self.completed:
+                self.completed.append(name)
+            if self.current_stage == name:
+                self.current_stage = ""
+        self.flush()
+
+    def _eta_seconds(self) -> Union[float, None]:
+        remaining = [stage for stage in self.stages
+                     if stage not in self.completed]
+        if not remaining:
+            return 0.
+        if any(stage not in self.stage_estimates for stage in remaining):
+            return None
+
+        eta = 0.
+        now = datetime.now(timezone.utc)
+        for stage in remaining:
+            estimate = self.stage_estimates[stage]
+            started = self.started_at.get(stage)
+            if started:
+                estimate -= (now - started).total_seconds()
+            eta += max(estimate, 0.)
+        return eta
+
+    def record(self) -> dict:
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            done = [stage for stage in self.stages
+                    if stage in self.completed]
+            eta = self._eta_seconds()
+            return {"etapaAtual": self.current_stage,
+                    "etapasConcluidas": done,
+                    "totalEtapas": len(self.stages),
+                    "inicioEtapas": dict(self.started_at),
+                    "etaSegundos": round(eta) if eta is not None else None,
+                    "conclusaoPrevista": now + timedelta(seconds=eta)
+                    if eta is not None else None,
+                    "atualizadoEm": now}
+
+    def flush(self, force=False):
+        with self.flush_lock:
+            if not self.closed:
+                self._flush(force)
+
+    def _flush(self, force: bool):
+        try:
+            wait = self.min_interval - (time() - self.last_flush)
+            if wait > 0 and not force:
+                if self.timer is None:
+                    self.timer = Timer(wait, self._deferred_flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            self.last_flush = time()
+            self.mongo_client.save("sequencias", {"_id": self.sample},
+                                   {"progresso": self.record()})
+        except Exception as e:
+            print(f"Failed to publish progress of {self.sample}.\n\n{e}")
+
+    def _deferred_flush(self):
+        self.timer = None
+        self.flush()
+
+    def mark_final(self, fields: List[str]):
+        """
+        Flags report fields of relatorios that will not change anymore, so
+        they can be shown before the whole analysis finishes.
+
+        Args:
+            fields (List[str]): Names of the final relatorios fields.
+        """
+        try:
+            query = {"sequenciaId": self.sample}
+            self.mongo_client.save(
+                "relatorios", query,
+                {f"resultadosFinais.{field}": True for field in fields})
+        except Exception as e:
+            print(f"Failed to mark final results of {self.sample}.\n\n{e}")
+
+    def close(self):
+        """
+        Writes the last record and stops publishing, so a deferred flush
+        can not write after the task closed its Mongo client.
+        """
+        with self.lock:
+            self.current_stage = ""
+        with self.flush_lock:
+            if self.closed:
+                return
+            self._flush(force=True)
+            self.closed = True
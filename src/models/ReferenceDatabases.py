@@ -0,0 +1,237 @@
+import os
+import json
+from os import path
+from shutil import copy2, copytree, rmtree
+from datetime import datetime, timezone
+from typing import Dict, List
+from src.utils.handle_databases import directory_manifest, set_checksum, \
+    blast_fastas, build_blast_index, missing_blast_indexes
+
+# Reference sets handled by the manager and how each one is prepared
+managed_databases = {"polimyxin_db": "blast",
+                     "outhers_db": "blast",
+                     "kraken_db": "files",
+                     "fastani_db": "files",
+                     "abricate_db": "files",
+                     "reference_gene_catalog": "files",
+                     "mutation_catalog": "files"}
+
+
+class ReferenceDatabases:
+    """
+    Versioned store of the reference databases under a single root:
+
+        <root>/<name>/versions/<version>/data/...
+        <root>/<name>/versions/<version>/manifest.json
+        <root>/<name>/current -> versions/<version>
+
+    A new version is copied, indexed and checksummed in a staging directory
+    and only then made current by atomically replacing the current symlink,
+    so workers never see a half-built database. Each sample resolves the
+    paths once when it starts and keeps using that version until it ends,
+    even if a newer one is activated meanwhile.
+    """
+
+    def __init__(self, root: str, makeblastdb="makeblastdb"):
+        self.root = root
+        self.makeblastdb = makeblastdb
+
+    def _database_dir(self, name: str) -> str:
+        if name not in managed_databases:
+            raise ValueError(f"Unknown reference database {name}.")
+        return path.join(self.root, name)
+
+    def _version_dir(self, name: str, version: str) -> str:
+        return path.join(self._database_dir(name), "versions", version)
+
+    def installed_versions(self, name: str) -> List[str]:
+        versions_dir = path.join(self._database_dir(name), "versions")
+        if not path.isdir(versions_dir):
+            return []
+        return sorted(version for version in os.listdir(versions_dir)
+                      if path.isfile(path.join(versions_dir, version,
+                                               "manifest.json")))
+
+    def manifest(self, name: str, version="") -> dict:
+        version = version or self.current_version(name)
+        if not version:
+            return {}
+        manifest_file = path.join(self._version_dir(name, version),
+                                  "manifest.json")
+        with open(manifest_file) as infile:
+            return json.load(infile)
+
+    def current_version(self, name: str) -> str:
+        current = path.join(self._database_dir(name), "current")
+        if not path.islink(current):
+            return ""
+        return path.basename(os.readlink(current))
+
+    def resolve(self, name: str) -> str:
+        """
+        Returns the path to pass to the tools for the current version of a
+        database, or an empty string when it is not installed.
+        """
+        version = self.current_version(name)
+        if not version:
+            return ""
+        entry = self.manifest(name, version).get("entry", "")
+        data_dir = path.join(self._version_dir(name, version), "data")
+        return path.join(data_dir, entry) if entry else data_dir
+
+    def versions(self) -> Dict[str, str]:
+        """
+        Returns the current version of each installed database, the key used
+        to tell results produced with different references apart.
+        """
+        versions = {}
+        for name in managed_databases:
+            version = self.current_version(name)
+            if version:
+                versions[name] = version
+        return versions
+
+    def install(self, name: str, source: str, version="",
+                activate=True) -> dict:
+        """
+        Installs a new version of a database from a file or directory.
+
+        Args:
+            name (str): Database name, one of managed_databases.
+            source (str): File or directory with the reference set.
+            version (str): Version label. Defaults to the install date and
+            the start of the checksum.
+            activate (bool): Makes the new version current.
+
+        Returns:
+            dict: The manifest of the installed version.
+        """
+        if not path.exists(source):
+            raise FileNotFoundError(f"Source {source} not found.")
+
+        database_dir = self._database_dir(name)
+        os.makedirs(path.join(database_dir, "versions"), exist_ok=True)
+
+        source_files = directory_manifest(source)
+        checksum = set_checksum(source_files)
+
+        # The same reference set installed again only becomes current
+        for installed in self.installed_versions(name):
+            if self.manifest(name, installed).get("checksum") == checksum:
+                if activate:
+                    self.activate(name, installed)
+                return self.manifest(name, installed)
+
+        if not version:
+            version = (f"{datetime.now(timezone.utc):%Y%m%d}-"
+                       f"{checksum[:8]}")
+        if path.exists(self._version_dir(name, version)):
+            raise ValueError(f"Version {version} of {name} already exists.")
+
+        staging = path.join(database_dir, f".staging-{os.getpid()}")
+        rmtree(staging, ignore_errors=True)
+        data_dir = path.join(staging, "data")
+        try:
+            entry = ""
+            if path.isfile(source):
+                os.makedirs(data_dir)
+                entry = path.basename(source)
+                copy2(source, path.join(data_dir, entry))
+            else:
+                copytree(source, data_dir)
+
+            blast_indexes = []
+            if managed_databases[name] == "blast":
+                for fasta in blast_fastas(data_dir):
+                    build_blast_index(fasta, self.makeblastdb)
+                    blast_indexes.append(path.relpath(fasta, data_dir))
+
+            manifest = {"name": name,
+                        "version": version,
+                        "kind": managed_databases[name],
+                        "entry": entry,
+                        "source": path.abspath(source),
+                        "checksum": checksum,
+                        "files": directory_manifest(data_dir),
+                        "blastIndexes": blast_indexes,
+                        "installedAt": datetime.now(timezone.utc).isoformat()}
+            with open(path.join(staging, "manifest.json"), "w") as outfile:
+                json.dump(manifest, outfile, indent=2)
+
+            os.rename(staging, self._version_dir(name, version))
+        except Exception:
+            rmtree(staging, ignore_errors=True)
+            raise
+
+        if activate:
+            self.activate(name, version)
+        return manifest
+
+    def activate(self, name: str, version: str):
+        """
+        Makes a version current by atomically replacing the current symlink.
+        """
+        if version not in self.installed_versions(name):
+            raise ValueError(f"Version {version} of {name} is not installed.")
+
+        current = path.join(self._database_dir(name), "current")
+        temporary = f"{current}.{os.getpid()}"
+        if path.lexists(temporary):
+            os.remove(temporary)
+        os.symlink(path.join("versions", version), temporary)
+        os.replace(temporary, current)
+
+    def verify(self, name: str, version="", full=True) -> List[str]:
+        """
+        Checks an installed version against its manifest.
+
+        Args:
+            name (str): Database name.
+            version (str): Version to check, the current one by default.
+            full (bool): Compares the checksums; otherwise only the presence
+            and size of the files, which is cheap enough for startup.
+
+        Returns:
+            List[str]: The problems found, empty when the version is sound.
+        """
+        version = version or self.current_version(name)
+        if not version:
+            return [f"{name} is not installed."]
+
+        manifest = self.manifest(name, version)
+        data_dir = path.join(self._version_dir(name, version), "data")
+        problems = []
+
+        found = directory_manifest(data_dir, checksums=full)
+        for relative, expected in manifest["files"].items():
+            actual = found.get(relative)
+            if not actual:
+                problems.append(f"{name} {version}: {relative} is missing.")
+            elif actual["size"] != expected["size"] or \
+                    (full and actual["sha256"] != expected["sha256"]):
+                problems.append(f"{name} {version}: {relative} changed.")
+
+        if manifest["kind"] == "blast":
+            for fasta in missing_blast_indexes(data_dir):
+                problems.append(f"{name} {version}: no BLAST index for "
+                                f"{path.relpath(fasta, data_dir)}.")
+        return problems
+
+    def prune(self, name: str, keep=2) -> List[str]:
+        """
+        Removes the oldest versions of a database, keeping the current one
+        and the keep - 1 most recently installed besides it, so samples
+        still running on the previous version are not disturbed.
+
+        Returns:
+            List[str]: The removed versions.
+        """
+        current = self.current_version(name)
+        others = sorted(
+            (version for version in self.installed_versions(name)
+             if version != current),
+            key=lambda version: self.manifest(name, version)["installedAt"])
+        removed = others[:max(len(others) - max(keep - 1, 0), 0)]
+        for version in removed:
+            rmtree(self._version_dir(name, version))
+        return removed
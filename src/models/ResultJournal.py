@@ -0,0 +1,316 @@
+import os
+import fcntl
+import sqlite3
+import threading
+from time import time, sleep
+from datetime import datetime, timezone
+from typing import List, Set, Tuple, Union
+from pymongo.errors import BulkWriteError
+from src.models.MongoHandler import MongoHandler
+from src.models.LocalResultStore import dumps, loads
+
+# Replayed in order they give the same document however many times they are
+# applied, so an operation pushed twice after a crash does no harm
+idempotent_operators = {"$set", "$unset"}
+replicated_retention = 86400
+
+
+class ResultJournal:
+    """
+    Write-ahead journal of result writes on the worker's disk, with the
+    interface of MongoHandler. save() only appends the update to a local
+    SQLite file and returns; JournalReplicator pushes the updates to Mongo
+    in order, so the pipeline never waits on the network and a database
+    outage does not fail a run. Reads and the other updates go to Mongo.
+    """
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.mongo_client: Union[MongoHandler, None] = None
+        self.connection = sqlite3.connect(journal_path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS operations ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "collection TEXT NOT NULL, "
+            "query TEXT NOT NULL, "
+            "bson TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "last_error TEXT)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS operations_status "
+            "ON operations (status, seq)")
+        self.connection.commit()
+
+    def _mongo(self) -> MongoHandler:
+        if self.mongo_client is None:
+            self.mongo_client = MongoHandler()
+        return self.mongo_client
+
+    def save(self, collection_name: str, query: dict, bson: dict):
+        try:
+            if not any(field.startswith("$") for field in bson):
+                bson = {"$set": bson}
+
+            # The date of the write, not of its replication
+            bson = dict(bson)
+            current_dates = bson.pop("$currentDate", {})
+            if current_dates:
+                now = datetime.now(timezone.utc)
+                bson["$set"] = {**bson.get("$set", {}),
+                                **{field: now for field in current_dates}}
+            unsupported = set(bson) - idempotent_operators
+            if unsupported:
+                raise ValueError(f"{', '.join(sorted(unsupported))} cannot "
+                                 "be replayed safely.")
+
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "INSERT INTO operations (collection, query, bson, "
+                    "created_at) VALUES (?, ?, ?, ?)",
+                    (collection_name, dumps(query), dumps(bson), time()))
+        except Exception as error:
+            raise Exception(f"Could not journal document update.\n\n{error}")
+
+    def search(self, collection_name: str, match=None, lookup=None,
+               project=None, sort=None, limit=None):
+        return self._mongo().search(collection_name, match, lookup, project,
+                                    sort, limit)
+
+    def find_and_update(self, collection_name: str, query: dict,
+                        bson: dict):
+        return self._mongo().find_and_update(collection_name, query, bson)
+
+    def update_many(self, collection_name: str, query: dict, bson: dict):
+        return self._mongo().update_many(collection_name, query, bson)
+
+    def pending(self, limit: int) -> List[Tuple[int, str, dict, dict]]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT seq, collection, query, bson FROM operations "
+                "WHERE status = 'pending' ORDER BY seq LIMIT ?",
+                (limit,)).fetchall()
+        return [(seq, collection, loads(query), loads(bson))
+                for seq, collection, query, bson in rows]
+
+    def pending_samples(self) -> Set[int]:
+        """
+        Returns the samples with operations waiting for Mongo, whose task
+        state in sequencias may not be current yet.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT collection, query FROM operations "
+                "WHERE status = 'pending'").fetchall()
+        samples = set()
+        for collection, query in rows:
+            query = loads(query)
+            sample = query.get("sequenciaId")
+            if sample is None and collection == "sequencias":
+                sample = query.get("_id")
+            if isinstance(sample, int):
+                samples.add(sample)
+        return samples
+
+    def backlog(self) -> Tuple[int, float]:
+        """
+        Returns the number of operations waiting for Mongo and the age in
+        seconds of the oldest one.
+        """
+        with self.lock:
+            count, oldest = self.connection.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM operations "
+                "WHERE status = 'pending'").fetchone()
+        return count, time() - oldest if oldest else 0.
+
+    def mark_replicated(self, seqs: List[int]):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE operations SET status = 'replicated' WHERE seq = ?",
+                [(seq,) for seq in seqs])
+
+    def mark_failed(self, seqs: List[int], error: str, rejected=False):
+        # Rejected operations are kept aside for inspection; the others are
+        # retried on the next round
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE operations SET attempts = attempts + 1, "
+                "last_error = ?, status = ? WHERE seq = ?",
+                [(error, "rejected" if rejected else "pending", seq)
+                 for seq in seqs])
+
+    def purge(self, retention=replicated_retention) -> int:
+        with self.lock, self.connection:
+            return self.connection.execute(
+                "DELETE FROM operations WHERE status = 'replicated' "
+                "AND created_at < ?", (time() - retention,)).rowcount
+
+    def close(self):
+        if self.mongo_client is not None:
+            self.mongo_client.close()
+            self.mongo_client = None
+        self.connection.close()
+
+
+def replicate_journal(journal: ResultJournal, mongo_client: MongoHandler,
+                      batch_size=500) -> int:
+    """
+    Pushes pending journal operations to Mongo in journal order, as one
+    ordered bulk upsert per run of consecutive operations on the same
+    collection. An operation Mongo rejects is set aside and the following
+    ones go on; a connection error stops the round, leaving it and the
+    rest pending.
+
+    Returns:
+        int: Number of operations replicated.
+    """
+    operations = journal.pending(batch_size)
+    replicated = 0
+    while operations:
+        collection_name = operations[0][1]
+        size = 1
+        while size < len(operations) and \
+                operations[size][1] == collection_name:
+            size += 1
+        batch, operations = operations[:size], operations[size:]
+        seqs = [seq for seq, _, _, _ in batch]
+        try:
+            mongo_client.bulk_upsert(
+                collection_name,
+                [(query, bson) for _, _, query, bson in batch])
+            journal.mark_replicated(seqs)
+            replicated += len(seqs)
+        except BulkWriteError as error:
+            failed = error.details["writeErrors"][0]
+            index = failed["index"]
+            journal.mark_replicated(seqs[:index])
+            journal.mark_failed([seqs[index]], failed.get("errmsg", ""),
+                                rejected=True)
+            replicated += index
+            # The operations after the rejected one were not attempted
+            operations = batch[index + 1:] + operations
+        except Exception as error:
+            journal.mark_failed(seqs, str(error))
+            raise
+    return replicated
+
+
+class JournalReplicator:
+    """
+    Background thread draining a result journal into Mongo, backing off
+    while the database is unreachable. Processes sharing a journal take
+    turns through a lock file, so operations are pushed in order.
+    """
+
+    def __init__(self, journal_path: str, batch_size=500, interval=2.,
+                 max_backoff=300.):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.stop_event = threading.Event()
+        self.thread: Union[threading.Thread, None] = None
+        self.journal: Union[ResultJournal, None] = None
+        self.mongo_client: Union[MongoHandler, None] = None
+
+    def _round(self, blocking: bool) -> int:
+        """
+        Replicates until the journal is empty.
+
+        Returns:
+            int: Operations left pending, or -1 when another process holds
+            the journal.
+        """
+        if self.journal is None:
+            self.journal = ResultJournal(self.journal_path)
+        if self.mongo_client is None:
+            self.mongo_client = MongoHandler()
+
+        with open(f"{self.journal_path}.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return -1
+            try:
+                while replicate_journal(self.journal, self.mongo_client,
+                                        self.batch_size):
+                    pass
+                self.journal.purge()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return self.journal.backlog()[0]
+
+    def _loop(self):
+        backoff = self.interval
+        while not self.stop_event.wait(backoff):
+            try:
+                self._round(blocking=False)
+                backoff = self.interval
+            except Exception as e:
+                backoff = min(max(backoff * 2, self.interval),
+                              self.max_backoff)
+                print(f"Failed to replicate results, retrying in "
+                      f"{backoff:.0f} s.\n\n{e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Replicates everything journaled so far, retrying until the timeout.
+
+        Returns:
+            bool: Whether the journal was emptied.
+        """
+        deadline = time() + timeout
+        while True:
+            try:
+                if self._round(blocking=True) == 0:
+                    return True
+            except Exception as e:
+                print(f"Failed to replicate results.\n\n{e}")
+            if time() >= deadline:
+                return False
+            sleep(min(self.interval, max(deadline - time(), 0)))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.journal:
+            self.journal.close()
+        if self.mongo_client:
+            self.mongo_client.close()
+
+
+def journaled_samples(journal_path: str) -> Set[int]:
+    journal = ResultJournal(journal_path)
+    try:
+        return journal.pending_samples()
+    finally:
+        journal.close()
+
+
+def journal_metrics(journal_path: str) -> List[Tuple[str, dict, float]]:
+    journal = ResultJournal(journal_path)
+    try:
+        pending, age = journal.backlog()
+    finally:
+        journal.close()
+    host = os.uname().nodename
+    return [("cabgen_journal_pending_operations", {"host": host}, pending),
+            ("cabgen_journal_oldest_pending_seconds", {"host": host}, age)]
+
+
+journal_descriptions = {
+    "cabgen_journal_pending_operations":
+        "Result writes journaled on this node and not yet in MongoDB.",
+    "cabgen_journal_oldest_pending_seconds":
+        "Age of the oldest result write not yet in MongoDB."}
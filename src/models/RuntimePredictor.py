@@ -0,0 +1,182 @@
+import numpy as np
+from os import path
+from statistics import median
+from typing import Dict, List, Tuple, Union
+from src.models.MongoHandler import MongoHandler
+
+default_runtimes = {"fastqc": 300., "genomic": 4 * 3600.,
+                    "complete": 4 * 3600. + 300.}
+default_memory_mb = 8000.
+# Peak disk footprint of a run per byte of compressed reads, used until the
+# lane has history. Assemblies keep decompressed reads, graphs and
+# intermediate k-mer files around.
+default_disk_ratios = {"fastqc": 3., "genomic": 12., "complete": 12.}
+default_disk_mb = 20000.
+
+
+def read_features(read1: str, read2: str,
+                  read_count: Union[int, None] = None) -> dict:
+    """
+    Builds the input features of a task from its read pair.
+
+    Args:
+        read1 (str): Path to the forward reads.
+        read2 (str): Path to the reverse reads.
+        read_count (int): Number of reads, when already known.
+
+    Returns:
+        dict: Sizes in bytes of both files, their sum and the read count.
+    """
+    sizes = [path.getsize(read) if path.isfile(read) else 0
+             for read in (read1, read2)]
+    return {"read1_size": sizes[0],
+            "read2_size": sizes[1],
+            "compressed_size": sum(sizes),
+            "read_count": read_count}
+
+
+class RuntimePredictor:
+    """
+    Predicts the runtime and peak memory of a task from the recorded history
+    of previous runs. Each lane gets a least-squares line over the compressed
+    read size, corrected by the mean residual of the species when it is
+    known and has enough history.
+    """
+
+    def __init__(self, history: List[dict], min_samples=5):
+        self.min_samples = min_samples
+        self.models: Dict[str, dict] = {}
+
+        lanes = {run.get("lane") for run in history}
+        for lane in lanes:
+            runs = [run for run in history if run.get("lane") == lane and
+                    run.get("runtime") is not None]
+            if runs:
+                self.models[lane] = self._fit(runs)
+
+    @classmethod
+    def from_mongo(cls, limit=2000, min_samples=5, lane=None, handler=None):
+        # A handler given by the caller is left open
+        own_handler = handler is None
+        handler = handler or MongoHandler()
+        try:
+            history = handler.search(
+                "historico_execucoes",
+                match={"lane": lane} if lane else None,
+                project={"lane": 1, "species": 1, "features": 1,
+                         "stages": 1, "runtime": 1, "peak_memory_mb": 1,
+                         "peak_disk_mb": 1},
+                sort={"finishedAt": -1}, limit=limit)
+        finally:
+            if own_handler:
+                handler.close()
+        return cls(history, min_samples)
+
+    def _fit(self, runs: List[dict]) -> dict:
+        sizes = np.array([run.get("features", {}).get("compressed_size", 0)
+                          for run in runs], dtype=float) / 1e9
+        runtimes = np.array([run["runtime"] for run in runs], dtype=float)
+        memory = np.array([run.get("peak_memory_mb") or default_memory_mb
+                           for run in runs], dtype=float)
+
+        stage_durations: Dict[str, List[float]] = {}
+        for run in runs:
+            for stage, duration in (run.get("stages") or {}).items():
+                stage_durations.setdefault(stage, []).append(duration)
+
+        # Upper decile of footprint per input byte, a tight estimate would
+        # let concurrent tasks overcommit the volume
+        disk_runs = [run for run, size in zip(runs, sizes)
+                     if run.get("peak_disk_mb") and size > 0]
+        disk_ratios = [run["peak_disk_mb"] / 1e3 /
+                       (run["features"]["compressed_size"] / 1e9)
+                       for run in disk_runs]
+
+        model = {"runtime_median": float(median(runtimes)),
+                 "memory_median": float(median(memory)),
+                 "disk_ratio": float(np.quantile(disk_ratios, 0.9))
+                 if len(disk_ratios) >= self.min_samples else None,
+                 "disk_median": float(median(
+                     run["peak_disk_mb"] for run in disk_runs))
+                 if disk_runs else None,
+                 "runtime_coef": None, "memory_coef": None,
+                 "species_offsets": {},
+                 "stage_medians": {stage: float(median(durations))
+                                   for stage, durations
+                                   in stage_durations.items()}}
+
+        if len(runs) < self.min_samples or np.ptp(sizes) == 0:
+            return model
+
+        design = np.column_stack([np.ones_like(sizes), sizes])
+        runtime_coef = np.linalg.lstsq(design, runtimes, rcond=None)[0]
+        memory_coef = np.linalg.lstsq(design, memory, rcond=None)[0]
+        model["runtime_coef"] = runtime_coef.tolist()
+        model["memory_coef"] = memory_coef.tolist()
+
+        residuals: Dict[str, List[float]] = {}
+        for run, size, runtime in zip(runs, sizes, runtimes):
+            species = run.get("species")
+            if species:
+                predicted = runtime_coef[0] + runtime_coef[1] * size
+                residuals.setdefault(species, []).append(runtime - predicted)
+        model["species_offsets"] = {
+            species: float(np.mean(values))
+            for species, values in residuals.items()
+            if len(values) >= self.min_samples}
+        return model
+
+    def stage_estimates(self, lane: str) -> Dict[str, float]:
+        model = self.models.get(lane)
+        return dict(model["stage_medians"]) if model else {}
+
+    def predict(self, lane: str, features: dict,
+                species="") -> Tuple[float, float]:
+        """
+        Predicts the runtime and peak memory of a task.
+
+        Args:
+            lane (str): Pipeline lane (fastqc, genomic or complete).
+            features (dict): Features built by read_features.
+            species (str): Species of the sample, when known.
+
+        Returns:
+            Tuple[float, float]: Runtime in seconds and memory in MB.
+        """
+        model = self.models.get(lane)
+        if not model:
+            return default_runtimes.get(lane, default_runtimes["complete"]), \
+                default_memory_mb
+
+        if model["runtime_coef"] is None:
+            return model["runtime_median"], model["memory_median"]
+
+        size = features.get("compressed_size", 0) / 1e9
+        runtime = model["runtime_coef"][0] + model["runtime_coef"][1] * size
+        runtime += model["species_offsets"].get(species, 0.)
+        memory = model["memory_coef"][0] + model["memory_coef"][1] * size
+
+        # Keep the estimates in a sane range for sizes outside the history
+        runtime = max(runtime, model["runtime_median"] * 0.1, 1.)
+        memory = max(memory, model["memory_median"] * 0.1, 1.)
+        return float(runtime), float(memory)
+
+    def predict_disk(self, lane: str, features: dict) -> float:
+        """
+        Predicts the peak disk footprint of a task, scratch and outputs.
+
+        Args:
+            lane (str): Pipeline lane (fastqc, genomic or complete).
+            features (dict): Features built by read_features.
+
+        Returns:
+            float: Footprint in MB.
+        """
+        model = self.models.get(lane) or {}
+        size = features.get("compressed_size", 0)
+        if not size:
+            return model.get("disk_median") or default_disk_mb
+
+        ratio = model.get("disk_ratio") or \
+            default_disk_ratios.get(lane, default_disk_ratios["complete"])
+        return float(size / 1e6 * ratio)
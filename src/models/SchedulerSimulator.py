@@ -0,0 +1,220 @@
+import numpy as np
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Tuple
+from src.models.FairShareQueue import FairShareQueue
+
+lanes = ["fastqc", "complete", "genomic"]
+
+
+@dataclass(frozen=True)
+class SimulationSettings:
+    """
+    Scheduler settings replayed by the simulator. "continuous" is the
+    current scheduler, which refills its queue as slots free up and starts
+    a task as soon as a slot is free. "rounds" is the former one: every
+    poll_interval after the previous round ends it takes the queued tasks
+    and runs the lanes one after the other, each lane to completion.
+    """
+    workers: int = 2
+    threads: int = 3
+    cores: int = 8
+    policy: str = "fifo"
+    dispatch: str = "continuous"
+    poll_interval: float = 300
+    user_max_concurrency: int = 0
+
+
+def scale_stage(wall: float, cpu: float, recorded_threads: int,
+                threads: int) -> Tuple[float, float]:
+    """
+    Rescales a recorded stage to another thread count with Amdahl's law,
+    taking the parallel fraction from the CPU time the stage used.
+
+    Args:
+        wall (float): Recorded wall time in seconds.
+        cpu (float): Recorded CPU time in seconds.
+        recorded_threads (int): Threads of the recorded run.
+        threads (int): Threads to simulate.
+
+    Returns:
+        Tuple[float, float]: Wall time with the new thread count, on an
+        otherwise idle machine, and the single-thread time of the stage.
+    """
+    if wall <= 0:
+        return 0., 0.
+    recorded_threads = max(recorded_threads, 1)
+    parallelism = min(max(cpu / wall, 1.), recorded_threads)
+    if recorded_threads == 1 or parallelism == 1:
+        return wall, wall
+
+    fraction = (1 - 1 / parallelism) / (1 - 1 / recorded_threads)
+    single = wall / ((1 - fraction) + fraction / recorded_threads)
+    return single * ((1 - fraction) + fraction / max(threads, 1)), single
+
+
+def parse_time(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+class SchedulerSimulator:
+    """
+    Discrete-event replay of a recorded workload (handle_workload records)
+    against other scheduler settings. Running tasks share the cores of the
+    node: when they demand more cores than there are, all of them slow down
+    in proportion (processor sharing). Dispatch uses the real FairShareQueue
+    with the recorded users, priorities and weights, and the dispatch
+    policies order by the simulated runtime, i.e. a perfect predictor.
+    """
+
+    def __init__(self, records: List[dict]):
+        self.records = records
+
+    def _jobs(self, settings: SimulationSettings) -> List[dict]:
+        jobs = []
+        for index, record in enumerate(self.records):
+            arrival = parse_time(record["enqueuedAt"])
+            recorded = parse_time(record["finishedAt"]) - \
+                parse_time(record["startedAt"])
+            recorded_threads = int(record.get("threads") or 1)
+
+            runtime = single = 0.
+            for stage in (record.get("stages") or {}).values():
+                wall, stage_single = scale_stage(
+                    stage["wall"], stage.get("cpu", 0.), recorded_threads,
+                    settings.threads)
+                runtime += wall
+                single += stage_single
+            # Time outside the stages (setup, e-mail, history) is serial
+            serial = max(recorded - sum(
+                stage["wall"]
+                for stage in (record.get("stages") or {}).values()), 0.)
+            runtime += serial
+            single += serial
+
+            jobs.append({"_id": index,
+                         "sample": record.get("sample"),
+                         "lane": record.get("lane", "complete"),
+                         "criadoPor": record.get("user", ""),
+                         "prioridade": record.get("priority", 0),
+                         "peso": record.get("weight", 1.),
+                         "maxConcorrencia": record.get("maxConcurrency", 0),
+                         "arrival": arrival,
+                         "predicted_runtime": runtime,
+                         "work": single,
+                         "demand": single / runtime if runtime else 1.})
+        return sorted(jobs, key=lambda job: job["arrival"])
+
+    @staticmethod
+    def _order(jobs: List[dict], policy: str) -> List[dict]:
+        if policy == "sjf":
+            return sorted(jobs, key=lambda job: job["predicted_runtime"])
+        if policy == "ljf":
+            return sorted(jobs, key=lambda job: -job["predicted_runtime"])
+        return sorted(jobs, key=lambda job: job["arrival"])
+
+    @staticmethod
+    def _rate(running: List[dict], cores: int) -> float:
+        demand = sum(job["demand"] for job in running)
+        return min(1., cores / demand) if demand else 1.
+
+    def _run(self, pending: List[dict], now: float,
+             settings: SimulationSettings, arrivals: List[dict]
+             ) -> Tuple[float, List[dict]]:
+        """
+        Runs the pending jobs from now on. In continuous mode the arrivals
+        join the queue as they come; in a round they wait for the next one.
+
+        Returns:
+            Tuple[float, List[dict]]: End time and the jobs left queued by
+            the concurrency caps.
+        """
+        running: List[dict] = []
+        queued = list(pending)
+        while True:
+            users = Counter(job["criadoPor"] for job in running)
+            queue = FairShareQueue(self._order(queued, settings.policy),
+                                   settings.user_max_concurrency, users)
+            while len(running) < settings.workers:
+                job = queue.next_task()
+                if job is None:
+                    break
+                queued.remove(job)
+                job["start"] = now
+                job["remaining"] = job["predicted_runtime"]
+                running.append(job)
+
+            rate = self._rate(running, settings.cores)
+            next_finish = min((job["remaining"] / rate for job in running),
+                              default=np.inf)
+            next_arrival = arrivals[0]["arrival"] - now if arrivals \
+                else np.inf
+            if next_finish == np.inf and next_arrival == np.inf:
+                return now, queued
+
+            step = min(next_finish, next_arrival)
+            now += step
+            for job in running:
+                job["remaining"] -= step * rate
+            for job in [job for job in running if job["remaining"] <= 1e-6]:
+                job["finish"] = now
+                running.remove(job)
+            while arrivals and arrivals[0]["arrival"] <= now:
+                queued.append(arrivals.pop(0))
+
+    def simulate(self, settings: SimulationSettings) -> Dict[str, float]:
+        """
+        Replays the workload.
+
+        Returns:
+            Dict[str, float]: Throughput (tasks per hour), p50/p95
+            turnaround and queue wait (seconds), worker slot and CPU
+            utilization, and the makespan.
+        """
+        jobs = self._jobs(settings)
+        if not jobs:
+            return {}
+
+        arrivals = list(jobs)
+        start = arrivals[0]["arrival"]
+        if settings.dispatch == "continuous":
+            self._run([], start, settings, arrivals)
+        else:
+            now = start
+            pending: List[dict] = []
+            while arrivals or pending:
+                while arrivals and arrivals[0]["arrival"] <= now:
+                    pending.append(arrivals.pop(0))
+                for lane in lanes:
+                    lane_jobs = [job for job in pending
+                                 if job["lane"] == lane]
+                    if not lane_jobs:
+                        continue
+                    now, deferred = self._run(lane_jobs, now, settings, [])
+                    pending = [job for job in pending
+                               if job["lane"] != lane or job in deferred]
+                now += settings.poll_interval
+
+        return self.summary(jobs, settings)
+
+    @staticmethod
+    def summary(jobs: List[dict], settings: SimulationSettings
+                ) -> Dict[str, float]:
+        arrival = np.array([job["arrival"] for job in jobs])
+        start = np.array([job["start"] for job in jobs])
+        finish = np.array([job["finish"] for job in jobs])
+        makespan = max(float(finish.max() - arrival.min()), 1e-9)
+        turnaround = finish - arrival
+        wait = start - arrival
+        busy = float((finish - start).sum())
+        work = sum(job["work"] for job in jobs)
+        return {"tasks": len(jobs),
+                "throughput_per_hour": len(jobs) / makespan * 3600,
+                "turnaround_p50": float(np.percentile(turnaround, 50)),
+                "turnaround_p95": float(np.percentile(turnaround, 95)),
+                "wait_p50": float(np.percentile(wait, 50)),
+                "wait_p95": float(np.percentile(wait, 95)),
+                "slot_utilization": busy / (settings.workers * makespan),
+                "cpu_utilization": work / (settings.cores * makespan),
+                "makespan": makespan}
@@ -0,0 +1,192 @@
+import socket
+from os import getpid
+from threading import Event, Thread
+from typing import Callable, Iterable, Union
+from datetime import datetime, timedelta, timezone
+from src.models.MongoHandler import MongoHandler
+
+
+def default_worker_id(prefix="") -> str:
+    prefix = prefix or socket.gethostname()
+    return f"{prefix}:{getpid()}"
+
+
+def lease_available(now: datetime) -> dict:
+    return {"$or": [{"lease": {"$exists": False}},
+                    {"lease": None},
+                    {"lease.expiresAt": {"$lt": now}}]}
+
+
+class TaskLease:
+    """
+    Exclusive, expiring claim of a sequencias task. The claim is a single
+    find-and-modify, so any number of schedulers on any number of hosts can
+    pull from the same queue. A background thread renews the lease while the
+    task runs; if the worker dies the lease expires and the task can be
+    claimed again.
+
+    Every renewal also reads the cancelamentoSolicitado flag of the task; once
+    it is set, on_cancel is called a single time so the worker can kill the
+    running tools.
+    """
+
+    def __init__(self, task_id: int, lane: str, worker_id="",
+                 lease_seconds=600, collection_name="sequencias",
+                 on_cancel: Union[Callable[[], None], None] = None,
+                 cancel_poll_seconds: float = 15):
+        self.task_id = task_id
+        self.lane = lane
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.collection_name = collection_name
+        self.on_cancel = on_cancel
+        self.cancel_poll_seconds = cancel_poll_seconds
+        self.stop_event = Event()
+        self.heartbeat_thread = None
+        self.claimed = False
+        self.cancelled = False
+
+    def _expiry(self, now: datetime) -> datetime:
+        return now + timedelta(seconds=self.lease_seconds)
+
+    def claim(self) -> bool:
+        handler = MongoHandler()
+        try:
+            now = datetime.now(timezone.utc)
+            query = {"_id": self.task_id, "ultimaTarefa": self.lane,
+                     **lease_available(now)}
+            bson = {"$set": {"lease": {"workerId": self.worker_id,
+                                       "claimedAt": now,
+                                       "heartbeat": now,
+                                       "expiresAt": self._expiry(now)}},
+                    "$inc": {"leaseCount": 1}}
+            claimed = handler.find_and_update(self.collection_name, query,
+                                              bson)
+            self.claimed = claimed is not None
+        finally:
+            handler.close()
+
+        if self.claimed:
+            self._check_cancel(claimed)  # type: ignore
+            self.heartbeat_thread = Thread(target=self._heartbeat,
+                                           daemon=True)
+            self.heartbeat_thread.start()
+        return self.claimed
+
+    def _check_cancel(self, task: dict):
+        if self.cancelled or not task.get("cancelamentoSolicitado"):
+            return
+        self.cancelled = True
+        print(f"Task {self.task_id} was cancelled.")
+        if self.on_cancel:
+            self.on_cancel()
+
+    def _heartbeat(self):
+        handler = MongoHandler()
+        interval = max(min(self.lease_seconds / 3,
+                           self.cancel_poll_seconds), 1)
+        try:
+            while not self.stop_event.wait(interval):
+                try:
+                    now = datetime.now(timezone.utc)
+                    query = {"_id": self.task_id,
+                             "lease.workerId": self.worker_id}
+                    bson = {"$set": {"lease.heartbeat": now,
+                                     "lease.expiresAt": self._expiry(now)}}
+                    renewed = handler.find_and_update(
+                        self.collection_name, query, bson)
+                    if renewed is None:
+                        print(f"Lease of task {self.task_id} was lost.")
+                        return
+                    self._check_cancel(renewed)
+                except Exception as e:
+                    print(f"Failed to renew lease of task {self.task_id}."
+                          f"\n\n{e}")
+        finally:
+            handler.close()
+
+    def stop_heartbeat(self):
+        """
+        Stops renewing the lease without releasing it, so it only expires
+        once lease_seconds have passed.
+        """
+        self.stop_event.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def release(self):
+        self.stop_heartbeat()
+
+        if not self.claimed:
+            return
+
+        handler = MongoHandler()
+        try:
+            # The wait is over; a task submitted again is stamped anew when
+            # a scheduler next sees it
+            handler.find_and_update(
+                self.collection_name,
+                {"_id": self.task_id, "lease.workerId": self.worker_id},
+                {"$unset": {"lease": "", "enfileiradoEm": ""}})
+            self.claimed = False
+        except Exception as e:
+            print(f"Failed to release lease of task {self.task_id}.\n\n{e}")
+        finally:
+            handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+def mark_interrupted(task_id: int, lane: str, result: str,
+                     collection_name="sequencias"):
+    """
+    Takes a cancelled or timed out task off its queue, recording the lane it
+    was in so it can be submitted again.
+
+    Args:
+        task_id (int): Sample id.
+        lane (str): The ultimaTarefa of the task, e.g. "ENS".
+        result (str): "cancelada" or "tempo_esgotado".
+    """
+    handler = MongoHandler()
+    try:
+        handler.find_and_update(
+            collection_name, {"_id": task_id, "ultimaTarefa": lane},
+            {"$set": {"ultimaTarefa": "",
+                      "resultadoExecucao": result,
+                      "tarefaInterrompida": lane,
+                      "interrompidaEm": datetime.now(timezone.utc)},
+             "$unset": {"cancelamentoSolicitado": ""}})
+    finally:
+        handler.close()
+
+
+def recover_expired_leases(collection_name="sequencias",
+                           exclude: Iterable[int] = ()) -> int:
+    """
+    Clears the leases whose worker stopped sending heartbeats, so the tasks
+    show up as available again.
+
+    Args:
+        exclude (Iterable[int]): Tasks whose lease is kept, e.g. the ones
+        with results still in the result journal.
+
+    Returns:
+        int: Number of recovered tasks.
+    """
+    handler = MongoHandler()
+    try:
+        now = datetime.now(timezone.utc)
+        query: dict = {"lease.expiresAt": {"$lt": now}}
+        if exclude:
+            query["_id"] = {"$nin": list(exclude)}
+        return handler.update_many(
+            collection_name, query,
+            {"$unset": {"lease": ""}, "$inc": {"leaseRecoveries": 1}})
+    finally:
+        handler.close()
@@ -9,3 +9,7 @@ class BacteriaDict(TypedDict):
     poli_db_path: str
     others_outfile_suffix: str
     poli_outfile_suffix: str
+    blastx: str
+    mutation_catalog: str
+    mutation_exhaustive: bool
+    mutation_deferred: bool
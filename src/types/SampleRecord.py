@@ -0,0 +1,23 @@
+from datetime import datetime
+from typing import Dict, List, TypedDict
+
+
+class SampleRecord(TypedDict, total=False):
+    sample: int
+    species: str
+    speciesKey: str
+    st: str
+    mlstScheme: str
+    resistanceGenes: List[str]
+    resistanceClasses: List[str]
+    virulenceGenes: List[str]
+    plasmids: List[str]
+    mutations: List[str]
+    mutationGenes: List[str]
+    completeness: float
+    contamination: float
+    coverage: float
+    genomeSize: int
+    databaseVersions: Dict[str, str]
+    qualityGate: str
+    finishedAt: datetime
@@ -9,3 +9,7 @@ class SpeciesDict(TypedDict):
     poli_db_path: str
     fastani_db_path: str
     output_path: str
+    blastx: str
+    mutation_catalog: str
+    mutation_exhaustive: bool
+    mutation_deferred: bool
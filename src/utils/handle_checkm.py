@@ -0,0 +1,70 @@
+import os
+import re
+from os import path
+from typing import List, Tuple
+from src.utils.handle_programs import run_command_line, CommandTimeout, \
+    CommandCancelled
+
+
+def checkm_taxa(kraken_name: str) -> List[Tuple[str, str]]:
+    """
+    Lists the CheckM taxa to try for a Kraken taxon name, the most specific
+    first, e.g. "Klebsiella pneumoniae" gives the species and then the genus.
+    """
+    words = kraken_name.strip().split()
+    if not words or not words[0][:1].isupper() or \
+            words[0].lower() in ("unclassified", "root"):
+        return []
+
+    taxa = []
+    if len(words) > 1 and words[1].islower() and words[1] != "sp.":
+        taxa.append(("species", f"{words[0]} {words[1]}"))
+    taxa.append(("genus", words[0]))
+    return taxa
+
+
+def cached_marker_set(checkm: str, cache_dir: str, rank: str,
+                      taxon: str) -> str:
+    """
+    Returns the CheckM marker set of a taxon, creating it with
+    "checkm taxon_set" on first use. Taxa CheckM does not know are
+    remembered too, so they are not asked for again; a failed command is
+    not, so it is retried by the next sample.
+
+    Args:
+        checkm (str): CheckM executable.
+        cache_dir (str): Directory of the marker sets.
+        rank (str): Taxonomic rank, e.g. "species".
+        taxon (str): Taxon name, e.g. "Klebsiella pneumoniae".
+
+    Returns:
+        str: Path to the marker set, empty when CheckM has none.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    slug = re.sub(r"[^a-z0-9]+", "_", taxon.lower()).strip("_")
+    marker_file = path.join(cache_dir, f"{rank}-{slug}.ms")
+    missing_file = f"{marker_file}.missing"
+    if path.isfile(marker_file):
+        return marker_file
+    if path.isfile(missing_file):
+        return ""
+
+    # Written aside and renamed, as several workers may share the cache
+    partial_file = f"{marker_file}.{os.getpid()}"
+    try:
+        run_command_line(f"{checkm} taxon_set {rank} '{taxon}' "
+                         f"{partial_file}")
+    except (CommandTimeout, CommandCancelled):
+        raise
+    except RuntimeError:
+        if path.isfile(partial_file):
+            os.remove(partial_file)
+        return ""
+    if not path.isfile(partial_file) or not path.getsize(partial_file):
+        if path.isfile(partial_file):
+            os.remove(partial_file)
+        open(missing_file, "w").close()
+        return ""
+
+    os.replace(partial_file, marker_file)
+    return marker_file
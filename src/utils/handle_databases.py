@@ -0,0 +1,131 @@
+import os
+import hashlib
+from os import path
+from typing import Dict, List
+from src.utils.handle_programs import run_command_line
+
+blast_extensions = (".fasta", ".fa", ".faa")
+blast_index_suffixes = (".pin", ".pal", ".00.pin")
+
+
+def file_checksum(file_path: str, block_size=1 << 20) -> str:
+    """
+    Computes the SHA-256 checksum of a file, reading it in blocks.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_files(root: str) -> List[str]:
+    """
+    Lists the files below root as sorted paths relative to it.
+    """
+    if path.isfile(root):
+        return [path.basename(root)]
+
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files.append(path.relpath(path.join(dirpath, filename), root))
+    return sorted(files)
+
+
+def directory_manifest(root: str, checksums=True) -> Dict[str, dict]:
+    """
+    Describes every file below root by size and, optionally, checksum.
+
+    Args:
+        root (str): Directory (or single file) to describe.
+        checksums (bool): Computes the SHA-256 of each file.
+
+    Returns:
+        Dict[str, dict]: Relative path to {"size", "sha256"}.
+    """
+    base = path.dirname(root) if path.isfile(root) else root
+    files = {}
+    for relative in list_files(root):
+        file_path = path.join(base, relative)
+        files[relative] = {"size": path.getsize(file_path),
+                           "sha256": file_checksum(file_path)
+                           if checksums else ""}
+    return files
+
+
+def set_checksum(files: Dict[str, dict]) -> str:
+    """
+    Combines the checksums of a reference set into a single checksum that
+    does not depend on the order the files were found.
+    """
+    digest = hashlib.sha256()
+    for relative in sorted(files):
+        digest.update(f"{relative}\t{files[relative]['sha256']}\n".encode())
+    return digest.hexdigest()
+
+
+def blast_fastas(root: str) -> List[str]:
+    """
+    Lists the protein FASTA files below root that are used as BLAST
+    databases.
+    """
+    base = path.dirname(root) if path.isfile(root) else root
+    return [path.join(base, relative) for relative in list_files(root)
+            if relative.endswith(blast_extensions)]
+
+
+def blast_index_exists(prefix: str) -> bool:
+    return any(path.exists(f"{prefix}{suffix}")
+               for suffix in blast_index_suffixes)
+
+
+def build_blast_index(fasta: str, makeblastdb="makeblastdb"):
+    """
+    Builds the protein BLAST index of a FASTA file next to it, using the
+    FASTA path as the database name, which is the -db run_blastx receives.
+    """
+    run_command_line(f"{makeblastdb} -in {fasta} -dbtype prot "
+                     f"-out {fasta}")
+    if not blast_index_exists(fasta):
+        raise RuntimeError(f"makeblastdb did not build an index for {fasta}.")
+
+
+def missing_blast_indexes(root: str) -> List[str]:
+    """
+    Returns the protein FASTA files below root without a BLAST index, or
+    with an index older than the FASTA itself.
+    """
+    missing = []
+    for fasta in blast_fastas(root):
+        indexes = [f"{fasta}{suffix}" for suffix in blast_index_suffixes
+                   if path.exists(f"{fasta}{suffix}")]
+        if not indexes or all(path.getmtime(index) < path.getmtime(fasta)
+                              for index in indexes):
+            missing.append(fasta)
+    return missing
+
+
+def warm_page_cache(files: List[str]) -> int:
+    """
+    Asks the kernel to read files into the page cache ahead of use, so a
+    later step finds its reference data in memory instead of on disk.
+
+    Returns:
+        int: Bytes requested.
+    """
+    requested = 0
+    for file_path in files:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            requested += os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+    return requested
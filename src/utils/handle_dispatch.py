@@ -0,0 +1,114 @@
+import heapq
+from os import path
+from typing import Dict, List
+from datetime import datetime, timedelta, timezone
+from src.models.MongoHandler import MongoHandler
+from src.models.RuntimePredictor import RuntimePredictor, read_features
+
+
+def task_features(task: dict, uploaded_sequences_path: str) -> dict:
+    read1 = path.join(uploaded_sequences_path, task.get("arquivofastqr1", ""))
+    read2 = path.join(uploaded_sequences_path, task.get("arquivofastqr2", ""))
+    return read_features(read1, read2)
+
+
+def reported_species(samples: List[int]) -> Dict[int, str]:
+    """
+    Returns the species reported by an earlier analysis of the samples,
+    e.g. before a genomic rerun. First analyses have none.
+    """
+    if not samples:
+        return {}
+
+    handler = MongoHandler()
+    try:
+        reports = handler.search(
+            "relatorios",
+            match={"sequenciaId": {"$in": samples},
+                   "especie": {"$exists": True}},
+            project={"sequenciaId": 1, "especie": 1})
+        return {report["sequenciaId"]: report["especie"]
+                for report in reports
+                if isinstance(report.get("especie"), str)}
+    except Exception as e:
+        print(f"Failed to read reported species.\n\n{e}")
+        return {}
+    finally:
+        handler.close()
+
+
+def order_tasks(tasks: List[dict], mode: str, predictor: RuntimePredictor,
+                uploaded_sequences_path: str, policy="fifo") -> List[dict]:
+    """
+    Annotates the tasks with their predicted runtime, memory and disk
+    footprint and orders them according to the dispatch policy.
+
+    Args:
+        tasks (List[dict]): Tasks returned by handle_tasks.
+        mode (str): Pipeline lane of the tasks.
+        predictor (RuntimePredictor): Runtime predictor.
+        uploaded_sequences_path (str): Directory of the uploaded reads.
+        policy (str): "fifo" keeps the query order, "sjf" runs the shortest
+        predicted jobs first (latency) and "ljf" the longest first
+        (makespan).
+
+    Returns:
+        List[dict]: Ordered tasks.
+    """
+    species = reported_species([task["_id"] for task in tasks])
+    for task in tasks:
+        features = task_features(task, uploaded_sequences_path)
+        runtime, memory = predictor.predict(mode, features,
+                                            species.get(task["_id"], ""))
+        task["predicted_runtime"] = runtime
+        task["predicted_memory"] = memory
+        task["predicted_disk"] = predictor.predict_disk(mode, features)
+
+    if policy == "sjf":
+        return sorted(tasks, key=lambda task: task["predicted_runtime"])
+    if policy == "ljf":
+        return sorted(tasks, key=lambda task: -task["predicted_runtime"])
+    return list(tasks)
+
+
+def publish_predictions(tasks: List[dict], workers: int,
+                        start: datetime) -> datetime:
+    """
+    Simulates the dispatch of the ordered tasks on the worker slots and saves
+    the predicted start and completion time of each task in sequencias.
+
+    Args:
+        tasks (List[dict]): Tasks annotated by order_tasks.
+        workers (int): Number of worker slots.
+        start (datetime): Time at which the first slot becomes free.
+
+    Returns:
+        datetime: Predicted completion time of the last task.
+    """
+    slots = [0.] * max(workers, 1)
+    heapq.heapify(slots)
+    makespan = 0.
+
+    handler = MongoHandler()
+    try:
+        for task in tasks:
+            slot_free = heapq.heappop(slots)
+            finish = slot_free + task["predicted_runtime"]
+            heapq.heappush(slots, finish)
+            makespan = max(makespan, finish)
+
+            prediction = {
+                "duracaoPrevista": round(task["predicted_runtime"]),
+                "memoriaPrevistaMb": round(task["predicted_memory"]),
+                "discoPrevistoMb": round(task["predicted_disk"]),
+                "inicioPrevisto": start + timedelta(seconds=slot_free),
+                "conclusaoPrevista": start + timedelta(seconds=finish),
+                "calculadoEm": datetime.now(timezone.utc)}
+            handler.save("sequencias", {"_id": task["_id"]},
+                         {"previsao": prediction})
+    except Exception as e:
+        print(f"Failed to publish predictions.\n\n{e}")
+    finally:
+        handler.close()
+
+    return start + timedelta(seconds=makespan)
@@ -12,3 +12,19 @@ def delete_folders_and_files(paths: List[str]):
                 rmtree(path)
     except Exception as e:
         print(f"Failed to delete {e}.")
+
+
+def directory_size(root: str) -> int:
+    """
+    Returns the bytes allocated on disk by the files under a directory, zero
+    when it does not exist. Files removed while walking are ignored.
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+            total += stat.st_blocks * 512
+    return total
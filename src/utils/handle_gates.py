@@ -0,0 +1,73 @@
+import numpy as np
+from typing import Tuple
+
+
+class QualityGateFailed(Exception):
+    """
+    Raised when a sample fails a quality gate, ending its analysis early.
+    """
+
+    def __init__(self, gate: str, value: float, limit: float):
+        self.gate = gate
+        self.value = value
+        self.limit = limit
+        super().__init__(f"{gate} is {value:g}, the limit is {limit:g}.")
+
+    def report(self) -> dict:
+        return {"portao": self.gate, "valor": self.value,
+                "limite": self.limit}
+
+
+def check_minimum(gate: str, value: float, minimum: float):
+    """
+    Fails the gate when the value is below a minimum; zero disables it.
+    """
+    if minimum and value < minimum:
+        raise QualityGateFailed(gate, value, minimum)
+
+
+def check_maximum(gate: str, value: float, maximum: float):
+    """
+    Fails the gate when the value is above a maximum; zero disables it.
+    """
+    if maximum and value > maximum:
+        raise QualityGateFailed(gate, value, maximum)
+
+
+def assembly_stats(fasta: str) -> Tuple[int, int, int]:
+    """
+    Computes the size of an assembly and its N50.
+
+    Args:
+        fasta (str): Path to the assembly.
+
+    Returns:
+        Tuple[int, int, int]: Total length, N50 and number of contigs.
+    """
+    lengths = []
+    length = 0
+    with open(fasta) as infile:
+        for line in infile:
+            if line.startswith(">"):
+                if length:
+                    lengths.append(length)
+                length = 0
+            else:
+                length += len(line.strip())
+    if length:
+        lengths.append(length)
+    if not lengths:
+        return 0, 0, 0
+
+    ordered = np.sort(np.array(lengths, dtype=np.int64))[::-1]
+    cumulative = np.cumsum(ordered)
+    n50 = int(ordered[np.searchsorted(cumulative, cumulative[-1] / 2)])
+    return int(cumulative[-1]), n50, len(lengths)
+
+
+def kraken_margin(first_count: int, second_count: int) -> float:
+    """
+    Share of the most voted taxon among the two most voted ones.
+    """
+    total = first_count + second_count
+    return first_count / total if total else 0.
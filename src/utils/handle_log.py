@@ -1,6 +1,36 @@
 import os
+import json
 import logging
-from typing import Union
+from time import time
+from logging.handlers import QueueHandler
+from multiprocessing import Process, Queue, get_context
+from typing import Dict, Set, Tuple, Union
+
+# Pool workers run a single task each, so per-process measures such as the
+# peak memory of the tools cover that task only. Fresh workers need the
+# spawn start method, and the log queue handed to them its context.
+task_context = get_context("spawn")
+
+# Queue set in pool workers by init_worker_logging. When it is set, the task
+# loggers only push records to the listener process.
+worker_log_queue: Union[Queue, None] = None
+
+log_format = logging.Formatter(
+    '%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def init_worker_logging(queue: Queue):
+    """
+    Pool initializer that routes the task loggers of a worker to the log
+    listener.
+
+    Args:
+        queue (Queue): Queue consumed by the log listener.
+    """
+    global worker_log_queue
+    worker_log_queue = queue
 
 
 def logging_conf(task_id: int, log_dir: str,
@@ -14,29 +44,146 @@ def logging_conf(task_id: int, log_dir: str,
         log_level (int): Logging level (default is INFO).
     """
     try:
-        if not os.path.exists(log_dir):
-            os.mkdir(log_dir)
-
         logger = logging.getLogger(f"tarefas_{task_id}")
         logger.setLevel(log_level)
+        logger.propagate = False
 
-        log_file = os.path.join(log_dir, f"tarefas_{task_id}.log")
+        # Drop handlers left by a previous run of the task in this worker
+        release_handlers(logger)
 
-        handler = logging.FileHandler(log_file, mode='w')
+        if worker_log_queue is not None:
+            logger.addHandler(QueueHandler(worker_log_queue))
+            return logger
 
-        formatter = logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        handler.setFormatter(formatter)
+        if not os.path.exists(log_dir):
+            os.mkdir(log_dir)
 
-        # Add the handler to the logger (check if handler exists to avoid
-        # duplication)
-        if not logger.hasHandlers():
-            logger.addHandler(handler)
+        log_file = os.path.join(log_dir, f"tarefas_{task_id}.log")
+
+        handler = logging.FileHandler(log_file, mode='w')
+        handler.setFormatter(log_format)
+        logger.addHandler(handler)
 
         return logger
 
     except Exception as e:
         print(f"Error configuring logging for task {task_id}: {e}.")
         return None
+
+
+def release_handlers(logger: logging.Logger):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def release_logger(logger: Union[logging.Logger, None]):
+    """
+    Closes the task log. The listener closes the task file once it receives
+    the end-of-task record.
+
+    Args:
+        logger (Logger): Task logger returned by logging_conf.
+    """
+    if not logger:
+        return
+
+    try:
+        logger.info("Task log closed", extra={"end_of_task": True})
+    finally:
+        release_handlers(logger)
+
+
+def json_record(record: logging.LogRecord) -> str:
+    return json.dumps({"time": record.created,
+                       "level": record.levelname,
+                       "task": record.name,
+                       "process": record.process,
+                       "message": record.getMessage()},
+                      ensure_ascii=False)
+
+
+def log_listener(queue: Queue, log_dir: str, json_log_path: str = "",
+                 idle_timeout: float = 3600):
+    """
+    Writes the records pushed by the pool workers to one file per task and,
+    optionally, to a JSON lines stream. Runs until it receives None.
+
+    Args:
+        queue (Queue): Queue fed by the workers' QueueHandlers.
+        log_dir (str): Directory where task log files are written.
+        json_log_path (str): Optional path of the structured JSON stream.
+        idle_timeout (float): Seconds after which the file of a task that
+        stopped logging is closed.
+    """
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+
+    handlers: Dict[str, Tuple[logging.FileHandler, float]] = {}
+    # Tasks whose file was closed while still running, reopened in append
+    # mode so their earlier records are kept
+    idle_tasks: Set[str] = set()
+    json_stream = open(json_log_path, "a") if json_log_path else None
+
+    while True:
+        record = queue.get()
+        if record is None:
+            break
+
+        try:
+            handler, _ = handlers.get(record.name, (None, 0.))
+            if handler is None:
+                handler = logging.FileHandler(
+                    os.path.join(log_dir, f"{record.name}.log"),
+                    mode='a' if record.name in idle_tasks else 'w')
+                handler.setFormatter(log_format)
+            handler.handle(record)
+            handlers[record.name] = (handler, time())
+
+            if json_stream:
+                json_stream.write(json_record(record) + "\n")
+                json_stream.flush()
+
+            if getattr(record, "end_of_task", False):
+                handlers.pop(record.name)[0].close()
+                idle_tasks.discard(record.name)
+
+            now = time()
+            for name, (idle_handler, last_seen) in list(handlers.items()):
+                if now - last_seen > idle_timeout:
+                    idle_handler.close()
+                    del handlers[name]
+                    idle_tasks.add(name)
+        except Exception as e:
+            print(f"Failed to write log record.\n\n{e}")
+
+    for handler, _ in handlers.values():
+        handler.close()
+    if json_stream:
+        json_stream.close()
+
+
+def start_log_listener(log_dir: str,
+                       json_log_path: str = "") -> Tuple[Queue, Process]:
+    """
+    Starts the log listener process.
+
+    Args:
+        log_dir (str): Directory where task log files are written.
+        json_log_path (str): Optional path of the structured JSON stream.
+
+    Returns:
+        Tuple[Queue, Process]: Queue to hand to the workers and the listener
+        process.
+    """
+    queue: Queue = task_context.Queue()
+    listener: Process = task_context.Process(  # type: ignore
+        target=log_listener, args=(queue, log_dir, json_log_path),
+        daemon=True)
+    listener.start()
+    return queue, listener
+
+
+def stop_log_listener(queue: Queue, listener: Process):
+    queue.put(None)
+    listener.join()
@@ -0,0 +1,50 @@
+import os
+from os import path
+from typing import Dict, List, Tuple
+
+Metric = Tuple[str, Dict[str, str], float]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value)}"'
+                     for key, value in sorted(labels.items()))
+    return f"{{{pairs}}}"
+
+
+def write_metrics(metrics_path: str, name: str, metrics: List[Metric],
+                  descriptions: Dict[str, str]):
+    """
+    Writes metrics in the Prometheus text format to
+    <metrics_path>/<name>.prom, the layout read by the node exporter
+    textfile collector. The file is replaced atomically so the collector
+    never reads a partial file. Nothing is written when metrics_path is
+    empty.
+
+    Args:
+        metrics_path (str): Directory read by the textfile collector.
+        name (str): Name of the metrics file.
+        metrics (List[Metric]): Metric name, labels and value.
+        descriptions (Dict[str, str]): Help text of each metric name.
+    """
+    if not metrics_path:
+        return
+
+    try:
+        os.makedirs(metrics_path, exist_ok=True)
+        lines = []
+        for metric_name, description in descriptions.items():
+            lines.append(f"# HELP {metric_name} {description}")
+            lines.append(f"# TYPE {metric_name} gauge")
+            for sample_name, labels, value in metrics:
+                if sample_name == metric_name:
+                    lines.append(f"{metric_name}{format_labels(labels)} "
+                                 f"{value}")
+
+        metrics_file = path.join(metrics_path, f"{name}.prom")
+        with open(f"{metrics_file}.tmp", "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(f"{metrics_file}.tmp", metrics_file)
+    except Exception as e:
+        print(f"Failed to write {name} metrics.\n\n{e}")
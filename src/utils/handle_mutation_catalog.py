@@ -0,0 +1,60 @@
+import csv
+import numpy as np
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# Calling only catalogued sites needs a curated TSV of resistance-relevant
+# residues (MUTATION_CATALOG), with the columns species, gene, position and
+# reference in the numbering of the proteins of the mutation BLAST
+# databases. There is no built-in list: without a catalog every
+# substitution of the panel genes is reported.
+Sites = Dict[str, np.ndarray]
+
+
+def read_catalog(catalog_path: str) -> List[Tuple[str, str, int, str]]:
+    """
+    Reads a curated catalog of known mutation sites.
+
+    Args:
+        catalog_path (str): Tab-delimited file with a header and the columns
+        species, gene, position and reference.
+
+    Returns:
+        List[Tuple[str, str, int, str]]: The catalog entries.
+    """
+    entries = []
+    with open(catalog_path, newline="") as infile:
+        for row in csv.DictReader(infile, delimiter="\t"):
+            entries.append((row["species"].strip(), row["gene"].strip(),
+                            int(row["position"]),
+                            (row.get("reference") or "").strip().upper()))
+    return entries
+
+
+def compile_catalog(
+        entries: List[Tuple[str, str, int, str]]) -> Dict[str, Sites]:
+    """
+    Compiles the catalog into a lookup table of sorted subject positions per
+    species and gene.
+
+    Returns:
+        Dict[str, Sites]: species -> gene -> positions.
+    """
+    positions: Dict[str, Dict[str, set]] = {}
+    for species, gene, position, _ in entries:
+        positions.setdefault(species, {}).setdefault(gene, set()) \
+            .add(position)
+    return {species: {gene: np.array(sorted(gene_positions), dtype=np.int64)
+                      for gene, gene_positions in genes.items()}
+            for species, genes in positions.items()}
+
+
+@lru_cache(maxsize=4)
+def load_catalog(catalog_path: str) -> Dict[str, Sites]:
+    return compile_catalog(read_catalog(catalog_path))
+
+
+def species_sites(species: str, catalog_path="") -> Sites:
+    if not catalog_path:
+        return {}
+    return load_catalog(catalog_path).get(species, {})
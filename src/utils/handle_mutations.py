@@ -1,27 +1,30 @@
 import re
-from typing import List, Tuple
+import numpy as np
+from typing import List, Tuple, Union
+from src.utils.handle_mutation_catalog import Sites, species_sites
 
-sbjct_pattern = re.compile(r">([\w]+)\|", re.I)
+sbjct_pattern = re.compile(r"^>\s*([^|\s]+)", re.I)
 sbjct_length_pattern = re.compile(r"Length=(\d+)", re.I)
 identities_total_pattern = re.compile(r"Identities = \d+\/(\d+)", re.I)
 perc_identity_pattern = re.compile(
     r"Identities = \d+\/\d+\s\((\d+)%\)", re.I)
-query_sequence_pattern = re.compile(r"Query\s+\d+\s+(\w+)", re.I)
-alignment_sequence_pattern = re.compile(
-    r"^\s+[ACDEFGHIKLMNPQRSTVWY\+\s]+$", re.I)
-subject_sequence_pattern = re.compile(r"Sbjct\s+(\d+)\s+(\w+)\s+(\d+)", re.I)
+query_sequence_pattern = re.compile(r"^Query\s+\d+\s+(\S+)", re.I)
+subject_sequence_pattern = re.compile(
+    r"^Sbjct\s+(\d+)\s+(\S+)\s+(\d+)", re.I)
 
 
-def find_mutation(blast_result_path: str, mutations: List[str]) -> List[str]:
+def parse_blast_hsps(blast_result_path: str) -> List[dict]:
     """
-    Finds the requested mutations from a BLAST result.
+    Reads the HSPs of a BLAST pairwise result, joining the alignment blocks
+    of each HSP into whole query and subject strings.
 
     Args:
         blast_result_path (str): The BLAST result path.
-        mutations (List[str]): The list of mutations to find.
 
     Returns:
-        List[str]: A list of the found mutations.
+        List[dict]: One dictionary per HSP with the subject name and length,
+        the alignment length and identity, the aligned sequences and the
+        subject start and end.
     """
     try:
         with open(blast_result_path, "r") as infile:
@@ -29,92 +32,164 @@ def find_mutation(blast_result_path: str, mutations: List[str]) -> List[str]:
     except FileNotFoundError:
         raise FileNotFoundError(f"File {blast_result_path} not open.")
 
+    hsps: List[dict] = []
     sbjct = None
     sbjct_length = 0
-    identities_total = 0
-    perc_identity = 0
-    query_sequence = []
-    subject_sequence = []
-    result = []
-    alignment_sequence = []
-    position = 0
-    test = 0
+    hsp: dict = {}
 
     for line in lines:
-        # Identify the subject
         sbjct_match = sbjct_pattern.search(line)
         if sbjct_match:
             sbjct = sbjct_match.group(1)
+            continue
 
-        # Identify the length of the subject sequence
         sbjct_length_match = sbjct_length_pattern.search(line)
         if sbjct_length_match:
             sbjct_length = int(sbjct_length_match.group(1))
+            continue
 
-        # Identify identities
         identities_total_match = identities_total_pattern.search(line)
         perc_identity_match = perc_identity_pattern.search(line)
         if identities_total_match and perc_identity_match:
-            identities_total = int(identities_total_match.group(1))
-            perc_identity = int(perc_identity_match.group(1))
+            hsp = {"sbjct": sbjct,
+                   "sbjct_length": sbjct_length,
+                   "identities_total": int(identities_total_match.group(1)),
+                   "perc_identity": int(perc_identity_match.group(1)),
+                   "query": [], "subject": [], "start": 0, "end": 0}
+            hsps.append(hsp)
+            continue
 
-            # Check for truncation
-            if (identities_total < (sbjct_length / 100) * 90) \
-                    and (perc_identity > 80):
-                mutation = (f"{sbjct} truncation: "
-                            f"{identities_total}/{sbjct_length},")
-                result.append(mutation)
+        if not hsp:
+            continue
 
-        # Identify query sequence line
         query_sequence_match = query_sequence_pattern.search(line)
-        if query_sequence_match and perc_identity > 90:
-            query_sequence = list(query_sequence_match.group(1).strip())
-
-        # Identify alignment line
-        alignment_sequence_match = alignment_sequence_pattern.search(line)
-        if alignment_sequence_match and perc_identity > 90:
-            alignment_sequence = list(alignment_sequence_match.group())
+        if query_sequence_match:
+            hsp["query"].append(query_sequence_match.group(1))
+            continue
 
-        # Identify subject sequence line
         subject_sequence_match = subject_sequence_pattern.search(line)
-        if subject_sequence_match and perc_identity > 90:
-            subject_sequence = list(subject_sequence_match.group(2).strip())
-            subject_sequence_start = int(subject_sequence_match.group(1))
-            subject_sequence_end = int(subject_sequence_match.group(3))
+        if subject_sequence_match:
+            if not hsp["subject"]:
+                hsp["start"] = int(subject_sequence_match.group(1))
+            hsp["subject"].append(subject_sequence_match.group(2))
+            hsp["end"] = int(subject_sequence_match.group(3))
+
+    for hsp in hsps:
+        hsp["query"] = "".join(hsp["query"]).upper()
+        hsp["subject"] = "".join(hsp["subject"]).upper()
+    return hsps
+
+
+def aligned_residues(hsp: dict) -> Tuple[np.ndarray, np.ndarray,
+                                         np.ndarray]:
+    """
+    Converts an HSP into arrays of query residues, subject residues and the
+    subject position of every aligned column.
+    """
+    query = np.frombuffer(hsp["query"].encode(), dtype="S1")
+    subject = np.frombuffer(hsp["subject"].encode(), dtype="S1")
+    length = min(len(query), len(subject))
+    query, subject = query[:length], subject[:length]
+
+    step = -1 if hsp["start"] > hsp["end"] else 1
+    offsets = np.cumsum(subject != b"-") - 1
+    positions = hsp["start"] + step * offsets
+    return query, subject, positions
+
+
+def call_mutations(hsps: List[dict], mutations: List[str], sites: Sites,
+                   exhaustive=True) -> List[str]:
+    """
+    Calls the mutations of the requested genes. Only the catalog sites of
+    each gene are compared, unless exhaustive is set, in which case every
+    aligned column is, to report novel variants.
+
+    Args:
+        hsps (List[dict]): HSPs returned by parse_blast_hsps.
+        mutations (List[str]): The genes to check.
+        sites (Sites): Catalog positions of each gene.
+        exhaustive (bool): Reports every substitution of the genes.
+
+    Returns:
+        List[str]: The truncations and mutations found.
+    """
+    result = []
+    for hsp in hsps:
+        sbjct = hsp["sbjct"]
+        sbjct_length = hsp["sbjct_length"]
+        identities_total = hsp["identities_total"]
+        perc_identity = hsp["perc_identity"]
+
+        # Check for truncation
+        if (identities_total < (sbjct_length / 100) * 90) \
+                and (perc_identity > 80):
+            result.append(f"{sbjct} truncation: "
+                          f"{identities_total}/{sbjct_length},")
 
-            if subject_sequence_start == 1:
-                test = 1
+        if sbjct not in mutations or perc_identity <= 90 or \
+                identities_total <= (sbjct_length / 100) * 90:
+            continue
 
-            if test == 1:
-                for i in range(60):
-                    if i > len(query_sequence) - 1:
-                        break
-                    query_aa = query_sequence[i].upper()
-                    alignment_aa = alignment_sequence[i].upper()
-                    subject_aa = subject_sequence[i].upper()
+        gene_sites = sites.get(sbjct)
+        if not exhaustive and (gene_sites is None or not len(gene_sites)):
+            continue
 
-                    if query_aa != alignment_aa:
-                        if subject_sequence_start > subject_sequence_end:
-                            position = subject_sequence_start - i
-                        else:
-                            position = subject_sequence_start + i
+        query, subject, positions = aligned_residues(hsp)
+        changed = (query != subject) & (subject != b"-")
+        if not exhaustive:
+            changed &= np.isin(positions, gene_sites)
 
-                        if sbjct in mutations and query_aa != subject_aa:
-                            if identities_total > (sbjct_length / 100) * 90:
-                                mutation = (f"{sbjct}:{subject_aa}"
-                                            f"{position}{query_aa},")
-                                result.append(mutation)
+        for column in np.flatnonzero(changed):
+            result.append(f"{sbjct}:{subject[column].decode()}"
+                          f"{positions[column]}{query[column].decode()},")
 
-    return result
+    return list(dict.fromkeys(result))
 
 
-def find_acineto_mutations(blast_result_path: str) -> Tuple[List[str],
-                                                            List[str]]:
+def find_mutation(blast_result_path: str, mutations: List[str],
+                  sites: Union[Sites, None] = None,
+                  exhaustive=True) -> List[str]:
+    """
+    Finds the requested mutations from a BLAST result.
+
+    Args:
+        blast_result_path (str): The BLAST result path.
+        mutations (List[str]): The list of mutations to find.
+        sites (Sites): Catalog positions of each gene.
+        exhaustive (bool): Reports every substitution of the genes.
+
+    Returns:
+        List[str]: A list of the found mutations.
+    """
+    return call_mutations(parse_blast_hsps(blast_result_path), mutations,
+                          sites or {}, exhaustive)
+
+
+def find_species_mutations(blast_result_path: str, species: str,
+                           other_mutations: List[str],
+                           poli_mutations: List[str], catalog_path="",
+                           exhaustive=True) -> Tuple[List[str], List[str]]:
+    hsps = parse_blast_hsps(blast_result_path)
+    sites = species_sites(species, catalog_path)
+    # Without a curated catalog only the exhaustive mode reports the
+    # substitutions of the panel genes
+    exhaustive = exhaustive or not catalog_path
+
+    other_result = call_mutations(hsps, other_mutations, sites, exhaustive)
+    poli_result = call_mutations(hsps, poli_mutations, sites, exhaustive)
+    return other_result, poli_result
+
+
+def find_acineto_mutations(
+        blast_result_path: str, catalog_path="",
+        exhaustive=True) -> Tuple[List[str], List[str]]:
     """
     Finds the requested mutations for Acineto sp from a BLAST result.
 
     Args:
         blast_result_path (str): The BLAST result path.
+        catalog_path (str): Curated catalog of the sites to check.
+        exhaustive (bool): Reports every substitution of the genes.
 
     Returns:
         Tuple[List[str], List[str]]: A tuple with the lists of the found
@@ -124,18 +199,21 @@ def find_acineto_mutations(blast_result_path: str) -> Tuple[List[str],
                        "AdeR", "CarO", "OmpA", "AdeL", "AdeS"]
     poli_mutations = ["PmrA", "PmrB", "LpxA", "LpxD", "LpxC"]
 
-    other_result = find_mutation(blast_result_path, other_mutations)
-    poli_result = find_mutation(blast_result_path, poli_mutations)
-    return other_result, poli_result
+    return find_species_mutations(blast_result_path, "Acinetobacter_baumannii",
+                                  other_mutations, poli_mutations,
+                                  catalog_path, exhaustive)
 
 
-def find_ecloacae_mutations(blast_result_path: str) -> Tuple[List[str],
-                                                             List[str]]:
+def find_ecloacae_mutations(
+        blast_result_path: str, catalog_path="",
+        exhaustive=True) -> Tuple[List[str], List[str]]:
     """
     Finds the requested mutations for Enterobacter cloacae from a BLAST result.
 
     Args:
         blast_result_path (str): The BLAST result path.
+        catalog_path (str): Curated catalog of the sites to check.
+        exhaustive (bool): Reports every substitution of the genes.
 
     Returns:
         Tuple[List[str], List[str]]: A tuple with the lists of the found
@@ -144,18 +222,21 @@ def find_ecloacae_mutations(blast_result_path: str) -> Tuple[List[str],
     other_mutations = ["GyrA", "ParC"]
     poli_mutations = ["PmrA", "PmrB", "MgrB", "PhoP", "PhoQ"]
 
-    other_result = find_mutation(blast_result_path, other_mutations)
-    poli_result = find_mutation(blast_result_path, poli_mutations)
-    return other_result, poli_result
+    return find_species_mutations(
+        blast_result_path, "Enterobacter_cloacae_subsp_cloacae",
+        other_mutations, poli_mutations, catalog_path, exhaustive)
 
 
-def find_kleb_mutations(blast_result_path: str) -> Tuple[List[str],
-                                                         List[str]]:
+def find_kleb_mutations(
+        blast_result_path: str, catalog_path="",
+        exhaustive=True) -> Tuple[List[str], List[str]]:
     """
     Finds the requested mutations for Klebsiella sp from a BLAST result.
 
     Args:
         blast_result_path (str): The BLAST result path.
+        catalog_path (str): Curated catalog of the sites to check.
+        exhaustive (bool): Reports every substitution of the genes.
 
     Returns:
         Tuple[List[str], List[str]]: A tuple with the lists of the found
@@ -164,18 +245,21 @@ def find_kleb_mutations(blast_result_path: str) -> Tuple[List[str],
     other_mutations = ["GyrA", "GyrB", "ParC", "AcrR", "RamR"]
     poli_mutations = ["PmrB", "PmrA", "MgrB", "PhoP", "PhoQ"]
 
-    other_result = find_mutation(blast_result_path, other_mutations)
-    poli_result = find_mutation(blast_result_path, poli_mutations)
-    return other_result, poli_result
+    return find_species_mutations(blast_result_path, "klebsiellapneumoniae",
+                                  other_mutations, poli_mutations,
+                                  catalog_path, exhaustive)
 
 
-def find_pseudo_mutations(blast_result_path: str) -> Tuple[List[str],
-                                                           List[str]]:
+def find_pseudo_mutations(
+        blast_result_path: str, catalog_path="",
+        exhaustive=True) -> Tuple[List[str], List[str]]:
     """
     Finds the requested mutations for Pseudomonas sp from a BLAST result.
 
     Args:
         blast_result_path (str): The BLAST result path.
+        catalog_path (str): Curated catalog of the sites to check.
+        exhaustive (bool): Reports every substitution of the genes.
 
     Returns:
         Tuple[List[str], List[str]]: A tuple with the lists of the found
@@ -186,6 +270,6 @@ def find_pseudo_mutations(blast_result_path: str) -> Tuple[List[str],
     poli_mutations = ["PmrA", "PmrB", "PhoQ",
                       "ParR", "ParS", "CrpS", "ColR", "ColS"]
 
-    other_result = find_mutation(blast_result_path, other_mutations)
-    poli_result = find_mutation(blast_result_path, poli_mutations)
-    return other_result, poli_result
+    return find_species_mutations(blast_result_path, "pseudomonasaeruginosa",
+                                  other_mutations, poli_mutations,
+                                  catalog_path, exhaustive)
@@ -0,0 +1,90 @@
+from time import sleep, time
+from itertools import groupby
+from typing import List, Tuple
+from src.models.NotificationOutbox import NotificationOutbox
+from src.models.PipelineConfig import PipelineConfig
+from src.utils.send_email import send_email, read_template
+
+
+def build_message(notifications: list,
+                  template_email_path: str) -> Tuple[str, str]:
+    """
+    Builds the subject and body of a message. Several pending notifications
+    for the same recipient are merged into a single digest.
+
+    Args:
+        notifications (list): Outbox rows of a single recipient.
+        template_email_path (str): Directory of the e-mail templates.
+
+    Returns:
+        Tuple[str, str]: Subject and body of the message.
+    """
+    if len(notifications) == 1:
+        notification = notifications[0]
+        return notification["subject"], \
+            read_template(notification["template"], template_email_path)
+
+    samples = [str(notification["sample"]) for notification in notifications
+               if notification["sample"] is not None]
+    templates = sorted({notification["template"]
+                        for notification in notifications})
+    body = "\n\n".join(read_template(template, template_email_path)
+                       for template in templates)
+    subject = f"Análises concluídas ({len(notifications)} amostras)"
+    if samples:
+        body += f"\n\nAmostras: {', '.join(samples)}\n"
+    return subject, body
+
+
+def drain_outbox(outbox: NotificationOutbox,
+                 config: PipelineConfig) -> List[int]:
+    """
+    Sends the pending notifications of the outbox once. Notifications of the
+    same recipient are held for digest_window seconds and then sent as one
+    digest. Failed deliveries are retried with exponential backoff until
+    max_attempts is reached. The rate limit, digest window and retry
+    settings come from the NOTIFICATION_* fields of the configuration.
+
+    Args:
+        outbox (NotificationOutbox): Outbox to drain.
+        config (PipelineConfig): Pipeline configuration.
+
+    Returns:
+        List[int]: Identifiers of the notifications sent.
+    """
+    sent: List[int] = []
+    max_per_minute = config.notification_rate_limit
+    digest_window = config.notification_digest_window
+    interval = 60 / max_per_minute if max_per_minute > 0 else 0
+    last_sent = 0.
+
+    pending = outbox.pending()
+    for recipient, group in groupby(pending,
+                                    key=lambda row: row["recipient"]):
+        notifications = list(group)
+        ids = [notification["id"] for notification in notifications]
+
+        if time() - outbox.oldest_pending(recipient) < digest_window:
+            continue
+
+        wait = interval - (time() - last_sent)
+        if wait > 0:
+            sleep(wait)
+
+        try:
+            subject, body = build_message(notifications,
+                                          config.template_email_path)
+            send_email(config, recipient, subject, body)
+            outbox.mark_sent(ids)
+            sent.extend(ids)
+        except Exception as e:
+            attempts = max(notification["attempts"]
+                           for notification in notifications)
+            outbox.mark_failed(
+                ids, str(e),
+                config.notification_retry_delay * 2 ** attempts,
+                config.notification_max_attempts)
+            print(f"Failed to notify {recipient}.\n\n{e}")
+        last_sent = time()
+
+    return sent
@@ -0,0 +1,179 @@
+import os
+from shutil import which
+from dataclasses import replace
+from subprocess import run, TimeoutExpired
+from typing import Dict, List
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ReferenceDatabases import ReferenceDatabases
+from src.utils.handle_databases import missing_blast_indexes
+
+required_programs = ["abricate", "mlst", "kraken2", "unicycler", "fastani",
+                     "prokka", "checkm", "blastx"]
+required_databases = ["polimyxin_db", "outhers_db", "kraken_db",
+                      "fastani_db", "reference_gene_catalog"]
+blast_databases = ["polimyxin_db", "outhers_db"]
+# Optional programs replaced by a slower built-in path when missing
+fallback_programs = ["pigz"]
+writable_directories = ["uploaded_sequences_path", "fastqc_output_path",
+                        "log_path"]
+
+
+def resolve_executable(program: str) -> str:
+    """
+    Resolves a program name or path to the absolute path of an executable.
+
+    Returns:
+        str: The absolute path, or an empty string when it is not found.
+    """
+    if not program:
+        return ""
+    return which(program) or ""
+
+
+def tool_version(executable: str) -> str:
+    """
+    Asks a tool for its version, trying the usual flags.
+
+    Returns:
+        str: The first line of the version output, or "unknown".
+    """
+    for flag in ("--version", "-version", "-h"):
+        try:
+            result = run([executable, flag], capture_output=True, text=True,
+                         timeout=60)
+        except (OSError, TimeoutExpired):
+            continue
+
+        output = (result.stdout or "") + (result.stderr or "")
+        lines = [line.strip() for line in output.splitlines()
+                 if line.strip()]
+        if lines and result.returncode == 0:
+            return lines[0]
+    return "unknown"
+
+
+def preflight(config: PipelineConfig) -> PipelineConfig:
+    """
+    Validates the configuration once, before any sample is touched: resolves
+    every executable, checks the databases and the writable directories and
+    caches the tool versions.
+
+    Args:
+        config (PipelineConfig): Configuration loaded from the environment.
+
+    Raises:
+        ValueError: Listing every problem found.
+
+    Returns:
+        PipelineConfig: The configuration with absolute executable paths and
+        tool versions.
+    """
+    errors: List[str] = []
+    resolved: Dict[str, str] = {}
+
+    programs = list(required_programs)
+    if config.qc_engine == "fastqc":
+        programs.append("fastqc")
+    optional_programs = [program for program in ("fastqc", "spades",
+                                                 "makeblastdb", "pigz")
+                         if program not in programs]
+
+    for program in programs:
+        executable = resolve_executable(getattr(config, program))
+        if executable:
+            resolved[program] = executable
+        else:
+            errors.append(f"Executable for {program} not found: "
+                          f"'{getattr(config, program)}'.")
+
+    for program in optional_programs:
+        executable = resolve_executable(getattr(config, program))
+        if executable:
+            resolved[program] = executable
+        elif program in fallback_programs:
+            resolved[program] = ""
+        elif getattr(config, program):
+            errors.append(f"Executable for {program} not found: "
+                          f"'{getattr(config, program)}'.")
+
+    databases = ReferenceDatabases(config.reference_db_root) \
+        if config.reference_db_root else None
+    database_names = list(required_databases)
+    database_names += [database for database in ("abricate_db",
+                                                 "mutation_catalog")
+                       if getattr(config, database)]
+
+    for database in database_names:
+        # Managed databases are checked against their manifest; the size
+        # check is cheap, full checksums are left to reference_db_main.py
+        if databases and databases.current_version(database):
+            errors.extend(databases.verify(database, full=False))
+            continue
+
+        database_path = getattr(config, database)
+        if not database_path or not os.path.exists(database_path):
+            errors.append(f"Database {database} not found: "
+                          f"'{database_path}'.")
+        elif database in blast_databases:
+            for fasta in missing_blast_indexes(database_path):
+                errors.append(f"No BLAST index for {fasta}, run "
+                              "'python3 reference_db_main.py index'.")
+
+    for directory in writable_directories:
+        directory_path = getattr(config, directory)
+        if not directory_path:
+            errors.append(f"Directory {directory} is not defined.")
+            continue
+        if directory == "log_path":
+            os.makedirs(directory_path, exist_ok=True)
+        if not os.path.isdir(directory_path):
+            errors.append(f"Directory {directory} not found: "
+                          f"'{directory_path}'.")
+        elif not os.access(directory_path, os.W_OK):
+            errors.append(f"Directory {directory} is not writable: "
+                          f"'{directory_path}'.")
+
+    if config.result_backend not in ("mongo", "sqlite", "file"):
+        errors.append(f"Unknown RESULT_BACKEND '{config.result_backend}', "
+                      "use 'mongo', 'sqlite' or 'file'.")
+    elif config.result_backend != "mongo" and not config.result_path:
+        errors.append(f"RESULT_PATH is required by the "
+                      f"{config.result_backend} result backend.")
+
+    journal_dir = os.path.dirname(os.path.abspath(
+        config.result_journal_path)) if config.result_journal_path else ""
+    if journal_dir and not os.access(journal_dir, os.W_OK):
+        errors.append(f"Directory of RESULT_JOURNAL_PATH is not writable: "
+                      f"'{journal_dir}'.")
+
+    # Catalogued sites only are a subset of what the exhaustive mode reports,
+    # so the catalog has to be a curated one
+    if not config.mutation_exhaustive and not config.mutation_catalog and \
+            not (databases and databases.current_version("mutation_catalog")):
+        errors.append("MUTATION_EXHAUSTIVE=false needs a curated "
+                      "MUTATION_CATALOG of the sites to check.")
+
+    if config.qc_engine not in ("fastqc", "native"):
+        errors.append(f"Unknown QC_ENGINE '{config.qc_engine}', use "
+                      "'fastqc' or 'native'.")
+
+    if config.checkm_mode not in ("lineage", "taxonomy"):
+        errors.append(f"Unknown CHECKM_MODE '{config.checkm_mode}', use "
+                      "'lineage' or 'taxonomy'.")
+
+    if not os.path.isabs(config.outbox_database()):
+        errors.append("NOTIFICATION_OUTBOX_PATH resolves to the relative "
+                      f"path '{config.outbox_database()}', make it or "
+                      "LOG_PATH absolute.")
+
+    if config.template_email_path and not os.path.isfile(os.path.join(
+            config.template_email_path, "analysisFinish.template")):
+        errors.append("E-mail template analysisFinish.template not found in "
+                      f"'{config.template_email_path}'.")
+
+    if errors:
+        raise ValueError("Preflight failed:\n" + "\n".join(errors))
+
+    versions = {program: tool_version(executable)
+                for program, executable in resolved.items() if executable}
+    return replace(config, tool_versions=versions, **resolved)
@@ -1,8 +1,10 @@
 import re
+import os
 from os import path
+from glob import glob
 from collections import Counter
-from typing import List, Tuple, Union
-from src.utils.handle_programs import run_blastx
+from typing import Dict, List, Tuple, Union
+from src.utils.handle_programs import run_blastx, blastx_outfile
 from src.types.SpeciesDict import SpeciesDict
 from src.types.BacteriaDict import BacteriaDict
 from src.utils.handle_mutations import find_acineto_mutations, \
@@ -14,6 +16,14 @@ choose_analysis = {"pseudomonasaeruginosa": find_pseudo_mutations,
                    find_ecloacae_mutations,
                    "Acinetobacter_baumannii": find_acineto_mutations}
 
+# Species named by fastANI whose databases are those of a species group
+mutation_species_groups = {"Acinetobacter_baumannii": "acinetobacter_species",
+                           "Enterobacter_cloacae_subsp_cloacae":
+                           "enterobacter_species"}
+
+# Separates the sample from the contig name in batched BLASTx queries
+sample_tag = "::"
+
 
 def run_blast_and_check_mutations(
         bacteria_dict: BacteriaDict) -> Tuple[List[str], List[str]]:
@@ -36,24 +46,187 @@ def run_blast_and_check_mutations(
         poli_db_path = bacteria_dict["poli_db_path"]
         others_outfile_suffix = bacteria_dict["others_outfile_suffix"]
         poli_outfile_suffix = bacteria_dict["poli_outfile_suffix"]
+        blastx = bacteria_dict.get("blastx") or "blastx"
+        catalog_path = bacteria_dict.get("mutation_catalog", "")
+        exhaustive = bacteria_dict.get("mutation_exhaustive", True)
+        # Left to a later batch over the samples of the species
+        if bacteria_dict.get("mutation_deferred"):
+            return [], []
 
         others_blast_result = run_blastx(
-            assembly_file, others_db_path, sample, others_outfile_suffix)
+            assembly_file, others_db_path, sample, others_outfile_suffix,
+            blastx)
         poli_blast_result = run_blastx(assembly_file, poli_db_path,
-                                       sample, poli_outfile_suffix)
+                                       sample, poli_outfile_suffix, blastx)
 
         analysis = choose_analysis.get(species, None)
         if not analysis:
             raise Exception(f"Invalid species {species}!")
 
-        others_mutations_result, _ = analysis(others_blast_result)
-        _, poli_mutations_result = analysis(poli_blast_result)
+        others_mutations_result, _ = analysis(others_blast_result,
+                                              catalog_path, exhaustive)
+        _, poli_mutations_result = analysis(poli_blast_result,
+                                            catalog_path, exhaustive)
 
         return others_mutations_result, poli_mutations_result
     except Exception as e:
         raise Exception(f"Failed to run blast and check mutations.\n\n{e}")
 
 
+def tag_assemblies(bacteria_dicts: List[BacteriaDict], query_file: str):
+    """
+    Concatenates the assemblies of several samples into one query file,
+    prefixing every contig name with its sample.
+    """
+    with open(query_file, "w") as outfile:
+        for bacteria_dict in bacteria_dicts:
+            with open(bacteria_dict["assembly_file"]) as infile:
+                for line in infile:
+                    if line.startswith(">"):
+                        line = (f">{bacteria_dict['sample']}{sample_tag}"
+                                f"{line[1:]}")
+                    outfile.write(line)
+
+
+def demultiplex_blast_result(batch_result: str, outfiles: Dict[str, str]):
+    """
+    Splits a batched BLASTx result into one result per sample, with the
+    original contig names, in the same layout as a single-sample run.
+
+    Args:
+        batch_result (str): BLASTx result of a tagged query file.
+        outfiles (Dict[str, str]): Result path of each sample.
+    """
+    header: List[str] = []
+    sections: Dict[str, List[str]] = {}
+    current = None
+
+    with open(batch_result) as infile:
+        for line in infile:
+            if line.startswith("Query="):
+                title = line[len("Query="):].strip()
+                sample, _, contig = title.partition(sample_tag)
+                current = sections.setdefault(sample, [])
+                line = f"Query= {contig}\n"
+            (header if current is None else current).append(line)
+
+    for sample, outfile_path in outfiles.items():
+        with open(outfile_path, "w") as outfile:
+            outfile.writelines(header + sections.get(sample, []))
+
+
+def run_batch_blast_and_check_mutations(
+        bacteria_dicts: List[BacteriaDict],
+        batch_dir: str) -> Dict[str, Tuple[List[str], List[str]]]:
+    """
+    Batch mode of run_blast_and_check_mutations for bulk reprocessing. The
+    assemblies of the samples of each species are searched with a single
+    BLASTx per database, so the program start and the database loading are
+    paid once per batch; the results are demultiplexed per sample before
+    the mutation detection.
+
+    Args:
+        bacteria_dicts (List[BacteriaDict]): One dictionary per sample.
+        batch_dir (str): Directory of the batched queries and results.
+
+    Returns:
+        Dict[str, Tuple[List[str], List[str]]]: The other and polymyxin
+        mutations of each sample.
+    """
+    groups: Dict[tuple, List[BacteriaDict]] = {}
+    for bacteria_dict in bacteria_dicts:
+        key = (bacteria_dict["species"], bacteria_dict["others_db_path"],
+               bacteria_dict["poli_db_path"],
+               bacteria_dict.get("blastx") or "blastx")
+        groups.setdefault(key, []).append(bacteria_dict)
+
+    os.makedirs(batch_dir, exist_ok=True)
+    results: Dict[str, Tuple[List[str], List[str]]] = {}
+    for (species, others_db_path, poli_db_path, blastx), group in \
+            groups.items():
+        try:
+            analysis = choose_analysis.get(species, None)
+            if not analysis:
+                raise Exception(f"Invalid species {species}!")
+
+            query_file = path.join(batch_dir, f"{species}_query.fasta")
+            tag_assemblies(group, query_file)
+            batch_files = [query_file]
+
+            for db_path, suffix in ((others_db_path, "others_outfile_suffix"),
+                                    (poli_db_path, "poli_outfile_suffix")):
+                batch_result = run_blastx(
+                    query_file, db_path, species,
+                    path.join(batch_dir, path.basename(group[0][suffix])),
+                    blastx)
+                batch_files.append(batch_result)
+                demultiplex_blast_result(
+                    batch_result,
+                    {bacteria_dict["sample"]: blastx_outfile(
+                        bacteria_dict["sample"], bacteria_dict[suffix])
+                     for bacteria_dict in group})
+
+            for bacteria_dict in group:
+                sample = bacteria_dict["sample"]
+                catalog_path = bacteria_dict.get("mutation_catalog", "")
+                exhaustive = bacteria_dict.get("mutation_exhaustive", True)
+                others_mutations_result, _ = analysis(
+                    blastx_outfile(sample,
+                                   bacteria_dict["others_outfile_suffix"]),
+                    catalog_path, exhaustive)
+                _, poli_mutations_result = analysis(
+                    blastx_outfile(sample,
+                                   bacteria_dict["poli_outfile_suffix"]),
+                    catalog_path, exhaustive)
+                results[sample] = (others_mutations_result,
+                                   poli_mutations_result)
+
+            for batch_file in batch_files:
+                os.remove(batch_file)
+        except Exception as e:
+            raise Exception(
+                f"Failed to run batched blast for {species}.\n\n{e}")
+
+    return results
+
+
+def build_bacteria_dict(species_info: SpeciesDict,
+                        species: str) -> Union[BacteriaDict, None]:
+    """
+    Builds the BLASTx mutation search of a sample.
+
+    Args:
+        species_info (SpeciesDict): Sample, assembly and database paths.
+        species (str): Species key of choose_analysis.
+
+    Returns:
+        Union[BacteriaDict, None]: The search, or None when the species has
+        no mutation databases.
+    """
+    species_data = build_species_data(species_info)
+    desired_species_data = species_data.get(
+        mutation_species_groups.get(species, species), {})
+    poli_fasta = desired_species_data.get("poli_fasta")
+    others_fasta = desired_species_data.get("others_fasta")
+    if not poli_fasta or not others_fasta:
+        return None
+
+    output_path = species_info.get("output_path")
+    return {"species": species,
+            "assembly_file": species_info.get("assembly"),
+            "sample": str(species_info.get("sample")),
+            "others_db_path": others_fasta,
+            "poli_db_path": poli_fasta,
+            "others_outfile_suffix": path.join(output_path, "blastOthers"),
+            "poli_outfile_suffix": path.join(output_path, "blastPoli"),
+            "blastx": species_info.get("blastx") or "blastx",
+            "mutation_catalog": species_info.get("mutation_catalog", ""),
+            "mutation_exhaustive":
+            species_info.get("mutation_exhaustive", True),
+            "mutation_deferred":
+            species_info.get("mutation_deferred", False)}
+
+
 def get_abricate_result(file_path: str) -> List[str]:
     """
     Processes Abricate result file and returns lines with identity > 90 and
@@ -95,6 +268,114 @@ def get_abricate_result(file_path: str) -> List[str]:
     return results
 
 
+def parse_prokka_gff(
+        gff_file: str) -> Dict[str, List[Tuple[int, int, str, str]]]:
+    """
+    Reads the annotated features of a Prokka GFF file.
+
+    Args:
+        gff_file (str): The path to the Prokka GFF file.
+
+    Returns:
+        Dict[str, List[Tuple[int, int, str, str]]]: Start, end, strand and
+        locus tag of the features of each contig.
+    """
+    features: Dict[str, List[Tuple[int, int, str, str]]] = {}
+
+    try:
+        with open(gff_file, "r") as infile:
+            for line in infile:
+                if line.startswith("##FASTA"):
+                    break
+                if line.startswith("#"):
+                    continue
+
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 9 or fields[2] == "gene":
+                    continue
+
+                attributes = dict(attribute.split("=", 1) for attribute
+                                  in fields[8].split(";") if "=" in attribute)
+                locus_tag = attributes.get("locus_tag")
+                if locus_tag:
+                    features.setdefault(fields[0], []).append(
+                        (int(fields[3]), int(fields[4]), fields[6],
+                         locus_tag))
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File {gff_file} not found")
+
+    return features
+
+
+def map_abricate_hits_to_features(
+        abricate_file: str,
+        features: Dict[str, List[Tuple[int, int, str, str]]]):
+    """
+    Rewrites an Abricate result obtained on the contigs so each hit names the
+    annotated feature it overlaps most, with coordinates relative to that
+    feature, as if it had been screened on the Prokka genes. Hits outside
+    any feature keep their contig coordinates.
+
+    Args:
+        abricate_file (str): The path to the Abricate result file.
+        features (Dict[str, List[Tuple[int, int, str, str]]]): Features
+        returned by parse_prokka_gff.
+    """
+    with open(abricate_file, "r") as infile:
+        lines = infile.readlines()
+
+    mapped_lines = []
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if line.startswith("#") or len(fields) < 11:
+            mapped_lines.append(line)
+            continue
+
+        try:
+            start, end = int(fields[2]), int(fields[3])
+        except ValueError:
+            mapped_lines.append(line)
+            continue
+
+        best_overlap = 0
+        best_feature = None
+        for feature in features.get(fields[1], []):
+            overlap = min(end, feature[1]) - max(start, feature[0]) + 1
+            if overlap > best_overlap:
+                best_overlap = overlap
+                best_feature = feature
+
+        if best_feature:
+            feature_start, feature_end, strand, locus_tag = best_feature
+            if strand == "-":
+                start, end = feature_end - end + 1, feature_end - start + 1
+            else:
+                start, end = start - feature_start + 1, \
+                    end - feature_start + 1
+            fields[1] = locus_tag
+            fields[2] = str(max(start, 1))
+            fields[3] = str(end)
+
+        mapped_lines.append("\t".join(fields) + "\n")
+
+    with open(abricate_file, "w") as outfile:
+        outfile.writelines(mapped_lines)
+
+
+def read_kraken_names(kraken_output: str) -> List[str]:
+    """
+    Returns the taxon name of every sequence of a Kraken result file
+    written with --use-names.
+    """
+    try:
+        with open(kraken_output) as infile:
+            return [line.split("\t")[2].split("(")[0].strip()
+                    for line in infile.readlines()
+                    if len(line.split("\t")) >= 3]
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File {kraken_output} not found")
+
+
 def count_kraken_words(kraken_output: str) -> Tuple[str, str, int, int]:
     """
     Processes Kraken result file and returns the two most common identified
@@ -106,14 +387,7 @@ def count_kraken_words(kraken_output: str) -> Tuple[str, str, int, int]:
     Returns:
         Tuple[str, str]: A tuple of the two most common bacteria species.
     """
-    try:
-        with open(kraken_output) as infile:
-            lines = [line.split("\t")[2].split("(")[0].strip()
-                     for line in infile.readlines()
-                     if len(line.split("\t")) >= 3]
-
-    except FileNotFoundError:
-        raise FileNotFoundError(f"File {kraken_output} not found")
+    lines = read_kraken_names(kraken_output)
 
     most_common_species = Counter(lines).most_common(2)
     first_most_common = most_common_species[0][0]
@@ -124,6 +398,61 @@ def count_kraken_words(kraken_output: str) -> Tuple[str, str, int, int]:
     return first_most_common, second_most_common, first_count, second_count
 
 
+def split_species_name(kraken_name: str) -> Tuple[str, str]:
+    """
+    Splits a Kraken taxon name into genus and species; a name without a
+    species, e.g. a genus call, keeps an empty species.
+    """
+    if re.findall(re.compile(r"\w+\s\w.*", re.I), kraken_name):
+        split_species = kraken_name.strip().split(" ")
+        return split_species[0], split_species[1]
+    return kraken_name, ""
+
+
+def species_key(kraken_name: str) -> str:
+    """
+    Turns a Kraken taxon name into the key of build_species_data, e.g.
+    "Klebsiella pneumoniae" into "klebsiellapneumoniae".
+    """
+    genus, species = split_species_name(kraken_name)
+    return f"{genus}{species}".lower()
+
+
+def species_reference_files(species_info: SpeciesDict,
+                            species: str) -> List[str]:
+    """
+    Lists the reference files the species-specific steps of a species will
+    read: its BLAST protein panels with their indexes, and the FastANI
+    reference list with the genomes it names.
+
+    Args:
+        species_info (SpeciesDict): Sample and database paths.
+        species (str): Key returned by species_key.
+
+    Returns:
+        List[str]: Existing files, empty for species without panels.
+    """
+    species_data = build_species_data(species_info)
+    entry = species_data.get(species)
+    if not entry:
+        for group in ("acinetobacter_species", "enterobacter_species"):
+            if group.split("_")[0] in species:
+                entry = species_data.get(group)
+    if not entry:
+        return []
+
+    files = []
+    for panel in ("poli_fasta", "others_fasta"):
+        if entry.get(panel):
+            files += [entry[panel]] + glob(f"{entry[panel]}.*")
+    fastani_list = entry.get("fastani_list")
+    if fastani_list and path.isfile(fastani_list):
+        with open(fastani_list) as infile:
+            files += [fastani_list] + [line.strip() for line in infile
+                                       if line.strip()]
+    return [file for file in files if path.isfile(file)]
+
+
 def build_species_data(species_info: SpeciesDict) -> dict:
     others_db_path = species_info.get("others_db_path")
     poli_db_path = species_info.get("poli_db_path")
@@ -208,25 +537,11 @@ def handle_species(species_info: SpeciesDict, species_data: dict) -> \
     desired_species_data = species_data.get(species)
 
     if desired_species_data:
-        assembly = species_info.get("assembly")
-        sample = species_info.get("sample")
-
         mlst_species = desired_species_data.get("mlst")
         print_species = desired_species_data.get("display_name")
-        poli_fasta = desired_species_data.get("poli_fasta")
-        others_fasta = desired_species_data.get("others_fasta")
-        output_path = species_info.get("output_path")
-
-        if poli_fasta and others_fasta:
-            bacteria_dict: BacteriaDict = {
-                "species": species,
-                "assembly_file": assembly,
-                "sample": str(sample),
-                "others_db_path": others_fasta,
-                "poli_db_path": poli_fasta,
-                "others_outfile_suffix": path.join(output_path, "blastOthers"),
-                "poli_outfile_suffix": path.join(output_path, "blastPoli")
-            }
+        bacteria_dict = build_bacteria_dict(species_info, species)
+
+        if bacteria_dict:
             return run_blast_and_check_mutations(bacteria_dict), \
                 print_species, mlst_species
     elif "acinetobacter" in species:
@@ -253,14 +568,16 @@ def identify_bacteria_species(species_info: SpeciesDict):
     return blast_result, display_name, mlst
 
 
-def process_resfinder(abricate_result: List[str]) -> Tuple[List[str],
-                                                           List[str]]:
+def process_resfinder(
+        abricate_result: List[str],
+        catalog_path: str) -> Tuple[List[str], List[str], List[str]]:
     gene_results = []
     blast_out_results = []
+    resistance_classes = []
     ref_list = []
 
     #open reference file add feed the list
-    with open("/cabgen/sequences_database/lista_ncbi_ReferenceGeneCatalog160725.txt") as f: #esse caminho precisa ser alterado de acordo com o servidor
+    with open(catalog_path) as f:
         for line in f: 
             line = line.strip() 
             ref_list.append(line.split("\t")) 
@@ -285,6 +602,7 @@ def process_resfinder(abricate_result: List[str]) -> Tuple[List[str],
                 #print(f"{fields[5]} {ref_item[-17]}")
                 gene_results.append(f"{gene} (resistance to {ref_item[-17].lower()}) "
                                     f"(allele confidence {id})")
+                resistance_classes.append(ref_item[-17].lower())
                 break
         else:
             gene_results.append(f"{gene} (allele confidence {id})")
@@ -292,7 +610,8 @@ def process_resfinder(abricate_result: List[str]) -> Tuple[List[str],
         blast_out = (f"{gene} (ID: {id} COV_Q: {cov_q} COV_DB: {cov_db})")
         blast_out_results.append(blast_out)
 
-    return gene_results, blast_out_results
+    return gene_results, blast_out_results, \
+        list(dict.fromkeys(resistance_classes))
 
 
 def process_vfdb(abricate_result: List[str]) -> List[str]:
@@ -342,37 +661,12 @@ def format_time(seconds: float) -> str:
 def handle_fastani_species(species_info: SpeciesDict,
                            fastani_species: str) -> Union[Tuple[List[str],
                                                           List[str]], None]:
+    if fastani_species not in mutation_species_groups:
+        return None
 
-    species_data = build_species_data(species_info)
-
-    species = fastani_species
-    assembly_file = species_info.get("assembly")
-    sample = str(species_info.get("sample"))
-    others_outfile_suffix = path.join(species_info.get("output_path"),
-                                      "blastOthers")
-    poli_outfile_suffix = path.join(species_info.get("output_path"),
-                                    "blastPoli")
-
-    fastani_species_dict = {"Acinetobacter_baumannii":
-                            species_data.get("acinetobacter_species", {}),
-                            "Enterobacter_cloacae_subsp_cloacae":
-                            species_data.get("enterobacter_species", {})}
-    species_dict = fastani_species_dict.get(fastani_species)
-
-    if species_dict:
-        others_db_path = species_dict.get("others_fasta", "")
-        poli_db_path = species_dict.get("poli_fasta", "")
-    else:
+    bacteria_dict = build_bacteria_dict(species_info, fastani_species)
+    if not bacteria_dict:
         return None
 
-    bacteria_dict: BacteriaDict = {
-        "species": species,
-        "assembly_file": assembly_file,
-        "sample": sample,
-        "others_db_path": others_db_path,
-        "poli_db_path": poli_db_path,
-        "others_outfile_suffix": others_outfile_suffix,
-        "poli_outfile_suffix": poli_outfile_suffix
-    }
     blast_result = run_blast_and_check_mutations(bacteria_dict)
     return blast_result
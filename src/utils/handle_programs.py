@@ -1,48 +1,173 @@
+import os
+import signal
 from os import path
-from subprocess import run, CalledProcessError
+from time import monotonic, sleep
+from threading import Event, Lock, local
+from subprocess import Popen, PIPE, TimeoutExpired
+from typing import Dict
+from src.utils.handle_trace import span
+
+# Seconds a killed tool gets to exit after SIGTERM before SIGKILL
+kill_grace_seconds = 10
+
+running_commands: Dict[int, Popen] = {}
+running_commands_lock = Lock()
+cancel_event = Event()
+timeout_event = Event()
+stage_deadline = local()
+
+
+class CommandTimeout(RuntimeError):
+    pass
+
+
+class CommandCancelled(RuntimeError):
+    pass
+
+
+def set_command_deadline(seconds: float):
+    """
+    Limits the commands started by the current thread to end within the
+    given seconds from now. Zero removes the limit.
+    """
+    stage_deadline.value = monotonic() + seconds if seconds > 0 else None
+
+
+def check_cancelled():
+    if cancel_event.is_set():
+        raise CommandCancelled("The task was cancelled.")
+
+
+def check_interrupted():
+    """
+    Raises when a command of the current task was cancelled or killed at
+    its stage deadline, also if the stage handled the error itself.
+    """
+    check_cancelled()
+    if timeout_event.is_set():
+        raise CommandTimeout("A stage of the task exceeded its timeout.")
+
+
+def kill_process_group(process: Popen):
+    """
+    Terminates a command and every process it spawned. The commands run in
+    their own session, so the whole tree shares the shell's process group.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+
+    deadline = monotonic() + kill_grace_seconds
+    try:
+        process.wait(timeout=kill_grace_seconds)
+        while monotonic() < deadline:
+            os.killpg(process.pid, 0)
+            sleep(0.2)
+        os.killpg(process.pid, signal.SIGKILL)
+    except (TimeoutExpired, PermissionError):
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def cancel_running_commands():
+    """
+    Kills the commands running in this process and refuses new ones until
+    reset_interruption is called.
+    """
+    cancel_event.set()
+    with running_commands_lock:
+        processes = list(running_commands.values())
+    for process in processes:
+        kill_process_group(process)
+
+
+def reset_interruption():
+    cancel_event.clear()
+    timeout_event.clear()
+
+
+def interruption() -> str:
+    """
+    Returns "cancelled" or "timeout" when a command of the current task was
+    killed, otherwise an empty string.
+    """
+    if cancel_event.is_set():
+        return "cancelled"
+    return "timeout" if timeout_event.is_set() else ""
 
 
 def run_command_line(command_line: str) -> str:
     """
-    Executes a generic program in the terminal.
+    Executes a generic program in the terminal. The command is killed with
+    all its children when the deadline of the calling thread passes or the
+    task is cancelled.
 
     Args:
         command_line (str): Command to be executed.
 
     Returns:
         str: Command line output.
+
+    Raises:
+        CommandTimeout: The stage deadline passed.
+        CommandCancelled: The task was cancelled.
     """
     if not command_line:
         raise ValueError("The command_line argument cannot be empty.")
 
-    try:
-        result = run(
-            command_line,
-            shell=True,
-            check=True,
-            text=True,
-            capture_output=True
-        )
+    check_cancelled()
+    deadline = getattr(stage_deadline, "value", None)
+    if deadline is not None and deadline <= monotonic():
+        timeout_event.set()
+        raise CommandTimeout(f"Command '{command_line}' not started, the "
+                             "stage timeout has passed.")
 
-        if result.returncode != 0:
-            raise RuntimeError(
-                f"Command '{command_line}' failed with error: {result.stderr}")
+    program = path.basename(command_line.split()[0])
+    with span(program, "subprocess", command=command_line[:500]):
+        try:
+            process = Popen(command_line, shell=True, text=True, stdout=PIPE,
+                            stderr=PIPE, start_new_session=True)
+        except Exception as error:
+            raise RuntimeError(f"An error occurred: {error}")
 
-        return result.stdout
+        with running_commands_lock:
+            running_commands[process.pid] = process
+        try:
+            timeout = deadline - monotonic() if deadline is not None \
+                else None
+            stdout, stderr = process.communicate(timeout=timeout)
+        except TimeoutExpired:
+            kill_process_group(process)
+            process.communicate()
+            timeout_event.set()
+            raise CommandTimeout(f"Command '{command_line}' exceeded the "
+                                 "stage timeout and was killed.")
+        finally:
+            with running_commands_lock:
+                running_commands.pop(process.pid, None)
 
-    except CalledProcessError as error:
+    check_cancelled()
+    if process.returncode != 0:
         raise RuntimeError(
-            f"Command '{error.cmd}' failed with return code "
-            f"{error.returncode}. Output: {error.output}. "
-            f"Error: {error.stderr}."
-        )
+            f"Command '{command_line}' failed with return code "
+            f"{process.returncode}. Output: {stdout}. "
+            f"Error: {stderr}.")
+    return stdout
+
 
-    except Exception as error:
-        raise RuntimeError(f"An error occurred: {error}")
+def blastx_outfile(sample: str, outfile_suffix: str) -> str:
+    """
+    Returns the path of the BLASTx result of a sample, next to the suffix.
+    """
+    outfile = f"{sample}_{path.basename(outfile_suffix)}"
+    dirname = path.dirname(path.abspath(outfile_suffix))
+    return path.join(dirname, outfile)
 
 
 def run_blastx(contig_file: str, blast_db_path: str, sample: str,
-               outfile_suffix: str) -> str:
+               outfile_suffix: str, blastx="blastx") -> str:
     """
     Executes the BLASTx program with the specified parameters and returns the
     path to the resulting output file.
@@ -56,19 +181,13 @@ def run_blastx(contig_file: str, blast_db_path: str, sample: str,
         identification purposes.
         outfile_suffix (str): Suffix to append to the output file name for
         distinction.
+        blastx (str): BLASTx executable.
 
     Returns:
         str: Path to the output file generated by BLASTx.
     """
-    outfile = f"{sample}_{path.basename(outfile_suffix)}"
-    dirname = path.dirname(path.abspath(outfile_suffix))
-
-    outfile_path = path.join(dirname, outfile)
-    command_line = (f"blastx -db {blast_db_path} -query {contig_file}"
+    outfile_path = blastx_outfile(sample, outfile_suffix)
+    command_line = (f"{blastx} -db {blast_db_path} -query {contig_file}"
                     f" -evalue 0.001 -out {outfile_path}")
-    try:
-        run(command_line, shell=True)
-    except Exception as error:
-        raise Exception(f"An error occurred: {error}")
-
+    run_command_line(command_line)
     return outfile_path
@@ -0,0 +1,432 @@
+import re
+import json
+import numpy as np
+from os import path, makedirs
+from collections import Counter
+from typing import IO, Dict, List, Tuple
+from src.utils.handle_reads import open_fastq
+
+PHRED_OFFSET = 33
+MAX_QUALITY = 94
+DUPLICATION_TRACKED = 100000
+ADAPTERS = {"Illumina Universal Adapter": "AGATCGGAAGAG",
+            "Nextera Transposase Sequence": "CTGTCTCTTATA"}
+MODULES = ["Basic Statistics", "Per base sequence quality",
+           "Per sequence quality scores", "Per base sequence content",
+           "Per sequence GC content", "Per base N content",
+           "Sequence Length Distribution", "Sequence Duplication Levels",
+           "Overrepresented sequences", "Adapter Content"]
+
+
+def grade(value: float, warn: float, error: float,
+          higher_is_worse: bool = True) -> str:
+    """
+    Grades a module value against the FastQC default limits.
+
+    Args:
+        value (float): Measured value.
+        warn (float): Warning limit.
+        error (float): Failure limit.
+        higher_is_worse (bool): Whether values above the limits are bad.
+
+    Returns:
+        str: "pass", "warn" or "fail".
+    """
+    if not higher_is_worse:
+        value, warn, error = -value, -warn, -error
+    if value > error:
+        return "fail"
+    if value > warn:
+        return "warn"
+    return "pass"
+
+
+def histogram_quantile(histogram: np.ndarray, fraction: float) -> np.ndarray:
+    """
+    Returns the quantile of each row of a (position, value) histogram.
+    """
+    totals = histogram.sum(axis=1, keepdims=True)
+    cumulative = histogram.cumsum(axis=1)
+    return (cumulative < totals * fraction).sum(axis=1)
+
+
+class FastqStats:
+    """
+    Accumulates the core FastQC modules for one FASTQ file, chunk by chunk.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.filename = path.basename(file_path)
+        self.total = 0
+        self.min_quality = MAX_QUALITY
+        self.max_length = 0
+        self.base_counts = {base: np.zeros(0, dtype=np.int64)
+                            for base in "ACGTN"}
+        self.quality_histogram = np.zeros((0, MAX_QUALITY), dtype=np.int64)
+        self.read_quality_histogram = np.zeros(MAX_QUALITY, dtype=np.int64)
+        self.gc_histogram = np.zeros(101, dtype=np.float64)
+        self.length_counts: Counter = Counter()
+        self.sequence_counts: Counter = Counter()
+        self.adapter_starts = {name: np.zeros(0, dtype=np.int64)
+                               for name in ADAPTERS}
+
+    def _grow(self, length: int):
+        extra = length - self.max_length
+        if extra <= 0:
+            return
+        for base in self.base_counts:
+            self.base_counts[base] = np.pad(self.base_counts[base],
+                                            (0, extra))
+        for name in self.adapter_starts:
+            self.adapter_starts[name] = np.pad(self.adapter_starts[name],
+                                               (0, extra))
+        self.quality_histogram = np.pad(self.quality_histogram,
+                                        ((0, extra), (0, 0)))
+        self.max_length = length
+
+    def add_chunk(self, sequences: List[str], qualities: List[str]):
+        """
+        Adds a chunk of reads to the accumulated statistics.
+
+        Args:
+            sequences (List[str]): Read sequences.
+            qualities (List[str]): Read quality strings.
+        """
+        reads = len(sequences)
+        if not reads:
+            return
+
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64,
+                              count=reads)
+        self._grow(int(lengths.max()))
+        self.total += reads
+        self.length_counts.update(lengths.tolist())
+
+        bases = np.frombuffer("".join(sequences).upper().encode("ascii"),
+                              dtype=np.uint8)
+        quality = np.frombuffer("".join(qualities).encode("ascii"),
+                                dtype=np.uint8).astype(np.int64)
+        quality = np.clip(quality - PHRED_OFFSET, 0, MAX_QUALITY - 1)
+        if quality.size:
+            self.min_quality = min(self.min_quality, int(quality.min()))
+
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        rows = np.repeat(np.arange(reads), lengths)
+        columns = np.arange(bases.size) - np.repeat(offsets, lengths)
+
+        for base in self.base_counts:
+            mask = bases == ord(base)
+            self.base_counts[base] += np.bincount(
+                columns[mask], minlength=self.max_length)
+
+        self.quality_histogram += np.bincount(
+            columns * MAX_QUALITY + quality,
+            minlength=self.max_length * MAX_QUALITY
+        ).reshape(self.max_length, MAX_QUALITY)
+
+        safe_lengths = np.maximum(lengths, 1)
+        read_quality = np.bincount(rows, weights=quality,
+                                   minlength=reads) / safe_lengths
+        self.read_quality_histogram += np.bincount(
+            np.rint(read_quality).astype(np.int64), minlength=MAX_QUALITY
+        )[:MAX_QUALITY]
+
+        gc_mask = (bases == ord("G")) | (bases == ord("C"))
+        read_gc = np.bincount(rows, weights=gc_mask,
+                              minlength=reads).astype(np.int64)
+        self._add_gc(read_gc, lengths)
+
+        self._add_adapters(sequences, offsets)
+        self._add_duplicates(sequences)
+
+    def _add_gc(self, read_gc: np.ndarray, lengths: np.ndarray):
+        """
+        Spreads each read over the percentage bins its GC count interval
+        overlaps, so read lengths that do not divide 100 do not leave a comb
+        pattern in the distribution.
+        """
+        pairs, counts = np.unique(np.stack([read_gc, lengths]), axis=1,
+                                  return_counts=True)
+        bin_edges = np.arange(102) - 0.5
+        for (gc_count, length), count in zip(pairs.T.tolist(),
+                                             counts.tolist()):
+            if not length:
+                continue
+            low = max((gc_count - 0.5) / length * 100, -0.5)
+            high = min((gc_count + 0.5) / length * 100, 100.5)
+            overlap = np.clip(np.minimum(bin_edges[1:], high) -
+                              np.maximum(bin_edges[:-1], low), 0, None)
+            self.gc_histogram += overlap / overlap.sum() * count
+
+    def _add_adapters(self, sequences: List[str], offsets: np.ndarray):
+        joined = "\n".join(sequences).upper()
+        line_offsets = offsets + np.arange(len(sequences))
+
+        for name, adapter in ADAPTERS.items():
+            starts = np.fromiter((match.start() for match in
+                                  re.finditer(adapter, joined)),
+                                 dtype=np.int64)
+            if not starts.size:
+                continue
+            read_index = np.searchsorted(line_offsets, starts,
+                                         side="right") - 1
+            first_hit = {}
+            for index, start in zip(read_index.tolist(), starts.tolist()):
+                first_hit.setdefault(index, start - line_offsets[index])
+            self.adapter_starts[name] += np.bincount(
+                list(first_hit.values()), minlength=self.max_length)
+
+    def _add_duplicates(self, sequences: List[str]):
+        counts = self.sequence_counts
+        for sequence in sequences:
+            key = sequence[:50] if len(sequence) > 75 else sequence
+            if key in counts or len(counts) < DUPLICATION_TRACKED:
+                counts[key] += 1
+
+    def summary(self) -> Tuple[Dict[str, str], Dict[str, list]]:
+        """
+        Grades every module and builds the tables of fastqc_data.txt.
+
+        Returns:
+            Tuple[Dict[str, str], Dict[str, list]]: Module statuses and
+            module tables.
+        """
+        statuses: Dict[str, str] = {}
+        tables: Dict[str, list] = {}
+        total = max(self.total, 1)
+        positions = np.arange(1, self.max_length + 1)
+
+        total_bases = sum(int(counts.sum())
+                          for counts in self.base_counts.values())
+        gc_bases = int(self.base_counts["G"].sum() +
+                       self.base_counts["C"].sum())
+        lengths = sorted(self.length_counts)
+        encoding = "Sanger / Illumina 1.9" \
+            if self.min_quality + PHRED_OFFSET < 64 else "Illumina 1.5"
+        statuses["Basic Statistics"] = "pass"
+        tables["Basic Statistics"] = [
+            ["#Measure", "Value"], ["Filename", self.filename],
+            ["File type", "Conventional base calls"],
+            ["Encoding", encoding], ["Total Sequences", self.total],
+            ["Sequences flagged as poor quality", 0],
+            ["Sequence length", f"{lengths[0]}-{lengths[-1]}"
+             if lengths and lengths[0] != lengths[-1]
+             else (lengths[0] if lengths else 0)],
+            ["%GC", round(gc_bases / max(total_bases, 1) * 100)]]
+
+        histogram = self.quality_histogram
+        quality_values = np.arange(MAX_QUALITY)
+        base_totals = np.maximum(histogram.sum(axis=1), 1)
+        mean = (histogram * quality_values).sum(axis=1) / base_totals
+        median = histogram_quantile(histogram, 0.5)
+        lower = histogram_quantile(histogram, 0.25)
+        upper = histogram_quantile(histogram, 0.75)
+        tenth = histogram_quantile(histogram, 0.1)
+        ninetieth = histogram_quantile(histogram, 0.9)
+        statuses["Per base sequence quality"] = max(
+            grade(float(lower.min(initial=40)), 10, 5, False),
+            grade(float(median.min(initial=40)), 25, 20, False),
+            key=["pass", "warn", "fail"].index)
+        tables["Per base sequence quality"] = [
+            ["#Base", "Mean", "Median", "Lower Quartile", "Upper Quartile",
+             "10th Percentile", "90th Percentile"]] + [
+            [int(position), round(float(m), 2), int(q2), int(q1), int(q3),
+             int(p10), int(p90)]
+            for position, m, q2, q1, q3, p10, p90 in zip(
+                positions, mean, median, lower, upper, tenth, ninetieth)]
+
+        read_qualities = self.read_quality_histogram
+        mode_quality = int(read_qualities.argmax())
+        statuses["Per sequence quality scores"] = grade(
+            mode_quality, 27, 20, False)
+        tables["Per sequence quality scores"] = [["#Quality", "Count"]] + [
+            [quality, int(count)] for quality, count
+            in enumerate(read_qualities.tolist()) if count]
+
+        called = np.maximum(sum(self.base_counts[base] for base in "ACGT"), 1)
+        content = {base: self.base_counts[base] / called * 100
+                   for base in "GATC"}
+        content_difference = float(max(
+            np.abs(content["A"] - content["T"]).max(initial=0),
+            np.abs(content["G"] - content["C"]).max(initial=0)))
+        statuses["Per base sequence content"] = grade(
+            content_difference, 10, 20)
+        tables["Per base sequence content"] = [
+            ["#Base", "G", "A", "T", "C"]] + [
+            [int(position)] + [round(float(content[base][index]), 2)
+                               for base in "GATC"]
+            for index, position in enumerate(positions)]
+
+        gc = self.gc_histogram
+        gc_values = np.arange(101)
+        gc_total = max(float(gc.sum()), 1.)
+        gc_mean = float((gc * gc_values).sum() / gc_total)
+        gc_sd = max(float(np.sqrt(
+            (gc * (gc_values - gc_mean) ** 2).sum() / gc_total)), 1e-6)
+        theoretical = np.exp(-0.5 * ((gc_values - gc_mean) / gc_sd) ** 2)
+        theoretical = theoretical / theoretical.sum() * gc_total
+        gc_deviation = float(np.abs(gc - theoretical).sum() / gc_total * 100)
+        statuses["Per sequence GC content"] = grade(gc_deviation, 15, 30)
+        tables["Per sequence GC content"] = [["#GC Content", "Count"]] + [
+            [value, round(count, 1)]
+            for value, count in enumerate(gc.tolist())]
+
+        all_bases = np.maximum(called + self.base_counts["N"], 1)
+        n_content = self.base_counts["N"] / all_bases * 100
+        statuses["Per base N content"] = grade(
+            float(n_content.max(initial=0)), 5, 20)
+        tables["Per base N content"] = [["#Base", "N-Count"]] + [
+            [int(position), round(float(value), 2)]
+            for position, value in zip(positions, n_content)]
+
+        if 0 in self.length_counts:
+            statuses["Sequence Length Distribution"] = "fail"
+        elif len(self.length_counts) > 1:
+            statuses["Sequence Length Distribution"] = "warn"
+        else:
+            statuses["Sequence Length Distribution"] = "pass"
+        tables["Sequence Length Distribution"] = [["#Length", "Count"]] + [
+            [length, self.length_counts[length]] for length in lengths]
+
+        tracked = max(sum(self.sequence_counts.values()), 1)
+        deduplicated = len(self.sequence_counts) / tracked * 100
+        statuses["Sequence Duplication Levels"] = grade(
+            deduplicated, 70, 50, False)
+        tables["Sequence Duplication Levels"] = [
+            ["#Total Deduplicated Percentage", round(deduplicated, 2)]]
+
+        overrepresented = [
+            [sequence, count, round(count / total * 100, 4), "No Hit"]
+            for sequence, count in self.sequence_counts.most_common(20)
+            if count / total * 100 > 0.1]
+        statuses["Overrepresented sequences"] = grade(
+            max([row[2] for row in overrepresented], default=0), 0.1, 1)
+        tables["Overrepresented sequences"] = [
+            ["#Sequence", "Count", "Percentage", "Possible Source"]] + \
+            overrepresented
+
+        adapter_content = {name: np.cumsum(starts) / total * 100
+                           for name, starts in self.adapter_starts.items()}
+        statuses["Adapter Content"] = grade(
+            max(float(values.max(initial=0))
+                for values in adapter_content.values()), 5, 10)
+        tables["Adapter Content"] = [["#Position"] + list(ADAPTERS)] + [
+            [int(position)] + [round(float(adapter_content[name][index]), 4)
+                               for name in ADAPTERS]
+            for index, position in enumerate(positions)]
+
+        return statuses, tables
+
+    def compact_record(self, statuses: Dict[str, str]) -> dict:
+        lengths = sorted(self.length_counts) or [0]
+        total_bases = sum(length * count
+                          for length, count in self.length_counts.items())
+        gc_bases = int(self.base_counts["G"].sum() +
+                       self.base_counts["C"].sum())
+        quality_values = np.arange(MAX_QUALITY)
+        mean_quality = float(
+            (self.quality_histogram * quality_values).sum() /
+            max(int(self.quality_histogram.sum()), 1))
+
+        return {"filename": self.filename,
+                "total_sequences": self.total,
+                "total_bases": total_bases,
+                "length_min": lengths[0],
+                "length_max": lengths[-1],
+                "gc": round(gc_bases / max(total_bases, 1) * 100, 2),
+                "mean_quality": round(mean_quality, 2),
+                "modules": statuses}
+
+
+def read_chunk(handle: IO[str],
+               chunk_size: int) -> Tuple[List[str], List[str]]:
+    sequences = []
+    qualities = []
+    for _ in range(chunk_size):
+        header = handle.readline()
+        if not header:
+            break
+        sequences.append(handle.readline().rstrip("\n"))
+        handle.readline()
+        qualities.append(handle.readline().rstrip("\n"))
+    return sequences, qualities
+
+
+def fastqc_stem(file_path: str) -> str:
+    stem = path.basename(file_path)
+    for suffix in (".gz", ".bz2", ".fastq", ".fq", ".txt", ".sam", ".bam"):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    return stem
+
+
+def write_fastqc_report(stats: FastqStats, output_dir: str) -> dict:
+    """
+    Writes FastQC-compatible summary.txt and fastqc_data.txt files and
+    returns the compact record of the file.
+
+    Args:
+        stats (FastqStats): Accumulated statistics of the file.
+        output_dir (str): Directory where the report folder is created.
+
+    Returns:
+        dict: Compact QC record of the file.
+    """
+    statuses, tables = stats.summary()
+    report_dir = path.join(output_dir, f"{fastqc_stem(stats.file_path)}"
+                                       "_fastqc")
+    makedirs(report_dir, exist_ok=True)
+
+    with open(path.join(report_dir, "summary.txt"), "w") as summary:
+        for module in MODULES:
+            summary.write(f"{statuses[module].upper()}\t{module}\t"
+                          f"{stats.filename}\n")
+
+    with open(path.join(report_dir, "fastqc_data.txt"), "w") as data:
+        data.write("##FastQC\tnative\n")
+        for module in MODULES:
+            data.write(f">>{module}\t{statuses[module]}\n")
+            for row in tables[module]:
+                data.write("\t".join(str(value) for value in row) + "\n")
+            data.write(">>END_MODULE\n")
+
+    return stats.compact_record(statuses)
+
+
+def run_native_qc(read1: str, read2: str, output_dir: str, sample: int,
+                  chunk_size: int = 50000) -> dict:
+    """
+    Computes the core FastQC modules for a read pair in a single streaming
+    pass over both files and writes FastQC-compatible summaries plus a
+    compact JSON record.
+
+    Args:
+        read1 (str): Path to the forward reads.
+        read2 (str): Path to the reverse reads.
+        output_dir (str): Directory where the reports are written.
+        sample (int): Sample identifier used to name the JSON record.
+        chunk_size (int): Number of reads processed per chunk.
+
+    Returns:
+        dict: Compact QC record of the read pair.
+    """
+    all_stats = [FastqStats(read1), FastqStats(read2)]
+
+    with open_fastq(read1) as handle1, open_fastq(read2) as handle2:
+        handles = [handle1, handle2]
+        while True:
+            chunks = [read_chunk(handle, chunk_size) for handle in handles]
+            if not any(sequences for sequences, _ in chunks):
+                break
+            for stats, (sequences, qualities) in zip(all_stats, chunks):
+                stats.add_chunk(sequences, qualities)
+
+    record = {"engine": "native",
+              "files": [write_fastqc_report(stats, output_dir)
+                        for stats in all_stats]}
+
+    with open(path.join(output_dir, f"{sample}_qc.json"), "w") as outfile:
+        json.dump(record, outfile, separators=(",", ":"))
+
+    return record
@@ -0,0 +1,269 @@
+import gzip
+import random
+from os import path, makedirs
+from collections import Counter
+from typing import IO, Dict, Iterator, List, Tuple
+from src.utils.handle_programs import run_command_line
+
+complement_table = str.maketrans("ACGT", "TGCA")
+
+
+def is_gzipped(file_path: str) -> bool:
+    with open(file_path, "rb") as infile:
+        return infile.read(2) == b"\x1f\x8b"
+
+
+def open_fastq(file_path: str) -> IO[str]:
+    """
+    Opens a FASTQ file for reading, transparently handling gzip compression.
+
+    Args:
+        file_path (str): Path to the FASTQ file.
+
+    Returns:
+        IO[str]: Text handle to the FASTQ file.
+    """
+    if is_gzipped(file_path):
+        return gzip.open(file_path, "rt")
+    return open(file_path, "r")
+
+
+def iter_fastq(handle: IO[str]) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Iterates over the records of a FASTQ file.
+
+    Args:
+        handle (IO[str]): Text handle to the FASTQ file.
+
+    Yields:
+        Tuple[str, str, str, str]: Header, sequence, separator and quality
+        lines of each record, without the trailing newline.
+    """
+    while True:
+        header = handle.readline()
+        if not header:
+            return
+        sequence = handle.readline().rstrip("\n")
+        separator = handle.readline().rstrip("\n")
+        quality = handle.readline().rstrip("\n")
+        yield header.rstrip("\n"), sequence, separator, quality
+
+
+def reverse_complement(sequence: str) -> str:
+    return sequence.translate(complement_table)[::-1]
+
+
+def count_sampled_kmers(sequence: str, kmer_counts: Counter, kmer_size: int,
+                        anchor: str):
+    """
+    Counts the canonical k-mers of a read that start with the anchor on
+    either strand. Anchoring on the k-mer content keeps the sampling
+    deterministic and about 2/4^len(anchor) of the genome positions.
+
+    Args:
+        sequence (str): Read sequence.
+        kmer_counts (Counter): Counter updated in place.
+        kmer_size (int): Length of the k-mers.
+        anchor (str): Prefix that selects the sampled k-mers.
+    """
+    rc_anchor = reverse_complement(anchor)
+    last_start = len(sequence) - kmer_size
+
+    position = sequence.find(anchor)
+    while -1 < position <= last_start:
+        kmer = sequence[position:position + kmer_size]
+        if "N" not in kmer:
+            kmer_counts[kmer] += 1
+        position = sequence.find(anchor, position + 1)
+
+    position = sequence.find(rc_anchor, kmer_size - len(rc_anchor))
+    while position != -1:
+        start = position + len(rc_anchor) - kmer_size
+        kmer = sequence[start:position + len(rc_anchor)]
+        if "N" not in kmer:
+            kmer_counts[reverse_complement(kmer)] += 1
+        position = sequence.find(rc_anchor, position + 1)
+
+
+def genome_size_from_histogram(histogram: Dict[int, int],
+                               sampling_rate: int) -> int:
+    """
+    Estimates the genome size from a k-mer coverage histogram, ignoring the
+    low-coverage k-mers produced by sequencing errors.
+
+    Args:
+        histogram (Dict[int, int]): Number of distinct k-mers per coverage.
+        sampling_rate (int): Inverse of the fraction of k-mers sampled.
+
+    Returns:
+        int: Estimated genome size, or 0 when no coverage peak is found.
+    """
+    if not histogram:
+        return 0
+
+    max_coverage = max(histogram)
+    valley = 1
+    while valley < max_coverage and \
+            histogram.get(valley + 1, 0) < histogram.get(valley, 0):
+        valley += 1
+
+    solid = {coverage: count for coverage, count in histogram.items()
+             if coverage > valley}
+    if not solid:
+        return 0
+
+    peak = max(solid, key=lambda coverage: solid[coverage])
+    if peak < 5:
+        return 0
+
+    solid_kmers = sum(coverage * count for coverage, count in solid.items())
+    return int(solid_kmers / peak * sampling_rate)
+
+
+def profile_reads(read1: str, read2: str, kmer_size: int = 21,
+                  max_kmer_pairs: int = 1000000,
+                  anchor: str = "ACG") -> Tuple[int, int, int]:
+    """
+    Streams a read pair once, counting reads and bases of the whole pair and
+    sampled k-mers of the first pairs to estimate the genome size.
+
+    Args:
+        read1 (str): Path to the forward reads.
+        read2 (str): Path to the reverse reads.
+        kmer_size (int): Length of the k-mers.
+        max_kmer_pairs (int): Number of pairs used for k-mer counting.
+        anchor (str): Prefix that selects the sampled k-mers.
+
+    Returns:
+        Tuple[int, int, int]: Number of pairs, total bases and estimated
+        genome size (0 when it could not be estimated).
+    """
+    kmer_counts: Counter = Counter()
+    pairs = 0
+    bases = 0
+
+    with open_fastq(read1) as handle1, open_fastq(read2) as handle2:
+        for record1, record2 in zip(iter_fastq(handle1),
+                                    iter_fastq(handle2)):
+            sequence1 = record1[1]
+            sequence2 = record2[1]
+            pairs += 1
+            bases += len(sequence1) + len(sequence2)
+
+            if pairs <= max_kmer_pairs:
+                count_sampled_kmers(sequence1.upper(), kmer_counts,
+                                    kmer_size, anchor)
+                count_sampled_kmers(sequence2.upper(), kmer_counts,
+                                    kmer_size, anchor)
+
+    histogram = Counter(kmer_counts.values())
+    genome_size = genome_size_from_histogram(histogram,
+                                             4 ** len(anchor) // 2)
+    return pairs, bases, genome_size
+
+
+def subsample_read_pairs(read1: str, read2: str, fraction: float,
+                         outputs: List[str], seed: int = 11) -> int:
+    """
+    Keeps a reproducible random fraction of the read pairs.
+
+    Args:
+        read1 (str): Path to the forward reads.
+        read2 (str): Path to the reverse reads.
+        fraction (float): Fraction of pairs to keep.
+        outputs (List[str]): Gzipped output paths for both mates.
+        seed (int): Seed of the pair selection.
+
+    Returns:
+        int: Number of pairs written.
+    """
+    rng = random.Random(seed)
+    kept = 0
+
+    with open_fastq(read1) as handle1, open_fastq(read2) as handle2, \
+            gzip.open(outputs[0], "wt", compresslevel=1) as out1, \
+            gzip.open(outputs[1], "wt", compresslevel=1) as out2:
+        for record1, record2 in zip(iter_fastq(handle1),
+                                    iter_fastq(handle2)):
+            if rng.random() >= fraction:
+                continue
+            out1.write("\n".join(record1) + "\n")
+            out2.write("\n".join(record2) + "\n")
+            kept += 1
+
+    return kept
+
+
+def stage_reads(reads: List[str], staging_dir: str, pigz="",
+                threads: int = 1) -> List[str]:
+    """
+    Decompresses the gzipped reads once into a staging directory, so QC,
+    profiling, assembly and coverage all read the same plain copy instead of
+    each inflating the files again. Both mates are decompressed at the same
+    time, with pigz when available.
+
+    Args:
+        reads (List[str]): Paths to the reads.
+        staging_dir (str): Directory of the decompressed copies.
+        pigz (str): pigz executable, gzip is used when empty.
+        threads (int): Threads of each pigz process.
+
+    Returns:
+        List[str]: Paths to read from, the original path of the files that
+        were not compressed.
+    """
+    makedirs(staging_dir, exist_ok=True)
+    decompress = f"{pigz} -dc -p {max(threads, 1)}" if pigz else "gzip -dc"
+
+    staged = []
+    commands = []
+    for read in reads:
+        if not is_gzipped(read):
+            staged.append(read)
+            continue
+        name = path.basename(read)
+        for extension in (".gz", ".gzip"):
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+        output = path.join(staging_dir, name)
+        commands.append(f"{decompress} {read} > {output}.tmp && "
+                        f"mv {output}.tmp {output}")
+        staged.append(output)
+
+    if len(commands) == 1:
+        run_command_line(commands[0])
+    elif commands:
+        # The shell fails if any of the background decompressions fails
+        launches = "; ".join(f"( {command} ) & pid{index}=$!"
+                             for index, command in enumerate(commands))
+        waits = " && ".join(f"wait $pid{index}"
+                            for index in range(len(commands)))
+        run_command_line(f"{launches}; {waits}")
+    return staged
+
+
+def head_read_pairs(read1: str, read2: str, pairs: int,
+                    outputs: List[str]) -> int:
+    """
+    Writes the first read pairs of a sample as plain FASTQ.
+
+    Args:
+        read1 (str): Path to the forward reads.
+        read2 (str): Path to the reverse reads.
+        pairs (int): Number of pairs to keep.
+        outputs (List[str]): Output paths for both mates.
+
+    Returns:
+        int: Number of pairs written.
+    """
+    written = 0
+    with open_fastq(read1) as handle1, open_fastq(read2) as handle2, \
+            open(outputs[0], "w") as out1, open(outputs[1], "w") as out2:
+        for record1, record2 in zip(iter_fastq(handle1),
+                                    iter_fastq(handle2)):
+            if written >= pairs:
+                break
+            out1.write("\n".join(record1) + "\n")
+            out2.write("\n".join(record2) + "\n")
+            written += 1
+    return written
@@ -0,0 +1,182 @@
+from os import path, makedirs
+from typing import Dict, List, Tuple
+from src.models.MongoHandler import MongoHandler
+from src.models.PipelineConfig import PipelineConfig
+from src.models.ReferenceDatabases import ReferenceDatabases
+from src.types.SpeciesDict import SpeciesDict
+from src.types.BacteriaDict import BacteriaDict
+from src.utils.handle_processing import choose_analysis, \
+    build_bacteria_dict, run_batch_blast_and_check_mutations
+from src.utils.handle_records import parse_mutations
+
+# Stages that only read the stored assembly or annotation, rerun when one of
+# their reference databases changes. Species, typing and assembly stages
+# are not: a change to kraken_db or fastani_db needs a full rerun.
+database_stages = {"abricate_db": ["resfinder", "vfdb", "plasmidfinder"],
+                   "reference_gene_catalog": ["resfinder"],
+                   "polimyxin_db": ["mutations"],
+                   "outhers_db": ["mutations"],
+                   "mutation_catalog": ["mutations"]}
+
+abricate_stages = ["resfinder", "vfdb", "plasmidfinder"]
+
+# Sample record fields written by each stage
+stage_record_fields = {"resfinder": ["resistanceGenes", "resistanceClasses"],
+                       "vfdb": ["virulenceGenes"],
+                       "plasmidfinder": ["plasmids"],
+                       "mutations": ["mutations", "mutationGenes"]}
+
+
+def database_path(config: PipelineConfig, name: str) -> str:
+    if config.reference_db_root:
+        resolved = ReferenceDatabases(config.reference_db_root).resolve(name)
+        if resolved:
+            return resolved
+    return getattr(config, name)
+
+
+def load_bacteria_dicts(mongo_client: MongoHandler, config: PipelineConfig,
+                        samples: List[int]) -> List[BacteriaDict]:
+    """
+    Builds the BLASTx mutation search of the stored assemblies of the given
+    samples, or of every sample with a mutation species.
+    """
+    match: dict = {"especieMutacoes": {"$in": list(choose_analysis)}}
+    if samples:
+        match["sequenciaId"] = {"$in": samples}
+    reports = mongo_client.search(
+        "relatorios", match=match,
+        project={"sequenciaId": 1, "especieMutacoes": 1})
+
+    bacteria_dicts = []
+    for report in reports:
+        sample = report["sequenciaId"]
+        assembly = path.join(config.fastqc_output_path, f"{sample}.fasta")
+        if not path.isfile(assembly):
+            print(f"Assembly of {sample} not found, skipping.")
+            continue
+
+        output_path = path.join(config.uploaded_sequences_path,
+                                f"output_{sample}")
+        makedirs(output_path, exist_ok=True)
+        species_info: SpeciesDict = {
+            "species": report["especieMutacoes"],
+            "assembly": assembly,
+            "sample": sample,
+            "poli_db_path": database_path(config, "polimyxin_db"),
+            "others_db_path": database_path(config, "outhers_db"),
+            "fastani_db_path": config.fastani_db,
+            "output_path": output_path,
+            "blastx": config.blastx,
+            "mutation_catalog": database_path(config, "mutation_catalog"),
+            "mutation_exhaustive": config.mutation_exhaustive,
+            "mutation_deferred": False}
+        bacteria_dict = build_bacteria_dict(species_info,
+                                            report["especieMutacoes"])
+        if bacteria_dict:
+            bacteria_dicts.append(bacteria_dict)
+    return bacteria_dicts
+
+
+def batch_mutations(mongo_client: MongoHandler, config: PipelineConfig,
+                    samples: List[int]) -> Dict[int, dict]:
+    """
+    Runs the mutation search of the stored assemblies of the samples in
+    batches of MUTATION_BATCH_SIZE, one BLASTx per species and database,
+    and saves the report fields.
+
+    Returns:
+        Dict[int, dict]: Sample record fields of each searched sample.
+    """
+    bacteria_dicts = load_bacteria_dicts(mongo_client, config, samples)
+    batch_dir = path.join(config.uploaded_sequences_path, "mutation_batch")
+    batch_size = max(config.mutation_batch_size, 1)
+
+    records = {}
+    for start in range(0, len(bacteria_dicts), batch_size):
+        results = run_batch_blast_and_check_mutations(
+            bacteria_dicts[start:start + batch_size], batch_dir)
+        for sample, (others, poli) in results.items():
+            query = {"sequenciaId": int(sample)}
+            mongo_client.save("relatorios", query,
+                              {"mutacoes_poli": "<br>".join(poli)})
+            mongo_client.save("relatorios", query,
+                              {"mutacoes_outras": "<br>".join(others)})
+            mutations, mutation_genes = parse_mutations(others + poli)
+            records[int(sample)] = {"mutations": mutations,
+                                    "mutationGenes": mutation_genes}
+    return records
+
+
+def stale_databases(analysed: Dict[str, str], current: Dict[str, str],
+                    databases: List[str]) -> List[str]:
+    """
+    Lists the databases a sample was analysed with an older version of.
+
+    Args:
+        analysed (Dict[str, str]): Versions recorded for the sample.
+        current (Dict[str, str]): Current version of each database.
+        databases (List[str]): Databases to consider.
+    """
+    return [database for database in databases
+            if current.get(database) and
+            analysed.get(database) != current[database]]
+
+
+def plan_reanalysis(reports: List[dict], current: Dict[str, str],
+                    databases: List[str]
+                    ) -> Dict[int, Tuple[List[str], List[str]]]:
+    """
+    Chooses what to rerun on each sample: the stages depending on the
+    databases it was analysed with an older version of. Samples already
+    reanalysed with the current versions are left out, so an interrupted
+    reanalysis resumes where it stopped.
+
+    Args:
+        reports (List[dict]): relatorios documents with sequenciaId,
+        especieMutacoes and the recorded database versions.
+        current (Dict[str, str]): Current version of each database.
+        databases (List[str]): Databases to consider.
+
+    Returns:
+        Dict[int, Tuple[List[str], List[str]]]: Stages to rerun and stale
+        databases of each sample.
+    """
+    plan = {}
+    for report in reports:
+        analysed = (report.get("registro") or {}).get("databaseVersions") \
+            or report.get("versoesBancos") or {}
+        stale = stale_databases(analysed, current, databases)
+        stages = [stage for stage in [*abricate_stages, "mutations"]
+                  if any(stage in database_stages[database]
+                         for database in stale)]
+        if "mutations" in stages and \
+                report.get("especieMutacoes") not in choose_analysis:
+            stages.remove("mutations")
+        if stale:
+            plan[int(report["sequenciaId"])] = (stages, stale)
+    return plan
+
+
+def save_reanalysis(mongo_client: MongoHandler, sample: int,
+                    record: dict, versions: Dict[str, str]):
+    """
+    Records the versions of the databases a sample was reanalysed with and,
+    when the report has a sample record, updates its reanalysed fields. The
+    record gets a new finishedAt, so the cohort export supersedes its
+    previous copy. Reports analysed before sample records existed get none:
+    a partial record, without sample or species, would be exported as a
+    bogus row.
+    """
+    mongo_client.save(
+        "relatorios", {"sequenciaId": sample},
+        {"$currentDate": {"reanalisadoEm": True},
+         "$set": {f"versoesBancos.{database}": version
+                  for database, version in versions.items()}})
+
+    fields = {f"registro.{field}": value for field, value in record.items()}
+    for database, version in versions.items():
+        fields[f"registro.databaseVersions.{database}"] = version
+    mongo_client.update_many(
+        "relatorios", {"sequenciaId": sample, "registro": {"$exists": True}},
+        {"$currentDate": {"registro.finishedAt": True}, "$set": fields})
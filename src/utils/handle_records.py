@@ -0,0 +1,66 @@
+import re
+from typing import List, Tuple
+from src.types.SampleRecord import SampleRecord
+
+mutation_pattern = re.compile(r"^(\w+):([A-Z*-])(\d+)([A-Z*-])$")
+truncation_pattern = re.compile(r"^(\w+) truncation")
+
+
+def new_sample_record(sample: int) -> SampleRecord:
+    return {"sample": sample, "species": "", "speciesKey": "", "st": "",
+            "mlstScheme": "", "resistanceGenes": [], "resistanceClasses": [],
+            "virulenceGenes": [], "plasmids": [], "mutations": [],
+            "mutationGenes": [], "completeness": float("nan"),
+            "contamination": float("nan"), "coverage": float("nan"),
+            "genomeSize": 0, "databaseVersions": {}}
+
+
+def species_slug(species: str) -> str:
+    """
+    Normalizes a species name into the key used to partition the records,
+    e.g. "Klebsiella pneumoniae" -> "klebsiella_pneumoniae".
+    """
+    slug = re.sub(r"[^a-z0-9]+", "_", species.lower()).strip("_")
+    return slug or "unknown"
+
+
+def abricate_genes(abricate_result: List[str]) -> List[str]:
+    """
+    Returns the distinct gene names of Abricate result lines, in order.
+    """
+    genes = [line.split("\t")[5] for line in abricate_result]
+    return list(dict.fromkeys(genes))
+
+
+def parse_mutations(results: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Turns the reported mutations ("GyrA:S83L," or "MgrB truncation: 20/47,")
+    into typed values.
+
+    Returns:
+        Tuple[List[str], List[str]]: The mutations, as "GyrA:S83L" or
+        "MgrB:truncation", and the genes they affect.
+    """
+    mutations = []
+    genes = []
+    for result in results:
+        result = result.strip().rstrip(",")
+        mutation_match = mutation_pattern.match(result)
+        truncation_match = truncation_pattern.match(result)
+        if mutation_match:
+            gene = mutation_match.group(1)
+            mutations.append(result)
+        elif truncation_match:
+            gene = truncation_match.group(1)
+            mutations.append(f"{gene}:truncation")
+        else:
+            continue
+        genes.append(gene)
+    return list(dict.fromkeys(mutations)), list(dict.fromkeys(genes))
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
@@ -0,0 +1,24 @@
+from typing import Union
+from src.models.MongoHandler import MongoHandler
+from src.models.PipelineConfig import PipelineConfig
+from src.models.LocalResultStore import LocalResultStore, \
+    SqliteResultStore, FileResultStore
+from src.models.ResultJournal import ResultJournal
+
+
+def open_result_store(config: PipelineConfig
+                      ) -> Union[MongoHandler, LocalResultStore,
+                                 ResultJournal]:
+    """
+    Opens the result backend chosen by RESULT_BACKEND: "mongo" (default),
+    "sqlite" (RESULT_PATH is the database file) or "file" (RESULT_PATH is
+    a directory). With RESULT_JOURNAL_PATH, Mongo writes go through the
+    local journal and are replicated in the background.
+    """
+    if config.result_backend == "sqlite":
+        return SqliteResultStore(config.result_path)
+    if config.result_backend == "file":
+        return FileResultStore(config.result_path)
+    if config.result_journal_path:
+        return ResultJournal(config.result_journal_path)
+    return MongoHandler()
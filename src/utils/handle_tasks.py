@@ -1,12 +1,16 @@
 from typing import List
+from collections import Counter
+from datetime import datetime, timezone
 from src.models.MongoHandler import MongoHandler
+from src.models.TaskLease import lease_available
 
 
 def get_fastqc_tasks() -> List[dict]:
     try:
         handler = MongoHandler()
 
-        match_stage = {"ultimaTarefa": "QUA"}
+        match_stage = {"ultimaTarefa": "QUA",
+                       **lease_available(datetime.now(timezone.utc))}
         lookup_stage = {
             "from": "usuarios",
             "localField": "criadoPor",
@@ -17,7 +21,13 @@ def get_fastqc_tasks() -> List[dict]:
             "arquivofastqr1": 1,
             "arquivofastqr2": 1,
             "email": {"$arrayElemAt": ["$usuario.email", 0]},
-            "ultimaTarefa": 1
+            "ultimaTarefa": 1,
+            "criadoPor": 1,
+            "prioridade": 1,
+            "enfileiradoEm": 1,
+            "peso": {"$arrayElemAt": ["$usuario.peso", 0]},
+            "maxConcorrencia": {"$arrayElemAt": [
+                "$usuario.maxConcorrencia", 0]}
         }
 
         tasks = handler.search("sequencias", match_stage,
@@ -34,7 +44,8 @@ def get_complete_tasks():
     try:
         handler = MongoHandler()
 
-        match_stage = {"ultimaTarefa": "TODOS"}
+        match_stage = {"ultimaTarefa": "TODOS",
+                       **lease_available(datetime.now(timezone.utc))}
         lookup_stage = {
             "from": "usuarios",
             "localField": "criadoPor",
@@ -45,7 +56,13 @@ def get_complete_tasks():
             "arquivofastqr1": 1,
             "arquivofastqr2": 1,
             "email": {"$arrayElemAt": ["$usuario.email", 0]},
-            "ultimaTarefa": 1
+            "ultimaTarefa": 1,
+            "criadoPor": 1,
+            "prioridade": 1,
+            "enfileiradoEm": 1,
+            "peso": {"$arrayElemAt": ["$usuario.peso", 0]},
+            "maxConcorrencia": {"$arrayElemAt": [
+                "$usuario.maxConcorrencia", 0]}
         }
 
         tasks = handler.search("sequencias", match_stage,
@@ -62,7 +79,8 @@ def get_genomic_tasks() -> List[dict]:
     try:
         handler = MongoHandler()
 
-        match_stage = {"ultimaTarefa": "ENS"}
+        match_stage = {"ultimaTarefa": "ENS",
+                       **lease_available(datetime.now(timezone.utc))}
         lookup_stage = {
             "from": "usuarios",
             "localField": "criadoPor",
@@ -73,7 +91,13 @@ def get_genomic_tasks() -> List[dict]:
             "arquivofastqr1": 1,
             "arquivofastqr2": 1,
             "email": {"$arrayElemAt": ["$usuario.email", 0]},
-            "ultimaTarefa": 1
+            "ultimaTarefa": 1,
+            "criadoPor": 1,
+            "prioridade": 1,
+            "enfileiradoEm": 1,
+            "peso": {"$arrayElemAt": ["$usuario.peso", 0]},
+            "maxConcorrencia": {"$arrayElemAt": [
+                "$usuario.maxConcorrencia", 0]}
         }
 
         tasks = handler.search("sequencias", match_stage,
@@ -84,3 +108,44 @@ def get_genomic_tasks() -> List[dict]:
         print(f"Can't retrive genomic tasks.\n\n{e}")
         handler.close()
         return []
+
+
+def mark_enqueued(tasks: List[dict]):
+    """
+    Stamps the time a task was first seen by a scheduler, used to measure
+    how long it waits for a worker.
+    """
+    if not tasks:
+        return
+
+    now = datetime.now(timezone.utc)
+    for task in tasks:
+        task.setdefault("enfileiradoEm", now)
+
+    try:
+        handler = MongoHandler()
+        handler.update_many(
+            "sequencias",
+            {"_id": {"$in": [task["_id"] for task in tasks]},
+             "enfileiradoEm": {"$exists": False}},
+            {"$currentDate": {"enfileiradoEm": True}})
+        handler.close()
+    except Exception as e:
+        print(f"Can't mark enqueued tasks.\n\n{e}")
+
+
+def count_running_by_user() -> Counter:
+    """
+    Counts the tasks currently leased by any worker, per submitting user.
+    """
+    try:
+        handler = MongoHandler()
+        match_stage = {"lease.expiresAt": {"$gt": datetime.now(timezone.utc)}}
+        project_stage = {"criadoPor": 1}
+        tasks = handler.search("sequencias", match_stage,
+                               project=project_stage)
+        handler.close()
+        return Counter(str(task.get("criadoPor") or "") for task in tasks)
+    except Exception as e:
+        print(f"Can't count running tasks.\n\n{e}")
+        return Counter()
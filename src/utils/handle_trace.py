@@ -0,0 +1,140 @@
+import os
+import json
+import socket
+import threading
+from os import path
+from time import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Union
+
+# Trace-event JSON (the format read by chrome://tracing, Perfetto and
+# speedscope). Each process appends its events to its own file; the array
+# needs no closing bracket, so a file is readable while it is being written.
+trace_state: Dict[str, Union[str, int, None]] = {"path": "", "name": "",
+                                                 "pid": None}
+trace_context: Dict[str, Union[str, int]] = {}
+trace_lock = threading.Lock()
+trace_file = None
+
+
+def configure_tracing(trace_path: str, process_name=""):
+    """
+    Enables tracing in this process. Events go to
+    <trace_path>/trace-<YYYYmmdd>-<host>-<pid>.json. Nothing is recorded
+    when trace_path is empty.
+
+    Args:
+        trace_path (str): Directory of the trace files.
+        process_name (str): Name of the process in the viewers.
+    """
+    trace_state["path"] = trace_path
+    trace_state["name"] = process_name
+    if trace_path:
+        os.makedirs(trace_path, exist_ok=True)
+
+
+def set_trace_context(**tags):
+    """
+    Tags every following event of this process, e.g. sample and lane.
+    """
+    trace_context.clear()
+    trace_context.update(tags)
+
+
+def tracing_enabled() -> bool:
+    return bool(trace_state["path"])
+
+
+def _open_trace_file():
+    global trace_file
+    # Forked workers inherit the handle of their parent and need their own
+    if trace_file is not None and trace_state["pid"] == os.getpid():
+        return trace_file
+
+    trace_state["pid"] = os.getpid()
+    name = (f"trace-{datetime.now(timezone.utc):%Y%m%d}-"
+            f"{socket.gethostname()}-{os.getpid()}.json")
+    trace_file = open(path.join(str(trace_state["path"]), name), "a",
+                      buffering=1)
+    if trace_file.tell() == 0:
+        trace_file.write("[\n")
+    process_name = trace_state.get("name") or \
+        f"{socket.gethostname()}:{os.getpid()}"
+    trace_file.write(json.dumps({"name": "process_name", "ph": "M",
+                                 "pid": os.getpid(),
+                                 "args": {"name": process_name}}) + ",\n")
+    return trace_file
+
+
+def record_span(name: str, category: str, start: float, end: float,
+                **args):
+    """
+    Records a complete event between two epoch timestamps.
+
+    Args:
+        name (str): Event name, e.g. the stage.
+        category (str): Event category, e.g. "stage" or "mongo".
+        start (float): Start, in seconds since the epoch.
+        end (float): End, in seconds since the epoch.
+        args: Extra tags shown with the event.
+    """
+    if not tracing_enabled():
+        return
+
+    event = {"name": name, "cat": category, "ph": "X",
+             "ts": round(start * 1e6), "dur": round((end - start) * 1e6),
+             "pid": os.getpid(), "tid": threading.get_native_id(),
+             "args": {**trace_context, **args}}
+    try:
+        with trace_lock:
+            _open_trace_file().write(json.dumps(event, default=str) + ",\n")
+    except Exception as e:
+        print(f"Failed to write trace event.\n\n{e}")
+
+
+@contextmanager
+def span(name: str, category: str, **args) -> Iterator[None]:
+    """
+    Records the block as a complete event.
+    """
+    if not tracing_enabled():
+        yield
+        return
+
+    start = time()
+    try:
+        yield
+    finally:
+        record_span(name, category, start, time(), **args)
+
+
+def read_trace_file(trace_file_path: str) -> List[dict]:
+    events = []
+    with open(trace_file_path) as infile:
+        for line in infile:
+            line = line.strip().rstrip(",")
+            if not line or line in ("[", "]"):
+                continue
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line of a file still being written
+                continue
+    return events
+
+
+def merge_traces(trace_files: List[str], output: str) -> int:
+    """
+    Merges the trace files of several processes into one timeline.
+
+    Returns:
+        int: Number of events written.
+    """
+    events = [event for trace_file_path in trace_files
+              for event in read_trace_file(trace_file_path)]
+    events.sort(key=lambda event: event.get("ts", 0))
+    with open(f"{output}.tmp", "w") as outfile:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outfile)
+    os.replace(f"{output}.tmp", output)
+    return len(events)
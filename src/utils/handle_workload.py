@@ -0,0 +1,88 @@
+import os
+import json
+import fcntl
+import socket
+from os import path
+from datetime import datetime, timezone
+from typing import List
+from resource import getrusage, RUSAGE_CHILDREN
+from src.models.RuntimePredictor import read_features
+
+
+def workload_record(task: dict, mode: str, pipe, started_at: datetime,
+                    workers: int, result: str) -> dict:
+    """
+    Builds the workload record of a finished task: when it arrived and ran,
+    what it asked of the machine and how long each stage took.
+
+    Args:
+        task (dict): Task returned by handle_tasks.
+        mode (str): Pipeline lane.
+        pipe (CabgenPipeline): Pipeline that ran the task.
+        started_at (datetime): Time the task was claimed.
+        workers (int): Worker slots of the scheduler.
+        result (str): "ok", "failed", "cancelled" or "timeout".
+
+    Returns:
+        dict: Record in the format read by the simulator.
+    """
+    enqueued = task.get("enfileiradoEm")
+    if isinstance(enqueued, datetime) and enqueued.tzinfo is None:
+        enqueued = enqueued.replace(tzinfo=timezone.utc)
+
+    return {"sample": int(task.get("_id", 0)),
+            "lane": mode,
+            "user": str(task.get("criadoPor") or ""),
+            "priority": int(task.get("prioridade") or 0),
+            "weight": float(task.get("peso") or 1.),
+            "maxConcurrency": int(task.get("maxConcorrencia") or 0),
+            "enqueuedAt": (enqueued or started_at).isoformat(),
+            "startedAt": started_at.isoformat(),
+            "finishedAt": datetime.now(timezone.utc).isoformat(),
+            "host": socket.gethostname(),
+            "workers": workers,
+            "threads": pipe.threads,
+            "features": read_features(pipe.read1, pipe.read2,
+                                      pipe.read_count),
+            "stages": {name: {"wall": round(wall, 3),
+                              "cpu": round(pipe.stage_cpu.get(name, 0.), 3)}
+                       for name, wall in pipe.stage_durations.items()},
+            # High-water mark of the worker, which runs a single task
+            "peakMemoryMb": getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024,
+            "peakDiskMb": pipe.peak_disk / 1e6,
+            "result": result}
+
+
+def record_workload(workload_path: str, record: dict):
+    """
+    Appends a record to <workload_path>/workload-<host>.jsonl. Workers of
+    the same host share the file, so appends are serialized with a lock.
+    Nothing is written when workload_path is empty.
+    """
+    if not workload_path:
+        return
+
+    try:
+        os.makedirs(workload_path, exist_ok=True)
+        workload_file = path.join(workload_path,
+                                  f"workload-{socket.gethostname()}.jsonl")
+        with open(workload_file, "a") as outfile:
+            fcntl.flock(outfile, fcntl.LOCK_EX)
+            outfile.write(json.dumps(record) + "\n")
+            fcntl.flock(outfile, fcntl.LOCK_UN)
+    except Exception as e:
+        print(f"Failed to record workload.\n\n{e}")
+
+
+def read_workload(workload_files: List[str]) -> List[dict]:
+    """
+    Reads the records of one or more workload files, oldest arrival first.
+    """
+    records = []
+    for workload_file in workload_files:
+        with open(workload_file) as infile:
+            for line in infile:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return sorted(records, key=lambda record: record["enqueuedAt"])
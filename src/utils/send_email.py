@@ -1,18 +1,62 @@
-from subprocess import run
-from os import getenv, path
-from dotenv import load_dotenv
+import smtplib
+from os import path
+from email.message import EmailMessage
+from src.models.NotificationOutbox import NotificationOutbox
+from src.models.PipelineConfig import PipelineConfig
 
-load_dotenv()
 
-sender_email = getenv("SENDER_EMAIL") or ""
-template_email_path = getenv("TEMPLATE_EMAIL_PATH") or ""
+def queue_email(config: PipelineConfig, recipient_email: str, subject: str,
+                template: str, sample=None):
+    """
+    Writes an e-mail to the durable outbox. The message is delivered later
+    by the notification sender, so a slow or broken mail relay never holds
+    a pipeline worker.
 
+    Args:
+        config (PipelineConfig): Pipeline configuration.
+        recipient_email (str): Recipient address.
+        subject (str): Message subject.
+        template (str): Template file name inside TEMPLATE_EMAIL_PATH.
+        sample (int): Sample the message refers to, used for digests.
+    """
+    try:
+        outbox = NotificationOutbox(config.outbox_database())
+        outbox.enqueue(recipient_email, subject, template, sample)
+        outbox.close()
+    except Exception as e:
+        raise Exception(f"Failed to queue e-mail.\n\n{e}")
+
+
+def read_template(template: str, template_email_path: str) -> str:
+    with open(path.join(template_email_path, template), "r") as infile:
+        return infile.read()
 
-def send_email(recipient_email: str, subject: str, template: str):
+
+def send_email(config: PipelineConfig, recipient_email: str, subject: str,
+               body: str):
+    """
+    Delivers an e-mail through the configured SMTP relay. Any SMTP server
+    works, including a local stand-in such as
+    `python -m aiosmtpd -n -l localhost:1025` with SMTP_PORT=1025.
+
+    Args:
+        config (PipelineConfig): Pipeline configuration.
+        recipient_email (str): Recipient address.
+        subject (str): Message subject.
+        body (str): Plain text body.
+    """
     try:
-        template_email = path.join(template_email_path, template)
-        command_line = (f"mailx -r {sender_email} -s '{subject}' "
-                        f"{recipient_email} < {template_email}")
-        run(command_line, shell=True)
+        message = EmailMessage()
+        message["From"] = config.sender_email
+        message["To"] = recipient_email
+        message["Subject"] = subject
+        message.set_content(body)
+
+        with smtplib.SMTP(config.smtp_host, config.smtp_port,
+                          timeout=config.smtp_timeout) as smtp:
+            if config.smtp_user:
+                smtp.starttls()
+                smtp.login(config.smtp_user, config.smtp_password)
+            smtp.send_message(message)
     except Exception as e:
         raise Exception(f"Failed to send e-mail.\n\n{e}")
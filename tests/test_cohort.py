@@ -0,0 +1,146 @@
+import pytest
+from datetime import datetime
+import cohort_main
+from src.models import CohortStore as cohort_store
+from src.models.CohortStore import CohortStore, part_files
+from src.models.PipelineConfig import PipelineConfig
+
+
+def sample_record(sample: int, finished: datetime,
+                  species="klebsiellapneumoniae", st="258", genes=(),
+                  mutation_genes=()) -> dict:
+    return {"sample": sample, "finishedAt": finished,
+            "species": species.capitalize(), "speciesKey": species,
+            "st": st, "mlstScheme": "kpneumoniae", "completeness": 99.1,
+            "contamination": 0.4, "coverage": 80., "genomeSize": 5400000,
+            "resistanceGenes": list(genes), "resistanceClasses": [],
+            "virulenceGenes": [], "plasmids": [], "mutations": [],
+            "mutationGenes": list(mutation_genes)}
+
+
+def test_load_keeps_latest_record_of_each_sample(tmp_path):
+    store = CohortStore(str(tmp_path))
+    store.append([sample_record(1, datetime(2026, 3, 1), genes=["blaKPC-2"]),
+                  sample_record(2, datetime(2026, 3, 2))])
+    store.append([sample_record(1, datetime(2026, 3, 9),
+                                genes=["blaNDM-1"])])
+
+    frame = store.load()
+    assert sorted(frame.samples()) == [1, 2]
+    assert frame.samples(resistanceGenes="blaNDM-1") == [1]
+    assert frame.samples(resistanceGenes="blaKPC-2") == []
+
+
+def test_compaction_merges_parts(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort_store, "max_parts", 2)
+    store = CohortStore(str(tmp_path))
+    for day in range(1, 4):
+        store.append([sample_record(1, datetime(2026, 3, day), st=str(day)),
+                      sample_record(10 + day, datetime(2026, 3, day))])
+
+    partition, = store.partitions()
+    assert len(part_files(partition)) == 1
+    frame = store.load()
+    assert sorted(frame.samples()) == [1, 11, 12, 13]
+    assert frame.samples(st="3") == [1]
+
+
+def test_superseded_record_in_other_partition_is_left_out(tmp_path):
+    store = CohortStore(str(tmp_path))
+    store.append([sample_record(1, datetime(2026, 1, 20)),
+                  sample_record(2, datetime(2026, 1, 21))])
+    # Reanalysed the next month, and reclassified
+    store.append([sample_record(1, datetime(2026, 2, 3),
+                                species="klebsiellavariicola")])
+
+    assert store.load(months=["2026-01"]).samples() == [2]
+    assert store.load(months=["2026-02"]).samples() == [1]
+    assert store.load(species=["klebsiellapneumoniae"]).samples() == [2]
+    assert sorted(store.load().samples()) == [1, 2]
+
+
+def test_prevalence_by_group(tmp_path):
+    store = CohortStore(str(tmp_path))
+    store.append([
+        sample_record(1, datetime(2026, 3, 1), st="258",
+                      genes=["blaKPC-2", "blaKPC-2"]),
+        sample_record(2, datetime(2026, 3, 2), st="258",
+                      genes=["blaKPC-2", "sul1"]),
+        sample_record(3, datetime(2026, 3, 3), st="11", genes=["sul1"]),
+        sample_record(4, datetime(2026, 4, 3), st="11", genes=[],
+                      mutation_genes=["PmrB"])])
+
+    frame = store.load()
+    assert frame.prevalence("resistanceGenes", "st") == {
+        ("258", "blaKPC-2"): (2, 2, 1.),
+        ("258", "sul1"): (1, 2, .5),
+        ("11", "sul1"): (1, 2, .5)}
+    assert frame.prevalence("resistanceGenes", "month",
+                            mutationGenes="PmrB") == {}
+    assert frame.prevalence("resistanceGenes", st="11") == {
+        ("", "sul1"): (1, 2, .5)}
+
+
+class FakeReports:
+    """
+    Stand-in for MongoHandler.search over relatorios, with the records
+    Mongo holds at the time of each export.
+    """
+    records: list = []
+
+    def search(self, collection_name, match=None, lookup=None, project=None,
+               sort=None, limit=None):
+        cursor = match["registro.finishedAt"]["$gt"]
+        records = sorted((record for record in self.records
+                          if record["finishedAt"] > cursor),
+                         key=lambda record: record["finishedAt"])
+        return [{"registro": record} for record in records[:limit]]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def reset_reports():
+    yield
+    FakeReports.records = []
+
+
+def test_export_rereads_overlap_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort_main, "MongoHandler", FakeReports)
+    monkeypatch.setattr(cohort_main, "export_batch_size", 2)
+    config = PipelineConfig(cohort_path=str(tmp_path),
+                            cohort_export_overlap=3600)
+    FakeReports.records = [sample_record(1, datetime(2026, 3, 1, 10)),
+                           sample_record(2, datetime(2026, 3, 1, 10, 5)),
+                           sample_record(3, datetime(2026, 3, 1, 10, 7))]
+    assert cohort_main.export_records(config) == 3
+
+    # Journaled during an outage, it reached Mongo after newer ones
+    FakeReports.records.append(sample_record(4, datetime(2026, 3, 1, 9, 58)))
+    assert cohort_main.export_records(config) == 1
+    assert cohort_main.export_records(config) == 0
+
+    # A reanalysis of an exported sample is a new record
+    FakeReports.records.append(sample_record(2, datetime(2026, 3, 1, 10, 6),
+                                             genes=["sul1"]))
+    assert cohort_main.export_records(config) == 1
+
+    exported_until, recent = cohort_main.read_checkpoint(str(tmp_path))
+    assert exported_until == datetime(2026, 3, 1, 10, 7)
+    assert sorted(recent) == ["1", "2", "3", "4"]
+    frame = CohortStore(str(tmp_path)).load()
+    assert sorted(frame.samples()) == [1, 2, 3, 4]
+    assert frame.samples(resistanceGenes="sul1") == [2]
+
+
+def test_export_prunes_records_out_of_the_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(cohort_main, "MongoHandler", FakeReports)
+    config = PipelineConfig(cohort_path=str(tmp_path),
+                            cohort_export_overlap=3600)
+    FakeReports.records = [sample_record(1, datetime(2026, 3, 1, 8)),
+                           sample_record(2, datetime(2026, 3, 1, 10))]
+    assert cohort_main.export_records(config) == 2
+
+    _, recent = cohort_main.read_checkpoint(str(tmp_path))
+    assert list(recent) == ["2"]
@@ -0,0 +1,65 @@
+from src.utils.handle_mutations import find_kleb_mutations
+
+residues = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def blast_hsp(gene: str, length: int, substitutions: dict) -> list:
+    subject = (residues * (length // len(residues) + 1))[:length]
+    query = "".join(substitutions.get(position, residue)
+                    for position, residue in enumerate(subject, 1))
+    match = "".join(a if a == b else " " for a, b in zip(query, subject))
+    identities = sum(a == b for a, b in zip(query, subject))
+    percent = identities * 100 // length
+    lines = [f">{gene}|klebsiellapneumoniae", "", f"Length={length}", "",
+             " Score = 200 bits (500),  Expect = 1e-60",
+             f" Identities = {identities}/{length} ({percent}%), "
+             f"Positives = {identities}/{length} ({percent}%), "
+             f"Gaps = 0/{length} (0%)", ""]
+    for start in range(0, length, 60):
+        end = min(start + 60, length)
+        lines += [f"Query  {start * 3 + 1:<5}{query[start:end]}  {end * 3}",
+                  " " * 12 + match[start:end],
+                  f"Sbjct  {start + 1:<5}{subject[start:end]}  {end}", ""]
+    return lines
+
+
+def write_blast_result(tmp_path) -> str:
+    lines = ["BLASTX 2.12.0+", ""]
+    lines += blast_hsp("GyrA", 120, {83: "I"})
+    lines += blast_hsp("PmrB", 180, {10: "W", 121: "Y", 157: "P"})
+    lines += blast_hsp("PhoQ", 120, {45: "W"})
+    lines += blast_hsp("MgrB", 60, {30: "W"})
+    blast_result = tmp_path / "kleb_blast.txt"
+    blast_result.write_text("\n".join(lines) + "\n")
+    return str(blast_result)
+
+
+# Output of the baseline character-by-character caller on the same result
+baseline_others = ["GyrA:D83I,"]
+baseline_poli = ["PmrB:L10W,", "PmrB:A121Y,", "PmrB:T157P,", "PhoQ:F45W,",
+                 "MgrB:L30W,"]
+
+
+def test_default_reports_every_baseline_mutation(tmp_path):
+    others, poli = find_kleb_mutations(write_blast_result(tmp_path))
+    assert others == baseline_others
+    assert poli == baseline_poli
+
+
+def test_no_catalog_keeps_every_substitution(tmp_path):
+    # Sites off any catalog, e.g. PmrB 10 or PhoQ, must not be dropped
+    others, poli = find_kleb_mutations(write_blast_result(tmp_path),
+                                       exhaustive=False)
+    assert others == baseline_others
+    assert poli == baseline_poli
+
+
+def test_catalog_limits_calls_to_its_sites(tmp_path):
+    catalog = tmp_path / "catalog.tsv"
+    catalog.write_text("species\tgene\tposition\treference\n"
+                       "klebsiellapneumoniae\tGyrA\t83\tS\n"
+                       "klebsiellapneumoniae\tPmrB\t157\tT\n")
+    others, poli = find_kleb_mutations(write_blast_result(tmp_path),
+                                       str(catalog), exhaustive=False)
+    assert others == ["GyrA:D83I,"]
+    assert poli == ["PmrB:T157P,"]
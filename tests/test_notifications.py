@@ -0,0 +1,122 @@
+import socket
+import threading
+import socketserver
+from email import message_from_bytes, policy
+from src.models.PipelineConfig import PipelineConfig
+from src.models.NotificationOutbox import NotificationOutbox
+from src.utils.handle_notifications import drain_outbox
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP relay keeping the messages it accepts, enough for
+    smtplib.send_message.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), SMTPHandler)
+        self.messages = []
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 localhost stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith("EHLO") or command.startswith("HELO"):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b""
+                for data_line in iter(self.rfile.readline, b".\r\n"):
+                    data += data_line
+                self.server.messages.append(
+                    message_from_bytes(data, policy=policy.default))
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+def write_template(tmp_path) -> str:
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "analysisFinish.template").write_text("Análise concluída.")
+    return str(templates)
+
+
+def notification_config(tmp_path, port: int) -> PipelineConfig:
+    return PipelineConfig(log_path=str(tmp_path),
+                          template_email_path=write_template(tmp_path),
+                          sender_email="cabgen@localhost",
+                          smtp_host="localhost", smtp_port=port,
+                          smtp_timeout=5, notification_rate_limit=0,
+                          notification_digest_window=0)
+
+
+def test_outbox_is_kept_in_log_path(tmp_path):
+    config = PipelineConfig(log_path=str(tmp_path))
+    assert config.outbox_database() == str(tmp_path / "outbox.sqlite3")
+
+    config = PipelineConfig(log_path=str(tmp_path),
+                            notification_outbox_path="/var/outbox.sqlite3")
+    assert config.outbox_database() == "/var/outbox.sqlite3"
+
+
+def test_drain_outbox_sends_digest(tmp_path):
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config = notification_config(tmp_path, server.server_address[1])
+        outbox = NotificationOutbox(config.outbox_database())
+        outbox.enqueue("ana@localhost", "Análise 1",
+                       "analysisFinish.template", 1)
+        outbox.enqueue("ana@localhost", "Análise 2",
+                       "analysisFinish.template", 2)
+        outbox.enqueue("rui@localhost", "Análise 3",
+                       "analysisFinish.template", 3)
+
+        sent = drain_outbox(outbox, config)
+
+        assert sorted(sent) == [1, 2, 3]
+        assert outbox.pending() == []
+        messages = {message["To"]: message for message in server.messages}
+        assert len(server.messages) == 2
+        assert messages["ana@localhost"]["Subject"] == \
+            "Análises concluídas (2 amostras)"
+        assert "Amostras: 1, 2" in messages["ana@localhost"].get_content()
+        assert messages["rui@localhost"]["Subject"] == "Análise 3"
+        outbox.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_drain_outbox_retries_when_relay_is_down(tmp_path):
+    # A port nothing listens on
+    with socket.socket() as unused:
+        unused.bind(("localhost", 0))
+        port = unused.getsockname()[1]
+    config = notification_config(tmp_path, port)
+    outbox = NotificationOutbox(config.outbox_database())
+    outbox.enqueue("ana@localhost", "Análise 1", "analysisFinish.template", 1)
+
+    assert drain_outbox(outbox, config) == []
+
+    row = outbox.connection.execute(
+        "SELECT status, attempts, last_error FROM notifications").fetchone()
+    assert row["status"] == "pending"
+    assert row["attempts"] == 1
+    assert row["last_error"]
+    assert outbox.pending() == []
+    outbox.close()
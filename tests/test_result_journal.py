@@ -0,0 +1,122 @@
+import fcntl
+import pytest
+from datetime import datetime
+from pymongo.errors import BulkWriteError
+from src.models.ResultJournal import ResultJournal, JournalReplicator, \
+    replicate_journal
+
+
+class FakeMongo:
+    """
+    Stand-in for MongoHandler.bulk_upsert recording the applied updates.
+    An update whose query has the reject key is refused as Mongo refuses a
+    bad document; from the down key on the connection is lost.
+    """
+
+    def __init__(self, reject=None, down=None):
+        self.applied = []
+        self.reject = reject
+        self.down = down
+
+    def bulk_upsert(self, collection_name, operations):
+        for index, (query, bson) in enumerate(operations):
+            key = query.get("sequenciaId", query.get("_id"))
+            if key == self.down:
+                raise ConnectionError("Connection refused.")
+            if key == self.reject:
+                raise BulkWriteError({"writeErrors": [
+                    {"index": index, "errmsg": "Document failed validation"}
+                ]})
+            self.applied.append((collection_name, key))
+        return len(operations)
+
+    def close(self):
+        pass
+
+
+def statuses(journal: ResultJournal) -> dict:
+    return dict(journal.connection.execute(
+        "SELECT seq, status FROM operations").fetchall())
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = ResultJournal(str(tmp_path / "journal.sqlite3"))
+    yield journal
+    journal.close()
+
+
+def fill(journal: ResultJournal, keys):
+    for collection_name, key in keys:
+        field = "_id" if collection_name == "sequencias" else "sequenciaId"
+        journal.save(collection_name, {field: key}, {"valor": key})
+
+
+def test_save_keeps_only_replayable_updates(journal):
+    journal.save("relatorios", {"sequenciaId": 1},
+                 {"$currentDate": {"finishedAt": True},
+                  "$set": {"estado": "ENSA"}})
+    (_, _, _, bson), = journal.pending(10)
+    assert bson["$set"]["estado"] == "ENSA"
+    assert isinstance(bson["$set"]["finishedAt"], datetime)
+
+    with pytest.raises(Exception, match=r"\$inc cannot be replayed"):
+        journal.save("sequencias", {"_id": 1}, {"$inc": {"leaseCount": 1}})
+    assert len(journal.pending(10)) == 1
+
+
+def test_replication_keeps_order_across_collections(journal):
+    keys = [("relatorios", 1), ("relatorios", 2), ("sequencias", 3),
+            ("relatorios", 4), ("sequencias", 5)]
+    fill(journal, keys)
+    mongo = FakeMongo()
+
+    assert replicate_journal(journal, mongo) == 5
+    assert mongo.applied == keys
+    assert journal.pending(10) == []
+
+
+def test_rejected_operation_is_set_aside(journal):
+    fill(journal, [("relatorios", 1), ("relatorios", 2), ("relatorios", 3),
+                   ("sequencias", 4)])
+    mongo = FakeMongo(reject=2)
+
+    assert replicate_journal(journal, mongo) == 3
+    assert mongo.applied == [("relatorios", 1), ("relatorios", 3),
+                             ("sequencias", 4)]
+    assert statuses(journal) == {1: "replicated", 2: "rejected",
+                                 3: "replicated", 4: "replicated"}
+
+
+def test_connection_error_stops_the_round(journal):
+    fill(journal, [("relatorios", 1), ("sequencias", 2), ("relatorios", 3)])
+    mongo = FakeMongo(down=2)
+
+    with pytest.raises(ConnectionError):
+        replicate_journal(journal, mongo)
+    assert mongo.applied == [("relatorios", 1)]
+    assert [seq for seq, _, _, _ in journal.pending(10)] == [2, 3]
+    assert journal.pending_samples() == {2, 3}
+
+    mongo.down = None
+    assert replicate_journal(journal, mongo) == 2
+    assert mongo.applied == [("relatorios", 1), ("sequencias", 2),
+                             ("relatorios", 3)]
+    assert journal.pending_samples() == set()
+
+
+def test_replicator_takes_turns_through_lock_file(journal, tmp_path):
+    fill(journal, [("relatorios", 1)])
+    replicator = JournalReplicator(journal.journal_path)
+    replicator.mongo_client = FakeMongo()
+    try:
+        with open(f"{journal.journal_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            assert replicator._round(blocking=False) == -1
+            assert replicator.mongo_client.applied == []
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        assert replicator._round(blocking=False) == 0
+        assert replicator.mongo_client.applied == [("relatorios", 1)]
+    finally:
+        replicator.stop()
@@ -0,0 +1,42 @@
+from glob import glob
+from os import path
+from sys import exit, argv
+from typing import List
+from src.models.PipelineConfig import PipelineConfig
+from src.utils.handle_trace import merge_traces
+
+usage = """Usage:
+    python3 trace_main.py merge <output.json> [YYYYmmdd ...]
+
+Merges the trace files of the scheduler and workers of the given days (all
+by default) into one timeline for chrome://tracing or ui.perfetto.dev."""
+
+
+def main(args: List[str]):
+    if len(args) < 2 or args[0] != "merge":
+        print(usage)
+        exit(1)
+
+    config = PipelineConfig.from_env()
+    if not config.trace_path:
+        raise Exception("TRACE_PATH is not defined.")
+
+    days = args[2:] or [""]
+    trace_files = sorted(
+        trace_file for day in days
+        for trace_file in glob(path.join(config.trace_path,
+                                         f"trace-{day}*.json")))
+    if not trace_files:
+        raise Exception("No trace files found.")
+
+    events = merge_traces(trace_files, args[1])
+    print(f"Merged {events} events from {len(trace_files)} files into "
+          f"{args[1]}.")
+
+
+if __name__ == "__main__":
+    try:
+        main(argv[1:])
+    except Exception as err:
+        print(err)
+        exit(1)